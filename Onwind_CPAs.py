@@ -13,17 +13,25 @@ With QGIS : 31613
         # a. the technology type and,
         # b. the exclusion scenario
 # Finally, when running you have the ability to save the file to your desired location.
-# Select 'CSV' when pointing to the output location for the attribute table of the resulting CPAs
+# For the attribute table of the resulting CPAs, set the 'CPA attribute table' output (a .csv written straight
+# from the attributes), or save the CPAs as .parquet or .arrow rather than selecting 'CSV' for the CPAs output
 
 
 
 
 ##### SET FILEPATH #######
-######  VVVVVVV  #########
+######  VVVVVVV  #########
 #filepath = "/Users/elesl/Dropbox/GIS Runs - Montara/Run_files/"
 filepath = "/Users/joebettles/Dropbox/GIS Runs - Montara/Run_files/"
 #####   ^^^^^^^  ########
 
+SUBSTATIONS_SHP = filepath+'5_transmissionAndInfrastructure/ENTSO_Substations/entso_substations.shp'
+NUTS_SHP = filepath+'3_geographicBoundaries/NUTS_2_Boundries/NUTS_RG_10M_2021_3857_LEVL_2.shp'
+# Persistent cache of the static preprocessing layers, outside the shared Dropbox folder (see CACHE)
+CACHE_FOLDER = '~/.cpa_cache'
+# Key of the warm worker, outside the cache so clearing it does not lock clients out (see WARM WORKER)
+WORKER_FOLDER = '~/.cpa_worker'
+
 
 
 from qgis.core import QgsProcessing
@@ -32,11 +40,2638 @@ from qgis.core import QgsProcessingMultiStepFeedback
 from qgis.core import QgsProcessingParameterNumber
 from qgis.core import QgsProcessingParameterCrs
 from qgis.core import QgsProcessingParameterRasterLayer
+from qgis.core import QgsProcessingParameterVectorLayer
 from qgis.core import QgsProcessingParameterFeatureSink
 from qgis.core import QgsProcessingParameterBoolean
+from qgis.core import QgsProcessingParameterEnum
+from qgis.core import QgsProcessingParameterFile
+from qgis.core import QgsProcessingParameterFileDestination
+from qgis.core import QgsProcessingUtils
+from qgis.core import QgsFeature
+from qgis.core import QgsFeatureRequest
+from qgis.core import QgsFeatureSink
+from qgis.core import QgsField
+from qgis.core import QgsFields
+from qgis.core import QgsGeometry
+from qgis.core import QgsRectangle
+from qgis.core import QgsSpatialIndex
+from qgis.core import QgsPointXY
+from qgis.core import QgsWkbTypes
+from qgis.core import QgsCoordinateTransform
+from qgis.core import QgsCoordinateReferenceSystem
+from qgis.core import QgsDistanceArea
+from qgis.core import QgsVectorLayer
+from qgis.core import QgsRasterLayer
+from qgis.core import Qgis
+from qgis.core import QgsProject
+from qgis.core import QgsApplication
+from qgis.core import QgsProcessingContext
+from qgis.core import QgsProcessingFeedback
+from qgis.core import QgsProcessingException
+from qgis.core import NULL
+from qgis.analysis import QgsNativeAlgorithms
+from qgis.PyQt.QtCore import QVariant
+from osgeo import gdal
+from osgeo import ogr
+from osgeo import osr
+import numpy as np
 import processing
+import argparse
+import csv
+import glob
+import hashlib
+import itertools
+import json
+import math
+import queue
+import os
+import platform
+import secrets
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import Client, Listener
+
+
+##### COST ASSUMPTIONS #######
+# Capacity factor derate applied to the raster mean CF
+CF_DERATE = 0.85
+# Installed capacity density (MW/km2)
+MW_PER_SQKM = 5
+HOURS_PER_YEAR = 8760
+# Plant capital cost (per MW)
+PLANT_COST_PER_MW = 1480024
+# Interconnection cost (per km to the nearest substation)
+INTER_COST_PER_KM = 517056
+# Annuity factor used to turn capital cost into annual payments
+ANNUITY_FACTOR = 0.073
+# CPAs with a resource area at or below this (km2) are removed
+MIN_CPA_SQKM = 0.5
+
+# The cost assumptions as coefficients for calc_cpa_attributes and re-costing (see RE-COSTING)
+DEFAULT_COEFFICIENTS = {
+    'cf_derate': CF_DERATE,
+    'mw_per_sqkm': MW_PER_SQKM,
+    'plant_cost_per_mw': PLANT_COST_PER_MW,
+    'inter_cost_per_km': INTER_COST_PER_KM,
+    'annuity_factor': ANNUITY_FACTOR,
+}
+
+# Attributes computed by the fused "CPA attributes" stage.
+# (name, type, length, precision, field(s) the new column is placed after, first one present wins)
+# The anchors reproduce the column order of the old one-fieldcalculator-per-attribute chain.
+CPA_ATTRIBUTE_FIELDS = [
+    ('CF', QVariant.Double, 0, 0, 'CF_mean'),
+    ('Name_cap', QVariant.Double, 15, 6, 'SqKm'),
+    ('Name_cap_gw', QVariant.Double, 10, 5, 'Name_cap'),
+    ('An_gen', QVariant.Double, 20, 3, 'Name_cap_gw'),
+    ('Plant_cost', QVariant.Double, 20, 3, 'An_gen'),
+    ('Inter_cost', QVariant.Double, 10, 3, ('nearest_y', 'distance')),
+    ('Total_cost', QVariant.Double, 10, 3, 'Inter_cost'),
+    ('An_payments', QVariant.Double, 10, 3, 'Total_cost'),
+    ('LCOE', QVariant.Double, 10, 3, 'An_payments'),
+    ('Sub_NUTS_ID', QVariant.String, 0, 0, 'NUTS_ID'),
+    ('CPA_ID', QVariant.String, 10, 0, None),
+    ('E37_CPA_ID', QVariant.String, 20, 0, 'CPA_ID'),
+]
+
+# Working fields removed by "Drop field(s)"
+DROP_FIELDS = ['fid','DN','x','n','feature_x','feature_y','nearest_x','nearest_y']
+
+# CPA outputs in a columnar format (GDAL's Parquet and Arrow drivers) are written by the CPA attributes stage
+# itself with only the kept columns, instead of being copied once more by Drop field(s)
+COLUMNAR_DRIVERS = {'.parquet': 'Parquet', '.arrow': 'Arrow', '.arrows': 'Arrow', '.feather': 'Arrow'}
+
+
+def columnar_driver(destination):
+    # OGR driver of a columnar output path, None for any other output
+    driver = COLUMNAR_DRIVERS.get(os.path.splitext(str(destination).split('|')[0])[1].lower())
+    if driver and ogr.GetDriverByName(driver) is None:
+        raise QgsProcessingException('GDAL has no {} driver, {} cannot be written'.format(driver, destination))
+    return driver
+
+
+def _as_float(value):
+    # NULL attributes become NaN so they propagate through the vectorized math like NULL does in expressions
+    if value is None or value == NULL:
+        return np.nan
+    return float(value)
+
+
+def _as_str(value):
+    if value is None or value == NULL:
+        return None
+    return str(value)
+
+
+def cost_coefficients(coefficients=None):
+    # DEFAULT_COEFFICIENTS overridden by coefficients
+    unknown = set(coefficients or {}) - set(DEFAULT_COEFFICIENTS)
+    if unknown:
+        raise ValueError('Unknown cost coefficients: {}'.format(', '.join(sorted(unknown))))
+    return dict(DEFAULT_COEFFICIENTS, **(coefficients or {}))
+
+
+def calc_cpa_attributes(cf_mean, sqkm, distance, sub_id, nuts_id, coefficients=None):
+    # Vectorized equivalent of the field calculator chain:
+    #   CF          = "CF_mean" * 0.85
+    #   Name_cap    = "SqKm" * 5
+    #   Name_cap_gw = "Name_cap"/1000
+    #   An_gen      = "Name_cap" * 8760 *"CF"
+    #   Plant_cost  = "Name_cap" * 1480024
+    #   Inter_cost  = 517056 * ("distance"/1000)
+    #   Total_cost  = "Plant_cost" + "Inter_cost"
+    #   An_payments = "Total_cost" * 0.073
+    #   LCOE        = "An_payments" / "An_gen"
+    #   Sub_NUTS_ID = substr("Sub_ID",5,4)
+    #   CPA_ID      = @row_number
+    #   E37_CPA_ID  = concat("NUTS_ID",'_',"CPA_ID")
+    # with the constants taken from coefficients (DEFAULT_COEFFICIENTS unless given).
+    # Numeric inputs are float arrays with NaN for NULL, string inputs are lists with None for NULL.
+    # Returns a dict of column name -> float array (NaN for NULL) or list of strings (None for NULL).
+    c = cost_coefficients(coefficients)
+    cf_mean = np.asarray(cf_mean, dtype=float)
+    sqkm = np.asarray(sqkm, dtype=float)
+    distance = np.asarray(distance, dtype=float)
+
+    cf = cf_mean * c['cf_derate']
+    name_cap = sqkm * c['mw_per_sqkm']
+    name_cap_gw = name_cap / 1000
+    an_gen = name_cap * HOURS_PER_YEAR * cf
+    plant_cost = name_cap * c['plant_cost_per_mw']
+    inter_cost = c['inter_cost_per_km'] * (distance / 1000)
+    total_cost = plant_cost + inter_cost
+    an_payments = total_cost * c['annuity_factor']
+    # Division by zero is NULL in QGIS expressions
+    with np.errstate(divide='ignore', invalid='ignore'):
+        lcoe = np.where(an_gen == 0, np.nan, an_payments / an_gen)
+
+    sub_nuts_id = [None if s is None else s[4:8] for s in sub_id]
+    cpa_id = [str(i) for i in range(1, len(cf_mean) + 1)]
+    e37_cpa_id = ['{}_{}'.format('' if n is None else n, i) for n, i in zip(nuts_id, cpa_id)]
+
+    return {
+        'CF': cf,
+        'Name_cap': name_cap,
+        'Name_cap_gw': name_cap_gw,
+        'An_gen': an_gen,
+        'Plant_cost': plant_cost,
+        'Inter_cost': inter_cost,
+        'Total_cost': total_cost,
+        'An_payments': an_payments,
+        'LCOE': lcoe,
+        'Sub_NUTS_ID': sub_nuts_id,
+        'CPA_ID': cpa_id,
+        'E37_CPA_ID': e37_cpa_id,
+    }
+
+
+def cpa_attribute_fields(input_fields):
+    # Input fields with the computed CPA attributes inserted at their usual position.
+    # Columns the input already has under a computed name are replaced.
+    computed = {spec[0]: spec for spec in CPA_ATTRIBUTE_FIELDS}
+    names = [f.name() for f in input_fields if f.name() not in computed]
+    for name, _type, _length, _precision, after in CPA_ATTRIBUTE_FIELDS:
+        anchors = [a for a in (after if isinstance(after, tuple) else (after,)) if a in names]
+        if anchors:
+            names.insert(names.index(anchors[0]) + 1, name)
+        else:
+            names.append(name)
+    fields = QgsFields()
+    for name in names:
+        if name in computed:
+            _name, field_type, length, precision, _after = computed[name]
+            fields.append(QgsField(name, field_type, len=length, prec=precision))
+        else:
+            fields.append(input_fields.field(name))
+    return fields
+
+
+# Per-CPA inputs of the attribute formulas, i.e. everything the geometry pipeline contributes
+CPA_INPUT_COLUMNS = ['CF_mean', 'SqKm', 'distance', 'Sub_ID', 'NUTS_ID', 'CNTR_CODE']
+CPA_STRING_COLUMNS = ['Sub_ID', 'NUTS_ID', 'CNTR_CODE']
+
+
+def read_cpa_inputs(layer):
+    # CPA_INPUT_COLUMNS of a layer in feature order: float arrays (NaN for NULL) and lists of strings (None for NULL)
+    names = [name for name in CPA_INPUT_COLUMNS if layer.fields().indexOf(name) >= 0]
+    values = {name: [] for name in names}
+    request = QgsFeatureRequest().setFlags(QgsFeatureRequest.NoGeometry).setSubsetOfAttributes(names, layer.fields())
+    for feature in layer.getFeatures(request):
+        for name in names:
+            values[name].append(feature[name])
+    columns = {}
+    for name in names:
+        if name in CPA_STRING_COLUMNS:
+            columns[name] = [_as_str(v) for v in values[name]]
+        else:
+            columns[name] = np.array([_as_float(v) for v in values[name]], dtype=float)
+    return columns
+
+
+def fuse_cpa_attributes(source, context, feedback, drop=(), create_sink=None):
+    # Compute every derived CPA attribute in one stage: read the input columns into arrays once,
+    # evaluate the formulas with NumPy and write all new columns in a single pass, leaving out the fields in drop.
+    # create_sink(fields, wkb_type, crs) -> (sink, dest_id) opens the output, a temporary layer by default.
+    # Returns the output id, usable like a child algorithm 'OUTPUT'.
+    layer = QgsProcessingUtils.mapLayerFromString(source, context)
+    input_fields = layer.fields()
+
+    columns = read_cpa_inputs(layer)
+    if feedback.isCanceled():
+        return None
+
+    computed = calc_cpa_attributes(columns['CF_mean'], columns['SqKm'], columns['distance'], columns['Sub_ID'], columns['NUTS_ID'])
+    # Back to plain Python values with None for NULL, which is what QgsFeature accepts
+    for name, values in computed.items():
+        if isinstance(values, np.ndarray):
+            computed[name] = [None if np.isnan(v) else float(v) for v in values]
+
+    fields = QgsFields()
+    for field in cpa_attribute_fields(input_fields):
+        if field.name() not in drop:
+            fields.append(field)
+    if create_sink is None:
+        sink, dest_id = QgsProcessingUtils.createFeatureSink('memory:', context, fields, layer.wkbType(), layer.crs())
+    else:
+        sink, dest_id = create_sink(fields, layer.wkbType(), layer.crs())
+    input_index = [input_fields.indexOf(f.name()) for f in fields]
+    total = 100.0 / layer.featureCount() if layer.featureCount() else 0
+    for row, feature in enumerate(layer.getFeatures()):
+        if feedback.isCanceled():
+            return None
+        attributes = feature.attributes()
+        out = QgsFeature(fields)
+        out.setGeometry(feature.geometry())
+        out.setAttributes([computed[f.name()][row] if f.name() in computed else attributes[i] for f, i in zip(fields, input_index)])
+        sink.addFeature(out, QgsFeatureSink.FastInsert)
+        feedback.setProgress(row * total)
+    del sink
+    return dest_id
+
+
+##### RE-COSTING #######
+# Every run stores the per-CPA results of the geometry pipeline (CPA_INPUT_COLUMNS, in output order) as
+# <output name>_cost_inputs.npz next to the CPA output. recost() recomputes the attribute table from that file
+# for another set of cost coefficients without touching geometry, and recost_sweep() does it for every
+# combination of a grid of coefficients:
+#     recost_sweep('cpas_cost_inputs.npz', {'plant_cost_per_mw': [1.3e6, 1.48e6], 'annuity_factor': [0.06, 0.073]}, 'sweep')
+# or standalone:
+#     python Onwind_CPAs.py --recost cpas_cost_inputs.npz --output sweep --set plant_cost_per_mw=1.3e6,1.48e6
+# Coefficient names are the keys of DEFAULT_COEFFICIENTS.
+
+# Columns of the CPA attribute table, in the order the model writes them
+ATTRIBUTE_TABLE_COLUMNS = [
+    'CF_mean', 'CF', 'SqKm', 'Name_cap', 'Name_cap_gw', 'An_gen', 'Plant_cost', 'Sub_ID', 'distance', 'Inter_cost',
+    'Total_cost', 'An_payments', 'LCOE', 'NUTS_ID', 'Sub_NUTS_ID', 'CNTR_CODE', 'CPA_ID', 'E37_CPA_ID',
+]
+
+
+def save_cpa_inputs(path, columns):
+    # Strings are stored with '' for NULL
+    arrays = {}
+    for name, values in columns.items():
+        if name in CPA_STRING_COLUMNS:
+            arrays[name] = np.array(['' if v is None else v for v in values], dtype=str)
+        else:
+            arrays[name] = np.asarray(values, dtype=float)
+    np.savez_compressed(path, **arrays)
+    return path
+
+
+def load_cpa_inputs(path):
+    columns = {}
+    with np.load(path) as data:
+        for name in data.files:
+            if name in CPA_STRING_COLUMNS:
+                columns[name] = [v or None for v in data[name].tolist()]
+            else:
+                columns[name] = data[name]
+    return columns
+
+
+def recost(inputs, coefficients=None):
+    # Attribute table (ATTRIBUTE_TABLE_COLUMNS -> values) for the CPA inputs (a dict or a saved .npz path)
+    if isinstance(inputs, str):
+        inputs = load_cpa_inputs(inputs)
+    table = dict(inputs)
+    table.update(calc_cpa_attributes(inputs['CF_mean'], inputs['SqKm'], inputs['distance'], inputs['Sub_ID'], inputs['NUTS_ID'], coefficients))
+    return {name: table[name] for name in ATTRIBUTE_TABLE_COLUMNS if name in table}
+
+
+# Rows converted and written at a time by write_attribute_table
+CSV_CHUNK_ROWS = 100000
+
+
+def _csv_cells(values):
+    # A slice of a column as CSV cells, NULL (None or NaN) as an empty cell. Floats are written as str() writes them.
+    if isinstance(values, np.ndarray):
+        cells = values.astype(str)
+        if values.dtype.kind == 'f':
+            cells[np.isnan(values)] = ''
+        return cells.tolist()
+    return ['' if v is None or (isinstance(v, float) and math.isnan(v)) else v for v in values]
+
+
+def write_attribute_table(path, table, chunk_rows=CSV_CHUNK_ROWS):
+    # CSV with NULL written as an empty cell. Columns are converted in chunks of chunk_rows rows, so a
+    # multi-million-row table never exists as Python row tuples all at once.
+    names = list(table)
+    rows = len(table[names[0]]) if names else 0
+    with open(path, 'w', newline='') as table_file:
+        writer = csv.writer(table_file)
+        writer.writerow(names)
+        for start in range(0, rows, chunk_rows):
+            writer.writerows(zip(*(_csv_cells(table[name][start:start + chunk_rows]) for name in names)))
+    return path
+
+
+def recost_sweep(inputs, grid, output_folder):
+    # One attribute table per combination of the coefficient values in grid ({name: [values]}), written as
+    # <output_folder>/recost_<n>.csv, plus sweep_index.csv mapping files to coefficients. Returns the index rows.
+    if isinstance(inputs, str):
+        inputs = load_cpa_inputs(inputs)
+    os.makedirs(output_folder, exist_ok=True)
+    names = sorted(grid)
+    rows = []
+    for n, values in enumerate(itertools.product(*(grid[name] for name in names))):
+        coefficients = cost_coefficients(dict(zip(names, values)))
+        path = write_attribute_table(os.path.join(output_folder, 'recost_{}.csv'.format(n)), recost(inputs, coefficients))
+        rows.append(dict(coefficients, table=path))
+    with open(os.path.join(output_folder, 'sweep_index.csv'), 'w', newline='') as index_file:
+        writer = csv.DictWriter(index_file, ['table'] + sorted(DEFAULT_COEFFICIENTS))
+        writer.writeheader()
+        writer.writerows(rows)
+    return rows
+
+
+##### SUPPLY CURVES #######
+# Optional SupplyCurves output: cumulative LCOE supply curves per NUTS_ID and per CNTR_CODE, computed from the
+# attribute arrays with one sort and bincounts instead of from the CPA rows. CPAs are binned by LCOE into bins
+# of SupplyCurveResolution (EUR/MWh), so a region has one row per bin that holds CPAs, in order of LCOE:
+#     level, region, LCOE_from, LCOE_to   the grouping column, its value and the bin
+#     CPAs, Name_cap_gw, An_gen           CPA count, capacity and generation in the bin
+#     LCOE_mean                           An_payments / An_gen of the bin
+#     Cum_cap_gw, Cum_gen                 capacity and generation of the region up to and including the bin
+# CPAs without an LCOE (no generation) are left out.
+SUPPLY_CURVE_LEVELS = ['NUTS_ID', 'CNTR_CODE']
+SUPPLY_CURVE_COLUMNS = ['level', 'region', 'LCOE_from', 'LCOE_to', 'CPAs', 'Name_cap_gw', 'An_gen', 'LCOE_mean', 'Cum_cap_gw', 'Cum_gen']
+
+
+def supply_curves(table, resolution=1.0):
+    # Supply curve table (SUPPLY_CURVE_COLUMNS -> arrays) of an attribute table (see recost())
+    lcoe = np.asarray(table['LCOE'], dtype=float)
+    priced = np.isfinite(lcoe)
+    bins = np.floor(lcoe[priced] / resolution).astype(np.int64)
+    capacity = np.asarray(table['Name_cap_gw'], dtype=float)[priced]
+    generation = np.asarray(table['An_gen'], dtype=float)[priced]
+    payments = np.asarray(table['An_payments'], dtype=float)[priced]
+
+    curves = {name: [] for name in SUPPLY_CURVE_COLUMNS}
+    for level in SUPPLY_CURVE_LEVELS:
+        if level not in table:
+            continue
+        regions, codes = np.unique(np.array(['' if v is None else v for v in table[level]], dtype=str)[priced], return_inverse=True)
+        # Groups sorted by region, then bin
+        groups, group = np.unique(np.column_stack([codes.ravel(), bins]).reshape(-1, 2), axis=0, return_inverse=True)
+        group = group.ravel()
+        sums = {name: np.bincount(group, weights=values, minlength=len(groups))
+                for name, values in (('Name_cap_gw', capacity), ('An_gen', generation), ('An_payments', payments))}
+        # Cumulative sums restarting at every region
+        starts = np.flatnonzero(np.r_[True, np.diff(groups[:, 0]) != 0])
+        sizes = np.diff(np.r_[starts, len(groups)])
+        cumulative = {}
+        for name in ('Name_cap_gw', 'An_gen'):
+            running = np.cumsum(sums[name])
+            cumulative[name] = running - np.repeat(np.r_[0.0, running][starts], sizes)
+
+        curves['level'].extend([level] * len(groups))
+        curves['region'].extend(regions[groups[:, 0]].tolist())
+        curves['LCOE_from'].append(groups[:, 1] * resolution)
+        curves['LCOE_to'].append((groups[:, 1] + 1) * resolution)
+        curves['CPAs'].append(np.bincount(group, minlength=len(groups)))
+        curves['Name_cap_gw'].append(sums['Name_cap_gw'])
+        curves['An_gen'].append(sums['An_gen'])
+        with np.errstate(divide='ignore', invalid='ignore'):
+            curves['LCOE_mean'].append(np.where(sums['An_gen'] == 0, np.nan, sums['An_payments'] / sums['An_gen']))
+        curves['Cum_cap_gw'].append(cumulative['Name_cap_gw'])
+        curves['Cum_gen'].append(cumulative['An_gen'])
+    return {name: values if name in ('level', 'region') else np.concatenate(values) if values else np.zeros(0)
+            for name, values in curves.items()}
+
+
+def supply_curve_fields():
+    fields = QgsFields()
+    fields.append(QgsField('level', QVariant.String))
+    fields.append(QgsField('region', QVariant.String))
+    for name in SUPPLY_CURVE_COLUMNS[2:]:
+        fields.append(QgsField(name, QVariant.Int if name == 'CPAs' else QVariant.Double))
+    return fields
+
+
+def write_supply_curves(sink, curves):
+    # Add the rows of curves (see supply_curves()) to a geometryless feature sink
+    fields = supply_curve_fields()
+    columns = [curves[name] if name in ('level', 'region') else curves[name].tolist() for name in SUPPLY_CURVE_COLUMNS]
+    for row in zip(*columns):
+        feature = QgsFeature(fields)
+        feature.setAttributes([NULL if isinstance(v, float) and math.isnan(v) else v for v in row])
+        sink.addFeature(feature, QgsFeatureSink.FastInsert)
+
+
+##### PROFILING #######
+# Every run is timed step by step: wall time, CPU time (including worker processes), peak RSS and the feature
+# or pixel counts of each child algorithm's inputs and outputs. The report is written as JSON and CSV next to
+# the CPA output, and summarised in the log when VERBOSE_LOG is on.
+# Peak RSS is the process high-water mark at the end of the step (not available on Windows).
+STEP_NAMES = [
+    'Repr Substations', 'Fix Substations', 'Fixed Boundary Layer', 'Reclassify by table', 'CF Grid', 'Fix Grid',
+    'Polygonize (raster to vector)', 'Add x field', 'Fix polys', 'Dissolve', 'Fix Resource Polys', 'Grided Resource',
+    'Resource with CF', 'Fix CF Polys', 'Calc: resource area polygon', 'Remove CPAs below cutoff',
+    'Distance to substations', 'NUTS IDs to CPAs', 'COUNTRY IDs to CPAs', 'CPA attributes', 'Drop field(s)',
+]
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+def _peak_rss_mb():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return round(peak / (1024.0 * 1024.0 if sys.platform == 'darwin' else 1024.0), 1)
+
+
+def _cpu_seconds():
+    times = os.times()
+    return times.user + times.system + times.children_user + times.children_system
+
+
+def layer_size(source, context):
+    # Feature count of a vector layer or pixel count of a raster layer, None if it can't be resolved
+    if not isinstance(source, str) or source == QgsProcessing.TEMPORARY_OUTPUT:
+        return None
+    layer = QgsProcessingUtils.mapLayerFromString(source, context)
+    if isinstance(layer, QgsVectorLayer):
+        return layer.featureCount()
+    if isinstance(layer, QgsRasterLayer):
+        return layer.width() * layer.height()
+    return None
+
+
+class StepProfiler:
+
+    def __init__(self):
+        self.steps = []
+        self.current = None
+        self.started = time.perf_counter()
+
+    def begin(self, step, name):
+        self.end()
+        self.current = {'step': step, 'name': name, 'inputs': {}, 'outputs': {}, 'counts': {},
+                        '_wall': time.perf_counter(), '_cpu': _cpu_seconds()}
+
+    def rename(self, name):
+        if self.current is not None:
+            self.current['name'] = name
+
+    def note(self, context, inputs=None, outputs=None):
+        # Record the sizes of a step's inputs/outputs, given as {parameter name: layer source}
+        if self.current is None:
+            return
+        for target, sources in (('inputs', inputs), ('outputs', outputs)):
+            for key, source in (sources or {}).items():
+                size = layer_size(source, context)
+                if size is not None:
+                    self.current[target][key] = size
+
+    def count(self, key, value):
+        # A figure of the current step other than a layer size, such as the number of repaired features
+        if self.current is not None:
+            self.current['counts'][key] = value
+
+    def end(self):
+        if self.current is None:
+            return
+        record = self.current
+        record['wall_s'] = round(time.perf_counter() - record.pop('_wall'), 3)
+        record['cpu_s'] = round(_cpu_seconds() - record.pop('_cpu'), 3)
+        record['peak_rss_mb'] = _peak_rss_mb()
+        self.steps.append(record)
+        self.current = None
+
+    def add(self, step, name, wall_s):
+        # A step timed by the stage scheduler. CPU time is per process, so concurrent stages have none of their own.
+        self.steps.append({'step': step, 'name': name, 'inputs': {}, 'outputs': {}, 'counts': {}, 'wall_s': round(wall_s, 3),
+                           'cpu_s': None, 'peak_rss_mb': _peak_rss_mb()})
+
+    def report(self):
+        self.end()
+        return {
+            'algorithm': 'CPAs - Onwind',
+            'qgis_version': Qgis.QGIS_VERSION,
+            'wall_s': round(time.perf_counter() - self.started, 3),
+            'peak_rss_mb': _peak_rss_mb(),
+            'steps': self.steps,
+        }
+
+    def write(self, stem):
+        # Write <stem>_profile.json and <stem>_profile.csv, returns the JSON path
+        report = self.report()
+        with open(stem + '_profile.json', 'w') as report_file:
+            json.dump(report, report_file, indent=2)
+        with open(stem + '_profile.csv', 'w', newline='') as report_file:
+            writer = csv.writer(report_file)
+            writer.writerow(['step', 'name', 'wall_s', 'cpu_s', 'peak_rss_mb', 'inputs', 'outputs', 'counts'])
+            for record in report['steps']:
+                writer.writerow([record['step'], record['name'], record['wall_s'], record['cpu_s'], record['peak_rss_mb'],
+                                 ';'.join('{}={}'.format(k, v) for k, v in record['inputs'].items()),
+                                 ';'.join('{}={}'.format(k, v) for k, v in record['outputs'].items()),
+                                 ';'.join('{}={}'.format(k, v) for k, v in record['counts'].items())])
+        return stem + '_profile.json'
+
+    def summary(self):
+        lines = ['{:>3} {:<32} {:>10} {:>10} {:>10}  {}'.format('#', 'step', 'wall s', 'cpu s', 'rss MB', 'in -> out')]
+        for record in self.steps:
+            lines.append('{:>3} {:<32} {:>10.2f} {:>10} {:>10}  {} -> {}'.format(
+                record['step'], record['name'][:32], record['wall_s'],
+                '-' if record['cpu_s'] is None else '{:.2f}'.format(record['cpu_s']), record['peak_rss_mb'],
+                sum(record['inputs'].values()), sum(record['outputs'].values())))
+        return '\n'.join(lines)
+
+
+class ProfilingFeedback(QgsProcessingMultiStepFeedback):
+    # Multi-step feedback that times the model between setCurrentStep() calls, logging each finished step if verbose
+
+    def __init__(self, steps, feedback, profiler, verbose=False):
+        super().__init__(steps, feedback)
+        self.profiler = profiler
+        self.verbose = verbose
+        self.step_count = steps
+        self.model_feedback = feedback
+        self.profiler.begin(0, STEP_NAMES[0])
+
+    def setStepsDone(self, steps_done):
+        # Overall progress while several steps run at once (see STAGE SCHEDULER), steps_done may be fractional
+        self.model_feedback.setProgress(100.0 * steps_done / self.step_count)
+
+    def setCurrentStep(self, step):
+        if self.profiler.current is None or self.profiler.current['step'] != step:
+            self.profiler.begin(step, STEP_NAMES[step])
+            if self.verbose and self.profiler.steps:
+                last = self.profiler.steps[-1]
+                self.pushInfo('{}: {:.2f} s wall, {:.2f} s CPU, peak RSS {} MB'.format(last['name'], last['wall_s'], last['cpu_s'], last['peak_rss_mb']))
+        super().setCurrentStep(step)
+
+
+def _profiler(feedback):
+    return getattr(feedback, 'profiler', None)
+
+
+def name_step(feedback, name):
+    # Label the current step in the profile when it runs something other than its usual child algorithm
+    if _profiler(feedback):
+        _profiler(feedback).rename(name)
+
+
+def note_step(feedback, context, inputs=None, outputs=None):
+    if _profiler(feedback):
+        _profiler(feedback).note(context, inputs, outputs)
+
+
+def count_step(feedback, key, value):
+    if _profiler(feedback):
+        _profiler(feedback).count(key, value)
+
+
+def run_child(alg_id, alg_params, context, feedback):
+    # processing.run for a child algorithm, recording input and output sizes when the run is profiled
+    result = processing.run(alg_id, alg_params, context=context, feedback=feedback, is_child_algorithm=True)
+    if _profiler(feedback):
+        inputs = {k: v for k, v in alg_params.items() if k in ('INPUT', 'INPUT_RASTER', 'INPUT_2', 'OVERLAY', 'LINES')}
+        _profiler(feedback).note(context, inputs, {'OUTPUT': result.get('OUTPUT')})
+    return result
+
+
+##### STAGE SCHEDULER #######
+# With ConcurrentStages on, the branches of the model that do not depend on each other run at the same time on
+# a thread pool of Workers threads: the substations (steps 0-1), the boundaries (2) followed by the CF grid
+# (4-5), and the resource polygons (3, 6-10), or the raster grid CPAs once the boundaries exist. The rest of the
+# model runs in order once they have all finished. Each stage has a processing context of its own whose layers
+# are handed to the model's context when it finishes, so layers one stage passes to another have to be files.
+
+class Stage:
+    # A node of the model DAG. run(context, feedback, outputs) fills outputs[key] for the keys in produces, and
+    # may read outputs[key] for the keys in requires. It returns False if the run was cancelled.
+
+    def __init__(self, name, steps, requires, produces, run):
+        self.name = name
+        self.steps = steps
+        self.requires = requires
+        self.produces = produces
+        self.run = run
+
+
+class StageFeedback(QgsProcessingFeedback):
+    # Feedback of a stage on a worker thread. It only records progress, the model step the stage is at and its
+    # log messages; the scheduler forwards them from the main thread.
+
+    def __init__(self, steps):
+        super().__init__()
+        self.steps = steps
+        self.step = steps[0]
+        self.messages = queue.Queue()
+
+    def setCurrentStep(self, step):
+        self.step = step
+        self.setProgress(0)
+
+    def steps_done(self):
+        done = self.steps.index(self.step) if self.step in self.steps else 0
+        return done + self.progress() / 100.0
+
+    def pushInfo(self, info):
+        self.messages.put((False, info))
+
+    def pushConsoleInfo(self, info):
+        self.messages.put((False, info))
+
+    def reportError(self, error, fatalError=False):
+        self.messages.put((True, error))
+
+
+def _run_stage(stage, main_context, main_thread, feedback, outputs):
+    # Worker thread side: a context of its own, handed back to the main thread with the layers it holds
+    context = QgsProcessingContext()
+    context.copyThreadSafeSettings(main_context)
+    started = time.perf_counter()
+    finished = stage.run(context, feedback, outputs)
+    context.pushToThread(main_thread)
+    return finished, context, time.perf_counter() - started
+
+
+def run_stages(stages, context, feedback, workers, outputs=None):
+    # Run stages as soon as the outputs they require have been produced, at most workers at a time. outputs are
+    # the ones available from the start. Progress goes to feedback (a ProfilingFeedback) as the sum of the steps
+    # done by every stage. Returns the outputs of all stages, None if the run was cancelled.
+    outputs = dict(outputs or {})
+    produced = set(outputs)
+    pending = list(stages)
+    running = {}
+    done_steps = 0
+    cancelled = False
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        while pending or running:
+            for stage in [stage for stage in pending if set(stage.requires) <= produced]:
+                pending.remove(stage)
+                if cancelled:
+                    continue
+                stage_feedback = StageFeedback(stage.steps)
+                stage_outputs = {key: outputs[key] for key in stage.requires}
+                future = pool.submit(_run_stage, stage, context, context.thread(), stage_feedback, stage_outputs)
+                running[future] = (stage, stage_feedback, stage_outputs)
+            if not running:
+                if pending and not cancelled:
+                    raise QgsProcessingException('Stage(s) {} require outputs no stage produces'.format(', '.join(stage.name for stage in pending)))
+                break
+
+            finished, _running = wait(running, timeout=0.2, return_when=FIRST_COMPLETED)
+            if feedback.isCanceled() and not cancelled:
+                cancelled = True
+                for _stage, stage_feedback, _outputs in running.values():
+                    stage_feedback.cancel()
+            for stage, stage_feedback, _outputs in running.values():
+                while not stage_feedback.messages.empty():
+                    is_error, message = stage_feedback.messages.get()
+                    if is_error:
+                        feedback.reportError('{}: {}'.format(stage.name, message))
+                    else:
+                        feedback.pushInfo('{}: {}'.format(stage.name, message))
+
+            for future in finished:
+                stage, stage_feedback, stage_outputs = running.pop(future)
+                try:
+                    completed, stage_context, wall_s = future.result()
+                except Exception:
+                    for _stage, other_feedback, _outputs in running.values():
+                        other_feedback.cancel()
+                    raise
+                context.takeResultsFrom(stage_context)
+                feedback.profiler.add(stage.steps[0], '{} (steps {})'.format(stage.name, ', '.join(str(step) for step in stage.steps)), wall_s)
+                if not completed:
+                    cancelled = True
+                    continue
+                outputs.update(stage_outputs)
+                produced.update(stage.produces)
+                done_steps += len(stage.steps)
+            feedback.setStepsDone(done_steps + sum(stage_feedback.steps_done() for _stage, stage_feedback, _outputs in running.values()))
+    return None if cancelled else outputs
+
+
+##### CHECKPOINTS #######
+# With a CheckpointFolder, the outputs of the expensive vector steps (polygonize, dissolve, split, zonal
+# statistics) are written to <CheckpointFolder>/<fingerprint>/ as GeoPackages. The fingerprint covers what those
+# steps depend on: the checksums of the ResourceRaster and the NUTS boundaries, CPAGridLength, the grid CRS and
+# the parameters that change how the steps run (CHECKPOINT_PARAMETERS).
+# A checkpoint is built under a .partial name and renamed once its step has finished, so an interrupted step
+# leaves nothing behind. A run with the same fingerprint resumes after its last checkpoint.
+CHECKPOINT_STEPS = {6: 'PolygonizeRasterToVector', 9: 'Dissolve', 11: 'GridedResource', 12: 'ResourceWithCf'}
+CHECKPOINT_PARAMETERS = ('EuropeCRS', 'GeometryRepair', 'GridPruning', 'CompactCells', 'WindowedRaster', 'Streaming')
+
+
+def checkpoint_fingerprint(raster, grid_length, grid_crs, settings=None, memo=True):
+    # settings are the values of CHECKPOINT_PARAMETERS, memo as in file_fingerprint()
+    settings = ['{}={}'.format(name, value) for name, value in sorted((settings or {}).items())]
+    checksums = [file_fingerprint(raster, memo), file_fingerprint(NUTS_SHP, memo)]
+    return hashlib.sha1('|'.join(checksums + [str(grid_length), crs_key(grid_crs)] + settings).encode()).hexdigest()
+
+
+def checkpoint_path(folder, step):
+    return os.path.join(folder, 'step_{:02d}_{}.gpkg'.format(step, CHECKPOINT_STEPS[step]))
+
+
+def resume_step(outputs):
+    # The last valid checkpoint of the run in outputs['Checkpoints'], -1 if there is none. Its layer is put into
+    # outputs under the key of its step.
+    folder = outputs.get('Checkpoints', {}).get('OUTPUT')
+    if not folder:
+        return -1
+    for step in sorted(CHECKPOINT_STEPS, reverse=True):
+        path = checkpoint_path(folder, step)
+        if os.path.exists(path) and QgsVectorLayer(path, 'checkpoint', 'ogr').isValid():
+            outputs[CHECKPOINT_STEPS[step]] = {'OUTPUT': path}
+            return step
+    return -1
+
+
+def checkpoint_output(outputs, step):
+    # OUTPUT of a checkpointed step: a fresh .partial file in the checkpoint folder, or a temporary layer
+    folder = outputs.get('Checkpoints', {}).get('OUTPUT')
+    if not folder:
+        return QgsProcessing.TEMPORARY_OUTPUT
+    partial = partial_path(checkpoint_path(folder, step))
+    if os.path.exists(partial):
+        os.remove(partial)
+    return partial
+
+
+def checkpoint_store(outputs, step, feedback):
+    # Complete the checkpoint of a step whose child algorithm has finished. A cancelled step may have stopped
+    # part way, so it is not kept.
+    folder = outputs.get('Checkpoints', {}).get('OUTPUT')
+    if folder and not feedback.isCanceled():
+        path = checkpoint_path(folder, step)
+        os.replace(partial_path(path), path)
+        outputs[CHECKPOINT_STEPS[step]] = {'OUTPUT': path}
+
+
+##### CACHE #######
+# Static preprocessing does not depend on the ResourceRaster: the fixed substations, the fixed NUTS boundaries,
+# the fixed CF grid and the substation index. These are cached in CACHE_FOLDER as GeoPackage (.npz for the
+# index) under a key made of the input file checksum, EuropeCRS and, for the grid, CPAGridLength. Least
+# recently used entries are evicted once the cache grows past CACHE_MAX_BYTES. Run with 'Clear cache' or
+# call clear_cache() to invalidate it. With UseCache off nothing is read from or written to CACHE_FOLDER: the
+# substation index goes to the processing temp folder, and input checksums and tile hashes are not remembered.
+CACHE_MAX_BYTES = 5 * 1024 ** 3
+# Guards checksums.json against concurrent stages updating it at the same time
+_FINGERPRINT_LOCK = threading.Lock()
+
+
+def cache_folder():
+    return os.path.expanduser(CACHE_FOLDER)
+
+
+def _file_parts(path):
+    # A file and its sidecar files (.dbf, .shx, .prj, ... for a shapefile)
+    stem = os.path.splitext(path)[0]
+    return sorted(p for p in glob.glob(glob.escape(stem) + '.*') if os.path.splitext(p)[0] == stem)
+
+
+def file_checksum(path):
+    # SHA-1 over a file and its sidecar files
+    digest = hashlib.sha1()
+    for part in _file_parts(path):
+        digest.update(os.path.basename(part).encode())
+        with open(part, 'rb') as part_file:
+            for chunk in iter(lambda: part_file.read(1 << 20), b''):
+                digest.update(chunk)
+    return digest.hexdigest()
+
+
+def file_fingerprint(path, memo=True):
+    # file_checksum, remembered against the size and mtime of the files so unchanged inputs are not re-read every
+    # run. Without memo it is just file_checksum and checksums.json is not touched.
+    if not memo:
+        return file_checksum(path)
+    stat = [[os.path.basename(p), os.path.getsize(p), os.stat(p).st_mtime_ns] for p in _file_parts(path)]
+    with _FINGERPRINT_LOCK:
+        entry = _read_checksums().get(path)
+    if entry and entry['stat'] == stat:
+        return entry['sha1']
+    sha1 = file_checksum(path)
+    with _FINGERPRINT_LOCK:
+        memo = _read_checksums()
+        memo[path] = {'stat': stat, 'sha1': sha1}
+        os.makedirs(cache_folder(), exist_ok=True)
+        # A file of its own, so other processes never read or replace a half-written memo
+        handle, partial = tempfile.mkstemp(prefix='checksums.json.', suffix='.partial', dir=cache_folder())
+        with os.fdopen(handle, 'w') as memo_file:
+            json.dump(memo, memo_file)
+        os.replace(partial, os.path.join(cache_folder(), 'checksums.json'))
+    return sha1
+
+
+def _read_checksums():
+    try:
+        with open(os.path.join(cache_folder(), 'checksums.json')) as memo_file:
+            return json.load(memo_file)
+    except (OSError, ValueError):
+        return {}
+
+
+def crs_key(crs):
+    return crs.authid() or crs.toWkt()
+
+
+def cache_path(kind, key_parts, extension='.gpkg'):
+    key = hashlib.sha1('|'.join(str(part) for part in key_parts).encode()).hexdigest()
+    return os.path.join(cache_folder(), '{}_{}{}'.format(kind, key, extension))
+
+
+def partial_path(path):
+    # Where a cache entry is built before cache_store moves it into place
+    stem, extension = os.path.splitext(path)
+    return stem + '.partial' + extension
+
+
+def cache_lookup(path):
+    # The path of a cache entry if it exists (marking it as recently used), None otherwise
+    if path is None or not os.path.exists(path):
+        return None
+    os.utime(path)
+    return path
+
+
+def cache_store(built, path):
+    # Move a freshly built entry into the cache and evict old entries. Returns the cached path.
+    os.replace(built, path)
+    evict_cache()
+    return path
+
+
+def evict_cache(max_bytes=None):
+    # Remove the least recently used entries until the cache fits in max_bytes (CACHE_MAX_BYTES by default)
+    max_bytes = CACHE_MAX_BYTES if max_bytes is None else max_bytes
+    folder = cache_folder()
+    if not os.path.isdir(folder):
+        return
+    # Another run may evict or replace entries at the same time, files that are gone are skipped
+    entries = []
+    for name in os.listdir(folder):
+        path = os.path.join(folder, name)
+        if name == 'checksums.json' or '.partial' in name or not os.path.isfile(path):
+            continue
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            continue
+        entries.append((stat.st_mtime, stat.st_size, path))
+    entries.sort()
+    total = sum(size for _, size, _ in entries)
+    for _, size, entry in entries:
+        if total <= max_bytes:
+            break
+        total -= size
+        try:
+            os.remove(entry)
+        except FileNotFoundError:
+            pass
+
+
+def clear_cache():
+    shutil.rmtree(cache_folder(), ignore_errors=True)
+
+
+##### SUBSTATION INDEX #######
+# Replacement for native:joinbynearest against the substations. The reprojected, fixed substation points and
+# their Sub_ID are cached on disk, keyed by the checksum of the source shapefile and the target CRS, and
+# queried for all CPAs at once through a KD-tree (scipy's cKDTree, or a chunked brute force without SciPy).
+NEAREST_JOIN = 0
+NEAREST_CENTROID = 1
+NEAREST_GEOMETRY = 2
+
+try:
+    from scipy.spatial import cKDTree
+except ImportError:
+    cKDTree = None
+
+
+def substation_index_path(source, crs):
+    return cache_path('substation_index', [file_fingerprint(source), crs_key(crs)], '.npz')
+
+
+class SubstationIndex:
+    # Substation points (n x 2 array in the target CRS) and their Sub_ID
+
+    def __init__(self, coords, sub_ids):
+        self.coords = np.asarray(coords, dtype=float).reshape(-1, 2)
+        self.sub_ids = np.asarray(sub_ids, dtype=str)
+        self.tree = cKDTree(self.coords) if cKDTree is not None else None
+
+    @classmethod
+    def from_layer(cls, layer):
+        coords = []
+        sub_ids = []
+        for feature in layer.getFeatures():
+            geometry = feature.geometry()
+            if geometry.isNull() or geometry.isEmpty():
+                continue
+            # Multipoints count as their first point, as they do for the nearest neighbour join
+            point = geometry.vertexAt(0)
+            coords.append((point.x(), point.y()))
+            sub_ids.append(_as_str(feature['Sub_ID']) or '')
+        return cls(coords, sub_ids)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            return cls(data['coords'], data['sub_ids'])
+
+    def save(self, path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Write then rename, so a concurrent reader never sees half a file
+        np.savez(partial_path(path), coords=self.coords, sub_ids=self.sub_ids)
+        os.replace(partial_path(path), path)
+
+    def nearest(self, points, k=1):
+        # k nearest substations of each point. Returns (distances, indices), both of shape (m, k).
+        points = np.asarray(points, dtype=float).reshape(-1, 2)
+        k = min(k, len(self.coords))
+        if self.tree is not None:
+            distances, indices = self.tree.query(points, k=k)
+            return distances.reshape(-1, k), indices.reshape(-1, k)
+        distances = np.empty((len(points), k))
+        indices = np.empty((len(points), k), dtype=np.int64)
+        for start in range(0, len(points), 4096):
+            chunk = points[start:start + 4096]
+            d = np.hypot(chunk[:, None, 0] - self.coords[None, :, 0], chunk[:, None, 1] - self.coords[None, :, 1])
+            nearest = np.argpartition(d, k - 1, axis=1)[:, :k] if k < len(self.coords) else np.tile(np.arange(k), (len(chunk), 1))
+            nearest_d = np.take_along_axis(d, nearest, axis=1)
+            order = np.argsort(nearest_d, axis=1, kind='stable')
+            indices[start:start + len(chunk)] = np.take_along_axis(nearest, order, axis=1)
+            distances[start:start + len(chunk)] = np.take_along_axis(nearest_d, order, axis=1)
+        return distances, indices
+
+    def within(self, points, radii):
+        # Indices of the substations within radii[i] of points[i], for each point
+        points = np.asarray(points, dtype=float).reshape(-1, 2)
+        if self.tree is not None:
+            return self.tree.query_ball_point(points, np.asarray(radii, dtype=float))
+        result = []
+        for point, radius in zip(points, radii):
+            result.append(np.flatnonzero(np.hypot(self.coords[:, 0] - point[0], self.coords[:, 1] - point[1]) <= radius))
+        return result
+
+    def nearest_to_geometries(self, geometries, k=1):
+        # Exact geometry-to-point distance like the nearest neighbour join. Candidates are the substations within
+        # (distance from the centroid to its k-th nearest substation + 2 * bounding radius of the geometry) of the
+        # centroid. The centroid is within one radius of the geometry even when it lies outside it (multipart or
+        # concave CPAs), so these k substations are within distance + radius of the geometry, and every substation
+        # at least as near to the geometry within distance + 2 * radius of the centroid. Returns (distances,
+        # indices) of shape (m, k).
+        centroids = np.empty((len(geometries), 2))
+        radii = np.empty(len(geometries))
+        for i, geometry in enumerate(geometries):
+            centroid = geometry.centroid().asPoint()
+            box = geometry.boundingBox()
+            centroids[i] = centroid.x(), centroid.y()
+            radii[i] = max(math.hypot(x - centroid.x(), y - centroid.y())
+                           for x in (box.xMinimum(), box.xMaximum()) for y in (box.yMinimum(), box.yMaximum()))
+        k = min(k, len(self.coords))
+        centroid_distances, _indices = self.nearest(centroids, k)
+        candidates = self.within(centroids, centroid_distances[:, -1] + 2 * radii)
+        distances = np.empty((len(geometries), k))
+        indices = np.empty((len(geometries), k), dtype=np.int64)
+        for i, (geometry, candidate) in enumerate(zip(geometries, candidates)):
+            candidate = np.sort(np.asarray(candidate, dtype=np.int64))
+            d = np.array([geometry.distance(QgsGeometry.fromPointXY(QgsPointXY(*self.coords[j]))) for j in candidate])
+            order = np.argsort(d, kind='stable')[:k]
+            distances[i] = d[order]
+            indices[i] = candidate[order]
+        return distances, indices
+
+
+def nearest_substations(source, index, exact, context, feedback):
+    # Add Sub_ID, n and distance of the nearest substation to every CPA (the fields native:joinbynearest adds
+    # and the model keeps). exact measures from the CPA geometry like the join, otherwise from its centroid.
+    # Returns the id of a temporary layer.
+    layer = QgsProcessingUtils.mapLayerFromString(source, context)
+    geometries = [feature.geometry() for feature in layer.getFeatures(QgsFeatureRequest().setNoAttributes())]
+    if feedback.isCanceled():
+        return None
+    if exact:
+        distances, indices = index.nearest_to_geometries(geometries)
+    else:
+        centroids = []
+        for geometry in geometries:
+            centroid = geometry.centroid().asPoint()
+            centroids.append((centroid.x(), centroid.y()))
+        distances, indices = index.nearest(centroids)
+    del geometries
+
+    fields = QgsFields(layer.fields())
+    fields.append(QgsField('Sub_ID', QVariant.String))
+    fields.append(QgsField('n', QVariant.Int))
+    fields.append(QgsField('distance', QVariant.Double))
+    sink, dest_id = QgsProcessingUtils.createFeatureSink('memory:', context, fields, layer.wkbType(), layer.crs())
+    for row, feature in enumerate(layer.getFeatures()):
+        if feedback.isCanceled():
+            return None
+        out = QgsFeature(fields)
+        out.setGeometry(feature.geometry())
+        out.setAttributes(feature.attributes() + [str(index.sub_ids[indices[row, 0]]), 1, float(distances[row, 0])])
+        sink.addFeature(out, QgsFeatureSink.FastInsert)
+    del sink
+    return dest_id
+
+
+##### REGION ASSIGNMENT #######
+# Replacement for the two native:intersection overlays that attach NUTS_ID and CNTR_CODE. The fixed NUTS-2
+# polygons (which carry both codes) are reprojected once into a spatial index with prepared geometries, and
+# every CPA is assigned in one pass. REGION_CLIP cuts CPAs at region borders like the overlays (a CPA inside
+# a single region is passed through uncut), REGION_CENTROID and REGION_OVERLAP keep each CPA whole and give
+# it the region containing its centroid or the region it overlaps most. CPAs outside every region are dropped.
+REGION_OVERLAYS = 0
+REGION_CLIP = 1
+REGION_CENTROID = 2
+REGION_OVERLAP = 3
+
+REGION_FIELDS = ['NUTS_ID', 'CNTR_CODE']
+
+
+class RegionIndex:
+    # NUTS polygons in the CPA CRS, with their NUTS_ID and CNTR_CODE
+
+    def __init__(self, layer, crs, transform_context):
+        self.index = QgsSpatialIndex()
+        self.geometries = {}
+        self.engines = {}
+        self.codes = {}
+        self.fields = QgsFields()
+        for name in REGION_FIELDS:
+            self.fields.append(layer.fields().field(name))
+        transform = QgsCoordinateTransform(layer.crs(), crs, transform_context)
+        for feature in layer.getFeatures():
+            geometry = feature.geometry()
+            if geometry.isNull() or geometry.isEmpty():
+                continue
+            geometry.transform(transform)
+            engine = QgsGeometry.createGeometryEngine(geometry.constGet())
+            engine.prepareGeometry()
+            self.geometries[feature.id()] = geometry
+            self.engines[feature.id()] = engine
+            self.codes[feature.id()] = [feature[name] for name in REGION_FIELDS]
+            self.index.addFeature(feature.id(), geometry.boundingBox())
+
+    def candidates(self, geometry):
+        # Regions intersecting geometry, in feature order so the output does not depend on the index
+        return [fid for fid in sorted(self.index.intersects(geometry.boundingBox()))
+                if self.engines[fid].intersects(geometry.constGet())]
+
+    def clip(self, geometry):
+        # (codes, piece) for every region geometry intersects, the piece being geometry cut at the region border
+        pieces = []
+        for fid in self.candidates(geometry):
+            if self.engines[fid].contains(geometry.constGet()):
+                return [(self.codes[fid], geometry)]
+            piece = geometry.intersection(self.geometries[fid])
+            if piece.wkbType() == QgsWkbTypes.GeometryCollection:
+                piece = piece.convertGeometryCollectionToSubclass(QgsWkbTypes.PolygonGeometry)
+            if piece.isNull() or piece.isEmpty() or piece.type() != QgsWkbTypes.PolygonGeometry:
+                continue
+            pieces.append((self.codes[fid], piece))
+        return pieces
+
+    def assign(self, geometry, by_centroid):
+        # Codes of the region containing the centroid (falling back to the largest overlap when the centroid is
+        # outside every region) or of the region with the largest overlap. None if geometry is outside them all.
+        candidates = self.candidates(geometry)
+        if not candidates:
+            return None
+        if len(candidates) == 1:
+            return self.codes[candidates[0]]
+        if by_centroid:
+            centroid = geometry.centroid()
+            for fid in candidates:
+                if self.engines[fid].contains(centroid.constGet()):
+                    return self.codes[fid]
+        areas = [geometry.intersection(self.geometries[fid]).area() for fid in candidates]
+        return self.codes[candidates[areas.index(max(areas))]]
+
+
+def assign_regions(source, index, mode, context, feedback, destination='memory:'):
+    # Add NUTS_ID and CNTR_CODE to every CPA in one pass over index (a RegionIndex). mode is REGION_CLIP,
+    # REGION_CENTROID or REGION_OVERLAP. Returns the id of the output layer, written to destination.
+    layer = QgsProcessingUtils.mapLayerFromString(source, context)
+    fields = QgsFields(layer.fields())
+    for field in index.fields:
+        fields.append(field)
+    wkb_type = QgsWkbTypes.multiType(layer.wkbType())
+    sink, dest_id = QgsProcessingUtils.createFeatureSink(destination, context, fields, wkb_type, layer.crs())
+    for feature in layer.getFeatures():
+        if feedback.isCanceled():
+            return None
+        geometry = feature.geometry()
+        if geometry.isNull() or geometry.isEmpty():
+            continue
+        if mode == REGION_CLIP:
+            pieces = index.clip(geometry)
+        else:
+            codes = index.assign(geometry, mode == REGION_CENTROID)
+            pieces = [(codes, geometry)] if codes is not None else []
+        for codes, piece in pieces:
+            out = QgsFeature(fields)
+            piece = QgsGeometry(piece)
+            piece.convertToMultiType()
+            out.setGeometry(piece)
+            out.setAttributes(feature.attributes() + codes)
+            sink.addFeature(out, QgsFeatureSink.FastInsert)
+    del sink
+    return dest_id
+
+
+##### GEOMETRY REPAIR #######
+# The "Fix ..." steps run native:fixgeometries, which rebuilds every feature. With GeometryRepair set to
+# REPAIR_INVALID they check each geometry with GEOS and rebuild only the invalid ones (in the same way as
+# native:fixgeometries), and steps whose input is valid by construction are skipped: the substation points and
+# the grid lines of "CF Grid". The streamed fixes (see STREAMING) follow the same setting. Each step logs how many
+# features it repaired, and the profile records it.
+REPAIR_ALL = 0
+REPAIR_INVALID = 1
+
+
+def repaired_geometry(geometry, geometry_type):
+    # native:fixgeometries for one geometry
+    fixed = geometry.makeValid()
+    if QgsWkbTypes.flatType(fixed.wkbType()) in (QgsWkbTypes.Unknown, QgsWkbTypes.GeometryCollection):
+        fixed = fixed.convertGeometryCollectionToSubclass(geometry_type)
+    if not fixed.isNull():
+        fixed.convertToMultiType()
+    return fixed
+
+
+def _fixed_features(features, geometry_type, counts=None):
+    # Repair the geometry of every feature, or with counts (a dict) only of the invalid ones, counting
+    # counts['checked'] and counts['repaired']
+    for feature in features:
+        geometry = feature.geometry()
+        if not geometry.isNull():
+            if counts is None or not geometry.isGeosValid():
+                geometry = repaired_geometry(geometry, geometry_type)
+                if counts is not None:
+                    counts['repaired'] += 1
+            else:
+                geometry.convertToMultiType()
+            if counts is not None:
+                counts['checked'] += 1
+            feature.setGeometry(geometry)
+        yield feature
+
+
+def repair_counts(mode):
+    # repair_counts argument of stream_features() for a GeometryRepair mode
+    return {'checked': 0, 'repaired': 0} if mode == REPAIR_INVALID else None
+
+
+def report_repairs(feedback, counts):
+    if counts is not None:
+        feedback.pushInfo('Repaired {repaired} of {checked} geometries'.format(**counts))
+        count_step(feedback, 'repaired', counts['repaired'])
+
+
+##### STREAMING #######
+# With Streaming on, the per-feature stages run as one pass of chained generators each instead of one child
+# algorithm (and one full temporary layer) per step:
+#     Add x field + Fix polys, Fix Resource Polys, Fix CF Polys + SqKm + cutoff, CPA attributes + Drop field(s)
+# and every temporary layer is removed from the context as soon as the stage consuming it has finished, so the
+# peak holds about two copies of the CPA layer rather than all of them. Geometry is repaired like
+# native:fixgeometries and SqKm is measured like $area in the field calculator. The peak RSS is in the profile.
+
+def release_layers(context, *sources):
+    # Free temporary layers owned by the context. Anything else (cache entries, files on disk) is left alone.
+    store = context.temporaryLayerStore()
+    for source in sources:
+        if source and store.mapLayer(source) is not None:
+            store.removeMapLayer(source)
+
+
+def _with_fields(features, fields, add_fields):
+    for feature in features:
+        out = QgsFeature(fields)
+        out.setGeometry(feature.geometry())
+        out.setAttributes(feature.attributes() + [function(feature) for _field, function in add_fields])
+        yield out
+
+
+def measure_sqkm(crs, context):
+    # $area/1000000 as the field calculator evaluates it in this context, as a function of a geometry
+    measure = QgsDistanceArea()
+    measure.setSourceCrs(crs, context.transformContext())
+    measure.setEllipsoid(context.ellipsoid())
+    return lambda geometry: measure.convertAreaMeasurement(measure.measureArea(geometry), context.areaUnit()) / 1000000
+
+
+def area_sqkm(crs, context):
+    # measure_sqkm() as a function of the feature
+    sqkm = measure_sqkm(crs, context)
+    return lambda feature: sqkm(feature.geometry())
+
+
+def stream_features(source, context, feedback, fix=False, add_fields=(), keep=None, repair_counts=None, destination='memory:'):
+    # One pass over source: repair geometries (fix; only the invalid ones when repair_counts is given, see
+    # _fixed_features), append fields (add_fields, pairs of QgsField and a function of the feature) and keep only
+    # the features for which keep(feature) is true. Returns the id of the output, a temporary layer unless
+    # destination is a file, None if the run was cancelled.
+    layer = QgsProcessingUtils.mapLayerFromString(source, context)
+    fields = QgsFields(layer.fields())
+    for field, _function in add_fields:
+        fields.append(field)
+    wkb_type = QgsWkbTypes.multiType(layer.wkbType()) if fix else layer.wkbType()
+    features = layer.getFeatures()
+    if fix:
+        features = _fixed_features(features, layer.geometryType(), repair_counts)
+    if add_fields:
+        features = _with_fields(features, fields, add_fields)
+    if keep is not None:
+        features = filter(keep, features)
+
+    sink, dest_id = QgsProcessingUtils.createFeatureSink(destination, context, fields, wkb_type, layer.crs())
+    total = 100.0 / layer.featureCount() if layer.featureCount() else 0
+    for n, feature in enumerate(features):
+        if feedback.isCanceled():
+            return None
+        sink.addFeature(feature, QgsFeatureSink.FastInsert)
+        feedback.setProgress(n * total)
+    del sink
+    return dest_id
+
+
+##### RASTER GRID ENGINE #######
+# Alternative to reclassify -> polygonize -> dissolve -> split -> zonal statistics. The CPA grid is snapped
+# to the raster and the resource mask is block-reduced per cell, so area and mean CF come from array sums.
+# A pixel belongs to the cell containing its centre, which is the rule zonal statistics uses for CF_mean.
+#
+# Tolerance against the vector engine (the reference):
+#   - CF_mean is identical for cells whose resource is one connected piece.
+#   - SqKm is pixel count * pixel area. It matches $area exactly when CPAGridLength is a multiple of the pixel
+#     size in an equal-area CRS such as EPSG:3035, otherwise by at most the pixels straddling the cell edges
+#     (4 * CPAGridLength * pixel size per cell).
+#   - One CPA per cell. The reference emits one CPA per connected piece of resource inside a cell, so cells
+#     holding several disconnected patches become a single multipolygon CPA here, and the cutoff applies to
+#     their combined area.
+ENGINE_VECTOR = 0
+ENGINE_RASTER = 1
+
+
+def _grid_index(pixel_origin, pixel_size, count, grid_origin, grid_length):
+    # Grid cell index of every pixel centre along one axis (non-decreasing)
+    centres = pixel_origin + (np.arange(count) + 0.5) * pixel_size
+    return np.floor((centres - grid_origin) / grid_length).astype(np.int64)
+
+
+def _runs(index):
+    # Start offsets of the runs of equal values in a non-decreasing index array
+    return np.flatnonzero(np.r_[True, np.diff(index) != 0])
+
+
+def raster_grid_cpas(raster_path, crs, grid_origin, grid_length, context, feedback, band_number=1):
+    # Build CPA polygons with DN, x, CF_mean and SqKm straight from the resource raster, already filtered
+    # by the area cutoff. Returns the id of a temporary layer.
+    ds = gdal.Open(raster_path)
+    band = ds.GetRasterBand(band_number)
+    nodata = band.GetNoDataValue()
+    x0, px, _rx, y0, _ry, py = ds.GetGeoTransform()
+    py = -py
+    width, height = ds.RasterXSize, ds.RasterYSize
+    pixel_sqkm = px * py / 1000000
+
+    grid_x0, grid_y0 = grid_origin
+    col_index = _grid_index(x0, px, width, grid_x0, grid_length)
+    # Rows count downwards from the grid's top edge
+    row_index = _grid_index(-y0, py, height, -grid_y0, grid_length)
+    col_starts = _runs(col_index)
+    col_widths = np.diff(np.r_[col_starts, width])
+    row_starts = _runs(row_index)
+    row_ends = np.r_[row_starts[1:], height]
+
+    fields = QgsFields()
+    fields.append(QgsField('DN', QVariant.Int))
+    fields.append(QgsField('x', QVariant.Int, len=1))
+    fields.append(QgsField('CF_mean', QVariant.Double))
+    fields.append(QgsField('SqKm', QVariant.Double, len=10, prec=7))
+    sink, dest_id = QgsProcessingUtils.createFeatureSink('memory:', context, fields, QgsWkbTypes.MultiPolygon, crs)
+
+    for strip, (r0, r1) in enumerate(zip(row_starts, row_ends)):
+        if feedback.isCanceled():
+            return None
+        values = band.ReadAsArray(0, int(r0), width, int(r1 - r0)).astype(np.float64)
+        valid = _valid_pixels(values, nodata)
+        counts = np.add.reduceat(valid.sum(axis=0), col_starts)
+        sums = np.add.reduceat(np.where(valid, values, 0).sum(axis=0), col_starts)
+        sqkm = counts * pixel_sqkm
+        keep = np.flatnonzero(sqkm > MIN_CPA_SQKM)
+        if len(keep) == 0:
+            feedback.setProgress(100.0 * (strip + 1) / len(row_starts))
+            continue
+
+        # Full cells are emitted as their pixel footprint rectangle, partial cells are polygonized
+        # with the cell ordinal as label so every piece carries the cell it belongs to.
+        top = y0 - r0 * py
+        bottom = y0 - r1 * py
+        full = counts == col_widths * (r1 - r0)
+        geometries = {}
+        labels = np.zeros(len(col_starts), dtype=np.int32)
+        partial = keep[~full[keep]]
+        labels[partial] = partial + 1
+        for k in keep[full[keep]]:
+            left = x0 + col_starts[k] * px
+            geometries[k] = QgsGeometry.fromRect(QgsRectangle(left, bottom, left + col_widths[k] * px, top))
+        if len(partial):
+            geometries.update(_polygonize_cells(np.where(valid, np.repeat(labels, col_widths), 0).astype(np.int32),
+                                                (x0, px, 0, top, 0, -py)))
+
+        for k in keep:
+            geometry = geometries[k]
+            geometry.convertToMultiType()
+            feature = QgsFeature(fields)
+            feature.setGeometry(geometry)
+            feature.setAttributes([1, 1, float(sums[k] / counts[k]), float(sqkm[k])])
+            sink.addFeature(feature, QgsFeatureSink.FastInsert)
+        feedback.setProgress(100.0 * (strip + 1) / len(row_starts))
+
+    del sink
+    return dest_id
+
+
+def _polygonize_cells(labels, geotransform):
+    # Polygonize a label strip (0 = no resource) and collect the pieces of each label into one geometry.
+    # Returns {label - 1: QgsGeometry}.
+    mem = gdal.GetDriverByName('MEM').Create('', labels.shape[1], labels.shape[0], 1, gdal.GDT_Int32)
+    mem.SetGeoTransform(geotransform)
+    label_band = mem.GetRasterBand(1)
+    label_band.WriteArray(labels)
+    vector = ogr.GetDriverByName('Memory').CreateDataSource('')
+    layer = vector.CreateLayer('cells', geom_type=ogr.wkbPolygon)
+    layer.CreateField(ogr.FieldDefn('label', ogr.OFTInteger))
+    gdal.Polygonize(label_band, label_band, layer, 0, [], callback=None)
+
+    pieces = {}
+    for piece in layer:
+        pieces.setdefault(piece.GetField(0) - 1, []).append(QgsGeometry.fromWkt(piece.GetGeometryRef().ExportToWkt()))
+    return {k: QgsGeometry.collectGeometry(parts) for k, parts in pieces.items()}
+
+##### WINDOWED RASTER #######
+# With WindowedRaster on, step 3 and step 12 read the resource raster in windows of whole native blocks
+# (memory-mapped where GDAL can map the file) instead of going through native:reclassifybytable and
+# native:zonalstatisticsfb:
+#   - "Reclassify by table" is computed per window and written as a tiled, compressed GeoTIFF, the only raster
+#     intermediate, since polygonize needs it on disk.
+#   - "Resource with CF" rasterizes the CPAs per window and adds the CF sums and pixel counts of every CPA with
+#     one bincount, so each block of the raster is read once rather than once per CPA that covers it.
+# Both follow the reference rules: the reclass table (min < value <= max), and zonal statistics' pixel-centre
+# rule, with the overlap-weighted mean for CPAs holding at most one pixel centre.
+WINDOW_PIXELS = 1 << 22
+MASK_NODATA = -9999
+GTIFF_OPTIONS = ['TILED=YES', 'COMPRESS=DEFLATE', 'PREDICTOR=2', 'BIGTIFF=IF_SAFER']
+
+
+def raster_windows(band, window_pixels=WINDOW_PIXELS):
+    # (x, y, width, height) windows of about window_pixels, made of whole native blocks of band
+    width, height = band.XSize, band.YSize
+    block_x, block_y = band.GetBlockSize()
+    block_x, block_y = min(block_x, width), min(block_y, height)
+    step_x = min(block_x * max(1, int(math.sqrt(window_pixels)) // block_x), width)
+    step_y = min(block_y * max(1, window_pixels // (step_x * block_y)), height)
+    for y in range(0, height, step_y):
+        for x in range(0, width, step_x):
+            yield x, y, min(step_x, width - x), min(step_y, height - y)
+
+
+def _mapped(band):
+    # The whole band as a memory-mapped array where GDAL supports it (uncompressed local files), else None
+    try:
+        return band.GetVirtualMemAutoArray(gdal.GF_Read)
+    except (AttributeError, RuntimeError, TypeError):
+        return None
+
+
+def _read_window(band, mapped, x, y, width, height):
+    if mapped is not None:
+        return np.asarray(mapped[y:y + height, x:x + width], dtype=np.float64)
+    return band.ReadAsArray(x, y, width, height).astype(np.float64)
+
+
+def _valid_pixels(values, nodata):
+    valid = np.isfinite(values)
+    if nodata is not None:
+        valid &= values != nodata
+    return valid
+
+
+def resource_mask(raster_path, destination, feedback, band_number=1, table=(0, 100, 1)):
+    # Step 3 as native:reclassifybytable runs it there (min < value <= max becomes the table value, other values
+    # are kept, Int16 with nodata -9999), written to destination as a tiled, compressed GeoTIFF.
+    # Returns destination, None if the run was cancelled.
+    ds = gdal.Open(raster_path)
+    band = ds.GetRasterBand(band_number)
+    nodata = band.GetNoDataValue()
+    mapped = _mapped(band)
+    out = gdal.GetDriverByName('GTiff').Create(destination, ds.RasterXSize, ds.RasterYSize, 1, gdal.GDT_Int16, GTIFF_OPTIONS)
+    out.SetGeoTransform(ds.GetGeoTransform())
+    out.SetProjection(ds.GetProjection())
+    out_band = out.GetRasterBand(1)
+    out_band.SetNoDataValue(MASK_NODATA)
+
+    low, high, value = table
+    windows = list(raster_windows(band))
+    for n, (x, y, width, height) in enumerate(windows):
+        if feedback.isCanceled():
+            return None
+        values = _read_window(band, mapped, x, y, width, height)
+        valid = _valid_pixels(values, nodata)
+        mask = np.where(valid & (values > low) & (values <= high), value, np.where(valid, values, MASK_NODATA))
+        out_band.WriteArray(np.clip(mask, -32768, 32767).astype(np.int16), x, y)
+        feedback.setProgress(100.0 * (n + 1) / len(windows))
+    out_band.FlushCache()
+    out = None
+    return destination
+
+
+def _intersection_mean(geometry, band, geotransform, nodata):
+    # Mean of the pixels under geometry weighted by their overlap with it, None without valid pixels
+    x0, px, _rx, y0, _ry, py = geotransform
+    box = geometry.boundingBox()
+    c0 = max(int(math.floor((box.xMinimum() - x0) / px)), 0)
+    c1 = min(int(math.ceil((box.xMaximum() - x0) / px)), band.XSize)
+    r0 = max(int(math.floor((box.yMaximum() - y0) / py)), 0)
+    r1 = min(int(math.ceil((box.yMinimum() - y0) / py)), band.YSize)
+    if c1 <= c0 or r1 <= r0:
+        return None
+    values = band.ReadAsArray(c0, r0, c1 - c0, r1 - r0).astype(np.float64)
+    engine = QgsGeometry.createGeometryEngine(geometry.constGet())
+    engine.prepareGeometry()
+    total = weights = 0.0
+    for r, c in zip(*np.nonzero(_valid_pixels(values, nodata))):
+        left = x0 + (c0 + c) * px
+        top = y0 + (r0 + r) * py
+        pixel = QgsGeometry.fromRect(QgsRectangle(left, top + py, left + px, top))
+        if not engine.intersects(pixel.constGet()):
+            continue
+        weight = geometry.intersection(pixel).area()
+        total += weight * values[r, c]
+        weights += weight
+    return total / weights if weights > 0 else None
+
+
+def _label_layer(geometries):
+    # In-memory OGR layer of geometries labelled n + 1 for the n-th one. Returns the data source with it,
+    # which has to be kept alive as long as the layer is used.
+    source = ogr.GetDriverByName('Memory').CreateDataSource('')
+    layer = source.CreateLayer('cpas', geom_type=ogr.wkbMultiPolygon)
+    layer.CreateField(ogr.FieldDefn('label', ogr.OFTInteger))
+    for n, geometry in enumerate(geometries):
+        label = ogr.Feature(layer.GetLayerDefn())
+        label.SetField(0, n + 1)
+        if not geometry.isNull():
+            label.SetGeometry(ogr.CreateGeometryFromWkb(bytes(geometry.asWkb())))
+        layer.CreateFeature(label)
+    return source, layer
+
+
+def _window_labels(label_layer, geotransform, width, height):
+    # Label of the geometry holding each pixel centre of a window (0 for none), None if no geometry reaches it
+    left, px, _rx, top, _ry, py = geotransform
+    label_layer.SetSpatialFilterRect(left, top + height * py, left + width * px, top)
+    if not label_layer.GetFeatureCount():
+        return None
+    mem = gdal.GetDriverByName('MEM').Create('', width, height, 1, gdal.GDT_Int32)
+    mem.SetGeoTransform(geotransform)
+    gdal.RasterizeLayer(mem, [1], label_layer, options=['ATTRIBUTE=label'])
+    return mem.GetRasterBand(1).ReadAsArray()
+
+
+def zonal_means(source, raster_path, context, feedback, destination='memory:', band_number=1, column='CF_mean'):
+    # Step 12 in one sweep over the raster: source with the mean of its pixels appended as column.
+    # Returns the id of the output, a temporary layer unless destination is a file, None if the run was cancelled.
+    layer = QgsProcessingUtils.mapLayerFromString(source, context)
+    ds = gdal.Open(raster_path)
+    band = ds.GetRasterBand(band_number)
+    nodata = band.GetNoDataValue()
+    geotransform = ds.GetGeoTransform()
+    raster_crs = QgsCoordinateReferenceSystem.fromWkt(ds.GetProjection())
+    transform = QgsCoordinateTransform(layer.crs(), raster_crs, context.transformContext()) if raster_crs.isValid() and raster_crs != layer.crs() else None
+
+    geometries = []
+    for feature in layer.getFeatures():
+        geometry = QgsGeometry(feature.geometry())
+        if transform is not None:
+            geometry.transform(transform)
+        geometries.append(geometry)
+    _labels, label_layer = _label_layer(geometries)
+
+    sums = np.zeros(len(geometries) + 1)
+    counts = np.zeros(len(geometries) + 1, dtype=np.int64)
+    mapped = _mapped(band)
+    x0, px, _rx, y0, _ry, py = geotransform
+    windows = list(raster_windows(band))
+    for n, (x, y, width, height) in enumerate(windows):
+        if feedback.isCanceled():
+            return None
+        cells = _window_labels(label_layer, (x0 + x * px, px, 0, y0 + y * py, 0, py), width, height)
+        if cells is not None:
+            values = _read_window(band, mapped, x, y, width, height)
+            inside = (cells > 0) & _valid_pixels(values, nodata)
+            sums += np.bincount(cells[inside], weights=values[inside], minlength=len(sums))
+            counts += np.bincount(cells[inside], minlength=len(counts))
+        feedback.setProgress(100.0 * (n + 1) / len(windows))
+    label_layer.SetSpatialFilter(None)
+
+    fields = QgsFields(layer.fields())
+    fields.append(QgsField(column, QVariant.Double))
+    sink, dest_id = QgsProcessingUtils.createFeatureSink(destination, context, fields, layer.wkbType(), layer.crs())
+    for n, feature in enumerate(layer.getFeatures()):
+        if counts[n + 1] > 1:
+            mean = float(sums[n + 1] / counts[n + 1])
+        else:
+            mean = _intersection_mean(geometries[n], band, geotransform, nodata) if not geometries[n].isNull() else None
+        out = QgsFeature(fields)
+        out.setGeometry(feature.geometry())
+        out.setAttributes(feature.attributes() + [NULL if mean is None else mean])
+        sink.addFeature(out, QgsFeatureSink.FastInsert)
+    del sink
+    return dest_id
+
+
+##### GRID SPLIT #######
+# With GridPruning on, "CF Grid" and "Fix Grid" are not built over the whole boundary extent, and "Grided
+# Resource" cuts the resource polygons with grid_split() instead of native:splitwithlines. Only the cells under
+# each resource part's bounding box are considered. Their range follows from the grid origin and CPAGridLength,
+# so finding the cells near a part is an exact spatial index lookup rather than a search through every grid line.
+# Large parts are first halved along grid lines, so each intersection works on a bounded piece. A part inside
+# one cell passes through unchanged, and a cell lying wholly inside a part is emitted as its rectangle. The
+# output has one feature per connected piece, like native:splitwithlines.
+SPLIT_CELLS = 16
+# Tolerance, in cells, for part edges lying on a grid line
+SPLIT_EPSILON = 1e-9
+
+
+def _polygon_parts(geometry):
+    # The polygons of an intersection result, dropping any points and lines
+    if geometry.isNull() or geometry.isEmpty():
+        return []
+    if QgsWkbTypes.flatType(geometry.wkbType()) == QgsWkbTypes.GeometryCollection:
+        geometry = geometry.convertGeometryCollectionToSubclass(QgsWkbTypes.PolygonGeometry)
+    if geometry.isNull() or geometry.type() != QgsWkbTypes.PolygonGeometry:
+        return []
+    return geometry.asGeometryCollection()
+
+
+def _cell_rectangle(origin, grid_length, row0, row1, col0, col1):
+    return QgsGeometry.fromRect(QgsRectangle(origin[0] + col0 * grid_length, origin[1] - row1 * grid_length,
+                                             origin[0] + col1 * grid_length, origin[1] - row0 * grid_length))
+
+
+def _split_part(part, origin, grid_length, full=None):
+    # Pieces of one polygon cut at the grid lines, as (row, col, geometry). With full (a list), the cells lying
+    # wholly inside the polygon are appended to it as (row, col) instead of being yielded as rectangles.
+    box = part.boundingBox()
+    col0 = int(math.floor((box.xMinimum() - origin[0]) / grid_length + SPLIT_EPSILON))
+    col1 = max(int(math.ceil((box.xMaximum() - origin[0]) / grid_length - SPLIT_EPSILON)), col0 + 1)
+    row0 = int(math.floor((origin[1] - box.yMaximum()) / grid_length + SPLIT_EPSILON))
+    row1 = max(int(math.ceil((origin[1] - box.yMinimum()) / grid_length - SPLIT_EPSILON)), row0 + 1)
+    if col1 - col0 == 1 and row1 - row0 == 1:
+        yield row0, col0, part
+        return
+
+    engine = QgsGeometry.createGeometryEngine(part.constGet())
+    engine.prepareGeometry()
+    if (col1 - col0) * (row1 - row0) > SPLIT_CELLS:
+        if col1 - col0 >= row1 - row0:
+            middle = (col0 + col1) // 2
+            halves = [(row0, row1, col0, middle), (row0, row1, middle, col1)]
+        else:
+            middle = (row0 + row1) // 2
+            halves = [(row0, middle, col0, col1), (middle, row1, col0, col1)]
+        contained = []
+        for half in halves:
+            rectangle = _cell_rectangle(origin, grid_length, *half)
+            if not engine.intersects(rectangle.constGet()):
+                continue
+            if engine.contains(rectangle.constGet()):
+                contained.extend((row, col) for row in range(half[0], half[1]) for col in range(half[2], half[3]))
+                continue
+            for piece in _polygon_parts(part.intersection(rectangle)):
+                yield from _split_part(piece, origin, grid_length, full)
+        if full is not None:
+            full.extend(contained)
+            return
+        for row, col in contained:
+            yield row, col, _cell_rectangle(origin, grid_length, row, row + 1, col, col + 1)
+        return
+
+    for row in range(row0, row1):
+        for col in range(col0, col1):
+            rectangle = _cell_rectangle(origin, grid_length, row, row + 1, col, col + 1)
+            if not engine.intersects(rectangle.constGet()):
+                continue
+            if engine.contains(rectangle.constGet()):
+                if full is not None:
+                    full.append((row, col))
+                else:
+                    yield row, col, rectangle
+                continue
+            for piece in _polygon_parts(part.intersection(rectangle)):
+                yield row, col, piece
+
+
+def grid_split(source, origin, grid_length, context, feedback, destination='memory:'):
+    # Cut the polygons of source at the CPA grid lines through origin (top left corner) every grid_length.
+    # Returns the id of the output, a temporary layer unless destination is a file, None if the run was cancelled.
+    layer = QgsProcessingUtils.mapLayerFromString(source, context)
+    fields = layer.fields()
+    sink, dest_id = QgsProcessingUtils.createFeatureSink(destination, context, fields, QgsWkbTypes.multiType(layer.wkbType()), layer.crs())
+    total = 100.0 / layer.featureCount() if layer.featureCount() else 0
+    for n, feature in enumerate(layer.getFeatures()):
+        for part in _polygon_parts(feature.geometry()):
+            if feedback.isCanceled():
+                return None
+            for _row, _col, piece in _split_part(part, origin, grid_length):
+                piece.convertToMultiType()
+                out = QgsFeature(fields)
+                out.setGeometry(piece)
+                out.setAttributes(feature.attributes())
+                sink.addFeature(out, QgsFeatureSink.FastInsert)
+        feedback.setProgress(n * total)
+    del sink
+    return dest_id
+
+
+##### COMPACT CELLS #######
+# With CompactCells on (vector engine), steps 11-15 keep the CPAs in a GridCpas rather than one layer per step.
+# A grid cell lying wholly inside the resource is stored only as its (row, col) index, and only the pieces of
+# partial edge cells carry geometry. Nothing is written until the CPAs below the cutoff have been removed,
+# and the cell polygons are built only then, one feature at a time, for the layer the substation and region
+# steps read:
+#   - Grided Resource: grid_cells() cuts like grid_split() (so GridPruning is implied) without the rectangles.
+#   - Resource with CF: cell_means() makes one windowed sweep over the raster (see WINDOWED RASTER). Full cells
+#     find their pixels by index arithmetic from the grid origin, and pieces are rasterized.
+#   - Fix CF Polys: repairs only the pieces, since full cells are valid by construction.
+#   - SqKm is $area, as for the pieces. All full cells have the same area when the context measures planar
+#     areas or the CRS is equal-area (EPSG:3035, ...), so one cell is measured for all of them. The ellipsoidal
+#     $area then differs only by geodesic vs projected cell edges. In a cylindrical CRS (Mercator, ...) the area
+#     only changes from row to row, so one cell is measured per grid row. In any other CRS (UTM, conic, ...)
+#     every full cell is measured.
+# The CPAs come out in grid order (row, then column). Compact runs do not write the step 11 and 12 checkpoints.
+# Packs a (row, col) pair into one int64 key
+CELL_KEY = 1 << 32
+# PROJ names of the equal-area projections, and of the cylindrical ones whose cell areas only change with y
+EQUAL_AREA_PROJECTIONS = {'laea', 'aea', 'cea', 'moll', 'sinu', 'eck4', 'eck6', 'hammer'}
+CYLINDRICAL_PROJECTIONS = {'merc', 'eqc', 'mill', 'gall'}
+# How full cells are measured, see full_cell_sqkm()
+AREA_UNIFORM = 0
+AREA_PER_ROW = 1
+AREA_PER_CELL = 2
+
+
+class GridCpas:
+    # CPAs on the grid of origin (top left corner) and grid_length: full cells in self.full and pieces in
+    # self.pieces, both int64 arrays of (row, col, source feature). self.geometries holds the pieces' geometry and
+    # self.values[name] the (full cells, pieces) float arrays of every added field.
+
+    def __init__(self, origin, grid_length, crs, fields, attributes, full, pieces, geometries):
+        self.origin = origin
+        self.grid_length = grid_length
+        self.crs = crs
+        self.fields = fields
+        self.attributes = attributes
+        self.full = np.array(full, dtype=np.int64).reshape(-1, 3)
+        self.pieces = np.array(pieces, dtype=np.int64).reshape(-1, 3)
+        self.geometries = geometries
+        self.value_fields = []
+        self.values = {}
+
+    def __len__(self):
+        return len(self.full) + len(self.pieces)
+
+    def cell(self, row, col):
+        return _cell_rectangle(self.origin, self.grid_length, row, row + 1, col, col + 1)
+
+    def add_values(self, field, full, pieces):
+        self.value_fields.append(field)
+        self.values[field.name()] = (np.asarray(full, dtype=float), np.asarray(pieces, dtype=float))
+
+    def keep(self, full, pieces):
+        # Keep the CPAs where the boolean arrays full and pieces are true
+        self.full = self.full[full]
+        self.pieces = self.pieces[pieces]
+        self.geometries = [geometry for geometry, kept in zip(self.geometries, pieces) if kept]
+        self.values = {name: (values[0][full], values[1][pieces]) for name, values in self.values.items()}
+
+    def repair(self, counts=None):
+        # Fix CF Polys for the pieces, like _fixed_features()
+        for n, geometry in enumerate(self.geometries):
+            if counts is None or not geometry.isGeosValid():
+                self.geometries[n] = repaired_geometry(geometry, QgsWkbTypes.PolygonGeometry)
+                if counts is not None:
+                    counts['repaired'] += 1
+            if counts is not None:
+                counts['checked'] += 1
+
+    def output_fields(self):
+        fields = QgsFields(self.fields)
+        for field in self.value_fields:
+            fields.append(field)
+        return fields
+
+    def features(self):
+        # The CPAs as features in grid order, cell polygons built as they are needed
+        fields = self.output_fields()
+        cells = np.concatenate([self.full[:, :2], self.pieces[:, :2]])
+        for n in np.lexsort((np.arange(len(cells)), cells[:, 1], cells[:, 0])):
+            if n < len(self.full):
+                row, col, source = self.full[n]
+                geometry = self.cell(row, col)
+                values = [self.values[field.name()][0][n] for field in self.value_fields]
+            else:
+                row, col, source = self.pieces[n - len(self.full)]
+                geometry = QgsGeometry(self.geometries[n - len(self.full)])
+                values = [self.values[field.name()][1][n - len(self.full)] for field in self.value_fields]
+            geometry.convertToMultiType()
+            feature = QgsFeature(fields)
+            feature.setGeometry(geometry)
+            feature.setAttributes(list(self.attributes[source]) + [NULL if math.isnan(v) else float(v) for v in values])
+            yield feature
+
+    def write(self, context, feedback, destination='memory:'):
+        # Returns the id of the output, a temporary layer unless destination is a file, None if the run was cancelled
+        sink, dest_id = QgsProcessingUtils.createFeatureSink(destination, context, self.output_fields(), QgsWkbTypes.MultiPolygon, self.crs)
+        total = 100.0 / len(self) if len(self) else 0
+        for n, feature in enumerate(self.features()):
+            if feedback.isCanceled():
+                return None
+            sink.addFeature(feature, QgsFeatureSink.FastInsert)
+            feedback.setProgress(n * total)
+        del sink
+        return dest_id
+
+
+def grid_cells(source, origin, grid_length, context, feedback):
+    # The polygons of source cut at the CPA grid lines as a GridCpas, None if the run was cancelled
+    layer = QgsProcessingUtils.mapLayerFromString(source, context)
+    attributes = []
+    full = []
+    pieces = []
+    geometries = []
+    total = 100.0 / layer.featureCount() if layer.featureCount() else 0
+    for n, feature in enumerate(layer.getFeatures()):
+        attributes.append(feature.attributes())
+        for part in _polygon_parts(feature.geometry()):
+            if feedback.isCanceled():
+                return None
+            cells = []
+            for row, col, piece in _split_part(part, origin, grid_length, cells):
+                pieces.append((row, col, n))
+                geometries.append(piece)
+            full.extend((row, col, n) for row, col in cells)
+        feedback.setProgress(n * total)
+    return GridCpas(origin, grid_length, layer.crs(), layer.fields(), attributes, full, pieces, geometries)
+
+
+def cell_means(cpas, raster_path, feedback, band_number=1, column='CF_mean'):
+    # Add the mean of the raster under every CPA of cpas (in the raster CRS) as column, with zonal statistics'
+    # rules (see WINDOWED RASTER) in one windowed sweep. Returns False if the run was cancelled.
+    ds = gdal.Open(raster_path)
+    band = ds.GetRasterBand(band_number)
+    nodata = band.GetNoDataValue()
+    geotransform = ds.GetGeoTransform()
+    x0, px, _rx, y0, _ry, py = geotransform
+    grid_x0, grid_y0 = cpas.origin
+
+    keys = cpas.full[:, 0] * CELL_KEY + cpas.full[:, 1]
+    order = np.argsort(keys)
+    keys = keys[order]
+    full_sums = np.zeros(len(keys))
+    full_counts = np.zeros(len(keys), dtype=np.int64)
+    _labels, label_layer = _label_layer(cpas.geometries)
+    piece_sums = np.zeros(len(cpas.geometries) + 1)
+    piece_counts = np.zeros(len(cpas.geometries) + 1, dtype=np.int64)
+
+    mapped = _mapped(band)
+    windows = list(raster_windows(band))
+    for n, (x, y, width, height) in enumerate(windows):
+        if feedback.isCanceled():
+            return False
+        left, top = x0 + x * px, y0 + y * py
+        labels = _window_labels(label_layer, (left, px, 0, top, 0, py), width, height)
+        cols = _grid_index(left, px, width, grid_x0, cpas.grid_length)
+        # Rows count downwards from the grid's top edge
+        rows = _grid_index(-top, -py, height, -grid_y0, cpas.grid_length)
+        pixel_keys = rows[:, None] * CELL_KEY + cols[None, :]
+        in_full = len(keys) and keys[0] <= pixel_keys.max() and keys[-1] >= pixel_keys.min()
+        if not in_full and labels is None:
+            feedback.setProgress(100.0 * (n + 1) / len(windows))
+            continue
+        values = _read_window(band, mapped, x, y, width, height)
+        valid = _valid_pixels(values, nodata)
+        if in_full:
+            position = np.minimum(np.searchsorted(keys, pixel_keys), len(keys) - 1)
+            hit = valid & (keys[position] == pixel_keys)
+            full_sums += np.bincount(position[hit], weights=values[hit], minlength=len(keys))
+            full_counts += np.bincount(position[hit], minlength=len(keys))
+        if labels is not None:
+            inside = (labels > 0) & valid
+            piece_sums += np.bincount(labels[inside], weights=values[inside], minlength=len(piece_sums))
+            piece_counts += np.bincount(labels[inside], minlength=len(piece_counts))
+        feedback.setProgress(100.0 * (n + 1) / len(windows))
+    label_layer.SetSpatialFilter(None)
+
+    def means(sums, counts, geometry):
+        # At most one pixel centre: the overlap-weighted mean, as zonal statistics does
+        with np.errstate(divide='ignore', invalid='ignore'):
+            result = np.where(counts > 1, sums / counts, np.nan)
+        for k in np.flatnonzero(counts <= 1):
+            mean = None if geometry(k).isNull() else _intersection_mean(geometry(k), band, geotransform, nodata)
+            result[k] = np.nan if mean is None else mean
+        return result
+
+    full_means = np.empty(len(keys))
+    full_means[order] = means(full_sums, full_counts, lambda k: cpas.cell(*cpas.full[order[k], :2]))
+    piece_means = means(piece_sums[1:], piece_counts[1:], lambda k: cpas.geometries[k])
+    cpas.add_values(QgsField(column, QVariant.Double), full_means, piece_means)
+    return True
+
+
+def cell_area_mode(crs, context):
+    # How $area of the cells of a grid in crs varies: AREA_UNIFORM for planar areas or an equal-area
+    # projection, AREA_PER_ROW for a cylindrical projection, AREA_PER_CELL otherwise
+    measure = QgsDistanceArea()
+    measure.setSourceCrs(crs, context.transformContext())
+    measure.setEllipsoid(context.ellipsoid())
+    projection = dict(part.split('=', 1) for part in crs.toProj().split() if '=' in part).get('+proj')
+    if not measure.willUseEllipsoid() or projection in EQUAL_AREA_PROJECTIONS:
+        return AREA_UNIFORM
+    if projection in CYLINDRICAL_PROJECTIONS:
+        return AREA_PER_ROW
+    return AREA_PER_CELL
+
+
+def full_cell_sqkm(cpas, sqkm, mode):
+    # sqkm (see measure_sqkm) of the full cells of cpas: of one cell for all of them (AREA_UNIFORM), of the first
+    # full cell of every grid row for the row (AREA_PER_ROW) or of every cell (AREA_PER_CELL)
+    if not len(cpas.full):
+        return np.zeros(0)
+    if mode == AREA_UNIFORM:
+        return np.full(len(cpas.full), sqkm(cpas.cell(*cpas.full[0, :2])))
+    if mode == AREA_PER_ROW:
+        _rows, first, inverse = np.unique(cpas.full[:, 0], return_index=True, return_inverse=True)
+        return np.array([sqkm(cpas.cell(*cpas.full[n, :2])) for n in first])[inverse]
+    return np.array([sqkm(cpas.cell(row, col)) for row, col, _source in cpas.full])
+
+
+##### TILED RUNS #######
+# The CPA grid is cut into square tiles of whole CPA cells, so no cell is ever split between tiles. Every tile
+# runs CPA geometry, nearest substation and the NUTS/country overlays in its own worker process
+# ("python Onwind_CPAs.py --tile job.json"). The tiles are merged in grid order before the CPA attributes are
+# computed, so CPA_ID and E37_CPA_ID do not depend on the tile size or the number of workers.
+# Workers need QGIS's own Python environment, the same one qgis_process uses.
+
+def grid_tiles(raster_path, extent, grid_length, tile_size):
+    # Yield ([left, bottom, right, top], [xoff, yoff, xsize, ysize]) for each tile overlapping the raster.
+    # The pixel window has a one pixel margin so pixels straddling the tile edge are seen by both tiles.
+    ds = gdal.Open(raster_path)
+    x0, px, _rx, y0, _ry, py = ds.GetGeoTransform()
+    py = -py
+    width, height = ds.RasterXSize, ds.RasterYSize
+    span = grid_length * tile_size
+    tile_cols = int(math.ceil(extent.width() / span))
+    tile_rows = int(math.ceil(extent.height() / span))
+    for tile_row in range(tile_rows):
+        for tile_col in range(tile_cols):
+            left = extent.xMinimum() + tile_col * span
+            top = extent.yMaximum() - tile_row * span
+            right, bottom = left + span, top - span
+            xoff = max(int(math.floor((left - x0) / px)) - 1, 0)
+            xend = min(int(math.ceil((right - x0) / px)) + 1, width)
+            yoff = max(int(math.floor((y0 - top) / py)) - 1, 0)
+            yend = min(int(math.ceil((y0 - bottom) / py)) + 1, height)
+            if xend <= xoff or yend <= yoff:
+                continue
+            yield [left, bottom, right, top], [xoff, yoff, xend - xoff, yend - yoff]
+
+
+def _python_executable():
+    # Inside the QGIS desktop application sys.executable is QGIS itself rather than a Python interpreter
+    if os.path.basename(sys.executable).lower().startswith('python'):
+        return sys.executable
+    search = os.pathsep.join([sys.exec_prefix, os.path.join(sys.exec_prefix, 'bin'), os.environ.get('PATH', '')])
+    return shutil.which('python3', path=search) or shutil.which('python', path=search) or sys.executable
+
+
+def run_worker_processes(commands, workers, feedback, logs, fail_fast=True):
+    # Run commands with at most `workers` processes at a time, writing each one's output to its log file.
+    # Returns the exit codes in command order, None if the run was cancelled. With fail_fast a failing worker
+    # raises straight away.
+    pending = list(enumerate(zip(commands, logs)))
+    running = []
+    returncodes = [None] * len(commands)
+    while pending or running:
+        if feedback.isCanceled():
+            for _n, process, _log in running:
+                process.terminate()
+            return None
+        while pending and len(running) < workers:
+            n, (command, log) = pending.pop(0)
+            with open(log, 'w') as log_file:
+                running.append((n, subprocess.Popen(command, stdout=log_file, stderr=subprocess.STDOUT), log))
+        still_running = []
+        for n, process, log in running:
+            if process.poll() is None:
+                still_running.append((n, process, log))
+                continue
+            returncodes[n] = process.returncode
+            if process.returncode and fail_fast:
+                with open(log) as log_file:
+                    raise QgsProcessingException('Worker failed ({}):\n{}'.format(log, log_file.read()[-2000:]))
+        running = still_running
+        feedback.setProgress(100.0 * sum(code is not None for code in returncodes) / len(commands))
+        time.sleep(0.2)
+    return returncodes
+
+
+def run_tile_jobs(jobs, workers, folder, feedback):
+    commands = []
+    logs = []
+    for n, job in enumerate(jobs):
+        path = os.path.join(folder, 'tile_{}.json'.format(n))
+        with open(path, 'w') as job_file:
+            json.dump(job, job_file)
+        commands.append([_python_executable(), os.path.abspath(__file__), '--tile', path])
+        logs.append(os.path.join(folder, 'tile_{}.log'.format(n)))
+    return run_worker_processes(commands, workers, feedback, logs) is not None
+
+
+def _has_resource(raster_path):
+    ds = gdal.Open(raster_path)
+    band = ds.GetRasterBand(1)
+    values = band.ReadAsArray()
+    valid = np.isfinite(values)
+    if band.GetNoDataValue() is not None:
+        valid &= values != band.GetNoDataValue()
+    return bool(valid.any())
+
+
+def run_tile_job(job, context, feedback):
+    # Worker side of a tiled run. Writes the tile's CPAs with substations and regions to job['output'].
+    raster = os.path.splitext(job['output'])[0] + '.vrt'
+    gdal.Translate(raster, job['raster'], format='VRT', srcWin=job['window'])
+    if not _has_resource(raster):
+        return True
+
+    alg = CpasOnwind()
+    alg.initAlgorithm()
+    parameters = {'ResourceRaster': raster, 'CPAGridLength': job['grid_length'], 'CpaEngine': job['engine'], 'NearestEngine': job['nearest'],
+                  'RegionEngine': job['regions'], 'Streaming': job['streaming'], 'WindowedRaster': job['windowed'], 'GeometryRepair': job['repair'],
+                  'GridPruning': job['pruning'], 'CompactCells': job['compact']}
+    outputs = {
+        'FixSubstations': {'OUTPUT': job['substations']},
+        'SubstationIndex': {'OUTPUT': job['substation_index']},
+        'FixedBoundaryLayer': {'OUTPUT': job['boundaries']},
+    }
+    left, bottom, right, top = job['tile']
+    extent = '{},{},{},{} [{}]'.format(left, right, bottom, top, job['crs'])
+    if not alg.cpaGeometry(parameters, context, feedback, outputs, extent, job['crs']):
+        return False
+
+    # Keep the CPAs whose centroid is inside the tile, the pixel margin belongs to the neighbouring tiles
+    alg_params = {
+        'EXPRESSION': 'x(centroid($geometry)) >= {0} AND x(centroid($geometry)) < {2} AND y(centroid($geometry)) > {1} AND y(centroid($geometry)) <= {3}'.format(left, bottom, right, top),
+        'INPUT': outputs['RemoveCpasBelowCutoff']['OUTPUT'],
+        'OUTPUT': QgsProcessing.TEMPORARY_OUTPUT
+    }
+    outputs['RemoveCpasBelowCutoff'] = run_child('native:extractbyexpression', alg_params, context, feedback)
+    return alg.joinCpas(parameters, context, feedback, outputs, job['output'])
+
+
+def _cpa_sort_key(feature, origin, grid_length):
+    # Grid cell (row, col), region, then centroid: an order that does not depend on how the run was tiled
+    centroid = feature.geometry().centroid().asPoint()
+    row = math.floor((origin[1] - centroid.y()) / grid_length)
+    col = math.floor((centroid.x() - origin[0]) / grid_length)
+    return (row, col, _as_str(feature['NUTS_ID']) or '', _as_str(feature['CNTR_CODE']) or '',
+            round(-centroid.y(), 3), round(centroid.x(), 3))
+
+
+def _in_tile(point, tile):
+    # The centroid rule of run_tile_job
+    left, bottom, right, top = tile
+    return left <= point.x() < right and bottom < point.y() <= top
+
+
+def merge_tiles(paths, origin, grid_length, crs, context, feedback, previous=None, replaced=()):
+    # Merge the tile outputs into one temporary layer in grid order. With previous (a CPA layer), its CPAs
+    # outside the replaced tiles are merged as well, matching the tile outputs' fields by name. Returns its id.
+    keyed = []
+    fields = None
+    wkb_type = QgsWkbTypes.MultiPolygon
+    for path in paths:
+        layer = QgsVectorLayer(path, 'tile', 'ogr')
+        if fields is None:
+            fields = layer.fields()
+            wkb_type = layer.wkbType()
+        for feature in layer.getFeatures():
+            keyed.append((_cpa_sort_key(feature, origin, grid_length), feature))
+        if feedback.isCanceled():
+            return None
+    if previous is not None:
+        if fields is None:
+            fields = previous.fields()
+            wkb_type = previous.wkbType()
+        for feature in previous.getFeatures():
+            if any(_in_tile(feature.geometry().centroid().asPoint(), tile) for tile in replaced):
+                continue
+            kept = QgsFeature(fields)
+            kept.setGeometry(feature.geometry())
+            kept.setAttributes([feature[field.name()] if previous.fields().indexOf(field.name()) >= 0 else None for field in fields])
+            keyed.append((_cpa_sort_key(kept, origin, grid_length), kept))
+            if feedback.isCanceled():
+                return None
+    if fields is None:
+        raise QgsProcessingException('No CPAs were produced by any tile')
+    keyed.sort(key=lambda item: item[0])
+
+    sink, dest_id = QgsProcessingUtils.createFeatureSink('memory:', context, fields, wkb_type, crs)
+    for _key, feature in keyed:
+        out = QgsFeature(fields)
+        out.setGeometry(feature.geometry())
+        out.setAttributes(feature.attributes())
+        sink.addFeature(out, QgsFeatureSink.FastInsert)
+    del sink
+    return dest_id
+
+
+def start_qgis():
+    # Headless QGIS with the processing framework, for worker processes and other standalone entry points
+    app = QgsApplication([], False)
+    app.initQgis()
+    from processing.core.Processing import Processing
+    Processing.initialize()
+    QgsApplication.processingRegistry().addProvider(QgsNativeAlgorithms())
+    return app
+
+
+##### INCREMENTAL RUNS #######
+# A scenario that differs from an earlier one in part of the ResourceRaster only (PreviousRaster, whose CPA
+# output is PreviousCpas) is run tile by tile: the grid-aligned tiles of TileSize CPA cells (INCREMENTAL_TILE_SIZE
+# when TileSize is 0) whose pixels differ between the two rasters are recomputed by tile workers, and the
+# previous CPAs of the other tiles are kept. Tiles are compared by the SHA-1 of their pixel windows, margin
+# included, remembered in the cache per raster (with UseCache). All CPAs are then put in grid order and get their attributes
+# and CPA_IDs anew, which gives the same IDs as a full tiled run. Both rasters must be on the same pixel grid.
+INCREMENTAL_TILE_SIZE = 16
+
+
+def tile_hashes(raster_path, windows, use_cache=True):
+    # SHA-1 of the band 1 pixels of each [xoff, yoff, xsize, ysize] window, remembered in the cache if use_cache
+    path = cache_path('tile_hashes', [file_fingerprint(raster_path), json.dumps(windows)], '.json') if use_cache else None
+    if cache_lookup(path):
+        with open(path) as hash_file:
+            return json.load(hash_file)
+    band = gdal.Open(raster_path).GetRasterBand(1)
+    hashes = [hashlib.sha1(band.ReadAsArray(*window).tobytes()).hexdigest() for window in windows]
+    if path is None:
+        return hashes
+    os.makedirs(cache_folder(), exist_ok=True)
+    with open(partial_path(path), 'w') as hash_file:
+        json.dump(hashes, hash_file)
+    cache_store(partial_path(path), path)
+    return hashes
+
+
+def same_pixel_grid(raster_path, other_path):
+    ds, other = gdal.Open(raster_path), gdal.Open(other_path)
+    return (ds.GetGeoTransform() == other.GetGeoTransform() and (ds.RasterXSize, ds.RasterYSize) == (other.RasterXSize, other.RasterYSize)
+            and ds.GetProjection() == other.GetProjection())
+
+
+##### BATCH RUNS #######
+# run_batch() runs the model for many ResourceRasters, one per technology/exclusion scenario. The static
+# preprocessing (substations, boundaries, CF grid, substation index) is done once into the cache. The scenarios
+# then run concurrently in worker processes ("python Onwind_CPAs.py --run job.json") that all hit the cache.
+# Each scenario writes <output folder>/<raster name>.<extension>, and the batch writes batch_summary.json/.csv.
+# From the QGIS Python console:
+#     run_batch('/path/to/rasters', '/path/to/output', {'CPAGridLength': 1400}, workers=8)
+# or standalone:
+#     python Onwind_CPAs.py --batch /path/to/rasters --output /path/to/output --workers 8
+RASTER_EXTENSIONS = ('.tif', '.tiff', '.vrt', '.img', '.asc')
+
+
+class ConsoleFeedback(QgsProcessingFeedback):
+    # Feedback for worker processes: messages go to stdout, which the parent writes to the worker's log
+
+    def pushInfo(self, info):
+        print(info, flush=True)
+
+    def pushDebugInfo(self, info):
+        print(info, flush=True)
+
+    def reportError(self, error, fatalError=False):
+        print('ERROR: {}'.format(error), flush=True)
+
+
+def list_rasters(rasters):
+    # A folder, a raster or a list of either -> raster paths, folders listed in name order
+    if isinstance(rasters, str):
+        rasters = [rasters]
+    paths = []
+    for raster in rasters:
+        if os.path.isdir(raster):
+            paths.extend(os.path.join(raster, name) for name in sorted(os.listdir(raster))
+                         if os.path.splitext(name)[1].lower() in RASTER_EXTENSIONS)
+        else:
+            paths.append(raster)
+    return paths
+
+
+def scenario_names(rasters):
+    # Output names of the scenarios: the raster file names without extension, with _1, _2, ... added to
+    # names shared by several rasters (e.g. the same file name in two folders) so their outputs do not collide
+    stems = [os.path.splitext(os.path.basename(raster))[0] for raster in rasters]
+    used = {stem for stem in stems if stems.count(stem) == 1}
+    names = []
+    for stem in stems:
+        name, n = stem, 0
+        while stems.count(stem) > 1 and (n == 0 or name in used):
+            n += 1
+            name = '{}_{}'.format(stem, n)
+        used.add(name)
+        names.append(name)
+    return names
+
+
+def algorithm_parameters(alg, parameters):
+    # parameters completed with the algorithm's defaults, so they can be used outside processing.run
+    parameters = dict(parameters or {})
+    for definition in alg.parameterDefinitions():
+        if definition.name() not in parameters and definition.defaultValue() is not None:
+            parameters[definition.name()] = definition.defaultValue()
+    return parameters
+
+
+def cpa_totals(path):
+    # Headline numbers of a CPA output for run summaries
+    layer = QgsVectorLayer(path, 'cpas', 'ogr')
+    if not layer.isValid():
+        return {}
+    names = [name for name in ('Name_cap_gw', 'An_gen', 'LCOE') if layer.fields().indexOf(name) >= 0]
+    request = QgsFeatureRequest().setFlags(QgsFeatureRequest.NoGeometry).setSubsetOfAttributes(names, layer.fields())
+    values = {name: [] for name in names}
+    for feature in layer.getFeatures(request):
+        for name in names:
+            values[name].append(_as_float(feature[name]))
+    values = {name: np.asarray(v, dtype=float) for name, v in values.items()}
+    totals = {'cpas': layer.featureCount()}
+    if 'Name_cap_gw' in values:
+        totals['capacity_gw'] = round(float(np.nansum(values['Name_cap_gw'])), 3)
+    if 'An_gen' in values:
+        totals['generation_mwh'] = round(float(np.nansum(values['An_gen'])), 3)
+    if 'LCOE' in values and np.isfinite(values['LCOE']).any():
+        totals['lcoe_min'] = round(float(np.nanmin(values['LCOE'])), 3)
+        totals['lcoe_median'] = round(float(np.nanmedian(values['LCOE'])), 3)
+    return totals
+
+
+def worker_grid_crs(alg, parameters, context):
+    # The CRS of the CF grid for worker processes, whose project has none: the project CRS, else EuropeCRS
+    crs = context.project().crs() if context.project() else QgsCoordinateReferenceSystem()
+    return crs if crs.isValid() else alg.parameterAsCrs(parameters, 'EuropeCRS', context)
+
+
+def run_batch(rasters, output_folder, parameters=None, workers=None, extension='gpkg', feedback=None, context=None):
+    # Run every raster in rasters (see list_rasters) as its own scenario. parameters are the algorithm
+    # parameters shared by all scenarios. Returns the batch summary, None if cancelled.
+    feedback = feedback or QgsProcessingFeedback()
+    if context is None:
+        context = QgsProcessingContext()
+        context.setProject(QgsProject.instance())
+    rasters = list_rasters(rasters)
+    workers = workers or os.cpu_count() or 1
+    os.makedirs(output_folder, exist_ok=True)
+    job_folder = os.path.join(output_folder, 'batch_jobs')
+    os.makedirs(job_folder, exist_ok=True)
+
+    alg = CpasOnwind()
+    alg.initAlgorithm()
+    parameters = algorithm_parameters(alg, parameters)
+    # The scenarios share the static layers through the cache
+    parameters['UseCache'] = True
+    started = time.perf_counter()
+
+    # Static preprocessing, once. The workers build their grid in grid_crs, so they find this one in the cache.
+    feedback.pushInfo('Static preprocessing for {} scenarios'.format(len(rasters)))
+    static_feedback = QgsProcessingMultiStepFeedback(21, feedback)
+    grid_crs = worker_grid_crs(alg, parameters, context)
+    outputs = {}
+    if not alg.staticLayers(parameters, context, static_feedback, outputs):
+        return None
+    if alg.parameterAsEnum(parameters, 'CpaEngine', context) == ENGINE_VECTOR and not alg.parameterAsInt(parameters, 'TileSize', context):
+        if not alg.cfGrid(parameters, context, static_feedback, outputs, crs=grid_crs):
+            return None
+    parameters['ClearCache'] = False
+    static_s = time.perf_counter() - started
+
+    # Raster-dependent stages, one worker process per scenario
+    commands = []
+    logs = []
+    scenario_outputs = []
+    for raster, name in zip(rasters, scenario_names(rasters)):
+        output = os.path.join(output_folder, '{}.{}'.format(name, extension))
+        job = dict(parameters, ResourceRaster=raster, Cpas=output, grid_crs=crs_key(grid_crs))
+        job_path = os.path.join(job_folder, '{}.json'.format(name))
+        with open(job_path, 'w') as job_file:
+            json.dump(job, job_file)
+        commands.append([_python_executable(), os.path.abspath(__file__), '--run', job_path])
+        logs.append(os.path.join(job_folder, '{}.log'.format(name)))
+        scenario_outputs.append(output)
+    feedback.pushInfo('Running {} scenarios on {} worker processes'.format(len(rasters), workers))
+    returncodes = run_worker_processes(commands, workers, feedback, logs, fail_fast=False)
+    if returncodes is None:
+        return None
+
+    scenarios = []
+    for raster, output, log, returncode in zip(rasters, scenario_outputs, logs, returncodes):
+        scenario = {'raster': raster, 'output': output, 'log': log, 'status': 'ok' if returncode == 0 else 'failed ({})'.format(returncode)}
+        profile = os.path.splitext(output)[0] + '_profile.json'
+        if os.path.exists(profile):
+            with open(profile) as profile_file:
+                scenario['wall_s'] = json.load(profile_file)['wall_s']
+        if returncode == 0:
+            scenario.update(cpa_totals(output))
+        scenarios.append(scenario)
+        if returncode:
+            feedback.reportError('Scenario {} failed, see {}'.format(raster, log))
+    summary = {
+        'parameters': {k: v for k, v in parameters.items() if k not in ('ResourceRaster', 'Cpas')},
+        'grid_crs': crs_key(grid_crs),
+        'workers': workers,
+        'static_s': round(static_s, 3),
+        'wall_s': round(time.perf_counter() - started, 3),
+        'scenarios': scenarios,
+    }
+    with open(os.path.join(output_folder, 'batch_summary.json'), 'w') as summary_file:
+        json.dump(summary, summary_file, indent=2, default=str)
+    columns = ['raster', 'output', 'status', 'wall_s', 'cpas', 'capacity_gw', 'generation_mwh', 'lcoe_min', 'lcoe_median', 'log']
+    with open(os.path.join(output_folder, 'batch_summary.csv'), 'w', newline='') as summary_file:
+        writer = csv.DictWriter(summary_file, columns, extrasaction='ignore')
+        writer.writeheader()
+        writer.writerows(scenarios)
+    feedback.pushInfo('Batch finished in {:.1f} s, summary in {}'.format(summary['wall_s'], output_folder))
+    return summary
+
+
+def run_job(job, context, feedback):
+    # Worker side of a batch scenario: one ordinary model run with the job's parameters. grid_crs is the CRS
+    # of the CF grid, set as the project CRS. Benchmark jobs also name the static inputs to use instead of
+    # SUBSTATIONS_SHP and NUTS_SHP.
+    global SUBSTATIONS_SHP, NUTS_SHP
+    job = dict(job)
+    SUBSTATIONS_SHP = job.pop('substations', SUBSTATIONS_SHP)
+    NUTS_SHP = job.pop('boundaries', NUTS_SHP)
+    grid_crs = job.pop('grid_crs', None)
+    if grid_crs and context.project():
+        context.project().setCrs(QgsCoordinateReferenceSystem(grid_crs))
+    alg = CpasOnwind()
+    alg.initAlgorithm()
+    return processing.run(alg, job, context=context, feedback=feedback)
+
+
+##### BENCHMARK #######
+# Times the model on the shapefiles bundled next to this script and on synthetic resource rasters of increasing
+# size and fragmentation, for every CPAGridLength in grid_lengths:
+#     python Onwind_CPAs.py --benchmark [GRID_LENGTH ...] --output FOLDER
+# The bundled shapefiles come without .shx, .dbf and .prj, so benchmark_inputs() restores the index, sets the
+# CRS (EPSG:3857 for NUTS, EPSG:3035 for the substations) and adds synthetic NUTS_ID, CNTR_CODE and Sub_ID
+# where the attributes are missing. Each case is a separate worker process, run one at a time, so peak memory
+# and timings are its own. The cache is off, so every case runs every step. The CF grid is in EuropeCRS, the
+# workers have no project CRS.
+# Results go to <output>/benchmark.json (environment, and per case the profiling report of every step) and
+# <output>/benchmark.csv (one row per case), to compare runs across changes.
+BENCHMARK_GRID_LENGTHS = (500, 1400, 5000)
+# Raster edge in pixels of 100 m
+BENCHMARK_SIZES = (500, 1000, 2000)
+# Edge in pixels of the random square resource patches, smaller is more fragmented
+BENCHMARK_PATCHES = {'coarse': 64, 'medium': 16, 'fine': 4}
+# Centre of the synthetic rasters in EPSG:3035, in central Europe
+BENCHMARK_CENTRE = (4300000, 3000000)
+
+
+def benchmark_inputs(folder):
+    # GeoPackage copies of the bundled shapefiles the model can run on. Returns (substations, boundaries).
+    bundled = os.path.dirname(os.path.abspath(__file__))
+    os.makedirs(folder, exist_ok=True)
+    specs = [
+        ('entso_substations', 3035, [('Sub_ID', lambda n: 'SUB_{:06d}'.format(n))]),
+        ('NUTS_RG_10M_2021_3857_LEVL_2', 3857, [('NUTS_ID', lambda n: 'X{:03d}'.format(n)), ('CNTR_CODE', lambda n: 'X{}'.format(n // 10 % 10))]),
+    ]
+    paths = []
+    gdal.SetConfigOption('SHAPE_RESTORE_SHX', 'YES')
+    try:
+        for name, epsg, synthetic in specs:
+            path = os.path.join(folder, name + '.gpkg')
+            paths.append(path)
+            if os.path.exists(path):
+                continue
+            # Restoring the .shx writes next to the .shp, so work on a copy
+            for extension in ('.shp', '.shx', '.dbf', '.prj'):
+                if os.path.exists(os.path.join(bundled, name + extension)):
+                    shutil.copy(os.path.join(bundled, name + extension), folder)
+            source = ogr.Open(os.path.join(folder, name + '.shp'))
+            source_layer = source.GetLayer(0)
+            srs = osr.SpatialReference()
+            srs.ImportFromEPSG(epsg)
+            target = ogr.GetDriverByName('GPKG').CreateDataSource(partial_path(path))
+            layer = target.CreateLayer(name, srs, source_layer.GetGeomType())
+            definition = source_layer.GetLayerDefn()
+            names = [definition.GetFieldDefn(i).GetName() for i in range(definition.GetFieldCount())]
+            for i in range(definition.GetFieldCount()):
+                layer.CreateField(definition.GetFieldDefn(i))
+            missing = [(field, value) for field, value in synthetic if field not in names]
+            for field, _value in missing:
+                layer.CreateField(ogr.FieldDefn(field, ogr.OFTString))
+            layer.StartTransaction()
+            for n, feature in enumerate(source_layer):
+                out = ogr.Feature(layer.GetLayerDefn())
+                out.SetGeometry(feature.GetGeometryRef())
+                for i, field in enumerate(names):
+                    out.SetField(field, feature.GetField(i))
+                for field, value in missing:
+                    out.SetField(field, value(n))
+                layer.CreateFeature(out)
+            layer.CommitTransaction()
+            target = source = None
+            os.replace(partial_path(path), path)
+    finally:
+        gdal.SetConfigOption('SHAPE_RESTORE_SHX', None)
+    return tuple(paths)
+
+
+def synthetic_raster(path, size, patch, coverage=0.4, seed=0, pixel_size=100, centre=BENCHMARK_CENTRE):
+    # size x size resource raster in EPSG:3035: random square patches of patch x patch pixels cover about
+    # coverage of it with CF between 0.15 and 0.45, nodata elsewhere. Returns the resource fraction.
+    rng = np.random.default_rng(seed)
+    cells = -(-size // patch)
+    resource = np.repeat(np.repeat(rng.random((cells, cells)) < coverage, patch, axis=0), patch, axis=1)[:size, :size]
+    values = np.where(resource, 0.15 + 0.3 * rng.random((size, size)), MASK_NODATA).astype(np.float32)
+    ds = gdal.GetDriverByName('GTiff').Create(path, size, size, 1, gdal.GDT_Float32, GTIFF_OPTIONS)
+    half = size * pixel_size / 2.0
+    ds.SetGeoTransform((centre[0] - half, pixel_size, 0, centre[1] + half, 0, -pixel_size))
+    srs = osr.SpatialReference()
+    srs.ImportFromEPSG(3035)
+    ds.SetProjection(srs.ExportToWkt())
+    band = ds.GetRasterBand(1)
+    band.SetNoDataValue(MASK_NODATA)
+    band.WriteArray(values)
+    ds = None
+    return round(float(resource.mean()), 4)
+
+
+def _git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmark(output_folder, grid_lengths=BENCHMARK_GRID_LENGTHS, sizes=BENCHMARK_SIZES, patches=None, parameters=None, feedback=None):
+    # Run every raster size x fragmentation x grid length case, see BENCHMARK. parameters are extra algorithm
+    # parameters for every case. Returns the benchmark report, None if cancelled.
+    feedback = feedback or QgsProcessingFeedback()
+    patches = patches or BENCHMARK_PATCHES
+    substations, boundaries = benchmark_inputs(os.path.join(output_folder, 'inputs'))
+    job_folder = os.path.join(output_folder, 'jobs')
+    os.makedirs(job_folder, exist_ok=True)
+    alg = CpasOnwind()
+    alg.initAlgorithm()
+    grid_crs = crs_key(worker_grid_crs(alg, algorithm_parameters(alg, parameters), QgsProcessingContext()))
+
+    cases = []
+    for size in sizes:
+        for fragmentation, patch in sorted(patches.items(), key=lambda item: -item[1]):
+            raster = os.path.join(output_folder, 'inputs', 'resource_{}_{}.tif'.format(size, fragmentation))
+            resource_fraction = synthetic_raster(raster, size, patch)
+            for grid_length in grid_lengths:
+                name = 'cpas_{}_{}_{}'.format(size, fragmentation, grid_length)
+                cases.append({'name': name, 'raster': raster, 'size_px': size, 'pixels': size * size, 'fragmentation': fragmentation,
+                              'patch_px': patch, 'resource_fraction': resource_fraction, 'grid_length': grid_length,
+                              'output': os.path.join(output_folder, name + '.gpkg')})
+
+    commands = []
+    logs = []
+    for case in cases:
+        job = dict(parameters or {}, ResourceRaster=case['raster'], CPAGridLength=case['grid_length'], Cpas=case['output'],
+                   UseCache=False, substations=substations, boundaries=boundaries, grid_crs=grid_crs)
+        job_path = os.path.join(job_folder, case['name'] + '.json')
+        with open(job_path, 'w') as job_file:
+            json.dump(job, job_file)
+        commands.append([_python_executable(), os.path.abspath(__file__), '--run', job_path])
+        logs.append(os.path.join(job_folder, case['name'] + '.log'))
+    feedback.pushInfo('Running {} benchmark cases'.format(len(cases)))
+    returncodes = run_worker_processes(commands, 1, feedback, logs, fail_fast=False)
+    if returncodes is None:
+        return None
+
+    for case, log, returncode in zip(cases, logs, returncodes):
+        case['status'] = 'ok' if returncode == 0 else 'failed ({})'.format(returncode)
+        case['log'] = log
+        profile = os.path.splitext(case['output'])[0] + '_profile.json'
+        if returncode == 0 and os.path.exists(profile):
+            with open(profile) as profile_file:
+                report = json.load(profile_file)
+            case['wall_s'] = report['wall_s']
+            case['peak_rss_mb'] = report['peak_rss_mb']
+            case['steps'] = report['steps']
+            case['cpas'] = cpa_totals(case['output']).get('cpas')
+            case['mpixels_per_s'] = round(case['pixels'] / 1e6 / case['wall_s'], 4) if case['wall_s'] else None
+            case['cpas_per_s'] = round(case['cpas'] / case['wall_s'], 2) if case['wall_s'] and case['cpas'] is not None else None
+        elif returncode:
+            feedback.reportError('Benchmark case {} failed, see {}'.format(case['name'], log))
+
+    report = {
+        'environment': {
+            'qgis_version': Qgis.QGIS_VERSION,
+            'gdal_version': gdal.__version__,
+            'numpy_version': np.__version__,
+            'python_version': sys.version.split()[0],
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+            'git_commit': _git_commit(),
+            'started': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        },
+        'parameters': dict(parameters or {}),
+        'grid_crs': grid_crs,
+        'cases': cases,
+    }
+    with open(os.path.join(output_folder, 'benchmark.json'), 'w') as report_file:
+        json.dump(report, report_file, indent=2, default=str)
+    columns = ['name', 'size_px', 'pixels', 'fragmentation', 'patch_px', 'resource_fraction', 'grid_length', 'status',
+               'wall_s', 'peak_rss_mb', 'cpas', 'mpixels_per_s', 'cpas_per_s']
+    with open(os.path.join(output_folder, 'benchmark.csv'), 'w', newline='') as report_file:
+        writer = csv.DictWriter(report_file, columns, extrasaction='ignore')
+        writer.writeheader()
+        writer.writerows(cases)
+    feedback.pushInfo('Benchmark results in {}'.format(output_folder))
+    return report
+
+
+##### WARM WORKER #######
+# A long-lived process that starts QGIS once, loads the substations, the boundaries and the substation index
+# once and keeps one CpasOnwind instance, for short runs where startup would dominate:
+#     python Onwind_CPAs.py --serve [--port PORT]
+#     python Onwind_CPAs.py --submit RASTER --output CPAS.gpkg [--grid-length L] [--port PORT]
+# Jobs are algorithm parameters (at least ResourceRaster and Cpas, CPAGridLength defaults to the worker's) sent
+# over a local socket with submit_job(), and run one after another in arrival order. The CF grid of each
+# CPAGridLength is built by the first job that needs it and kept. Every reply has the job's latency: time
+# waiting in the queue, run time and the total since submission. A job's temporary layers are dropped when it
+# finishes, so memory does not grow from job to job. Tiled runs do not use the loaded layers, because their
+# workers are separate processes. The static layers are loaded for the worker's NearestEngine at startup and
+# for any other NearestEngine by the first job that asks for it. They are all in the worker's EuropeCRS, so
+# jobs with another EuropeCRS are refused. Loaded layers that are cache entries are copied into a temporary
+# folder of the worker first, because the cache may evict or clear them while the worker runs.
+# Messages are pickled, so every connection is authenticated with a random key that --serve writes to
+# worker.key in WORKER_FOLDER, readable by the user only, and --submit reads back. Set CPA_WORKER_KEY to use
+# a key of your own on both sides instead.
+WORKER_PORT = 6038
+
+
+def worker_key_path():
+    return os.path.join(os.path.expanduser(WORKER_FOLDER), 'worker.key')
+
+
+def worker_key(create=False):
+    # The authkey of the warm worker: CPA_WORKER_KEY if set, else the key file (a new random one if create)
+    if os.environ.get('CPA_WORKER_KEY'):
+        return os.environ['CPA_WORKER_KEY'].encode()
+    path = worker_key_path()
+    if create:
+        os.makedirs(os.path.dirname(path), mode=0o700, exist_ok=True)
+        key = secrets.token_hex(32).encode()
+        if os.path.exists(path):
+            os.remove(path)
+        with os.fdopen(os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600), 'wb') as key_file:
+            key_file.write(key)
+        return key
+    try:
+        with open(path, 'rb') as key_file:
+            return key_file.read().strip()
+    except FileNotFoundError:
+        raise QgsProcessingException('No warm worker key in {}, start the worker with --serve or set CPA_WORKER_KEY'.format(path))
+
+
+class WarmWorker:
+
+    def __init__(self, parameters=None, feedback=None, context=None):
+        self.feedback = feedback or ConsoleFeedback()
+        if context is None:
+            context = QgsProcessingContext()
+            context.setProject(QgsProject.instance())
+        self.context = context
+        self.alg = CpasOnwind()
+        self.alg.initAlgorithm()
+        self.parameters = algorithm_parameters(self.alg, parameters)
+        # The CF grids are built in the project CRS, which a headless worker does not have
+        if context.project() and not context.project().crs().isValid():
+            context.project().setCrs(worker_grid_crs(self.alg, self.parameters, context))
+        self.alg.warm = {'crs': crs_key(self.alg.parameterAsCrs(self.parameters, 'EuropeCRS', self.context)), 'static': {}, 'grids': {},
+                         'folder': tempfile.mkdtemp(prefix='cpa_warm_', dir=QgsProcessingUtils.tempFolder())}
+        started = time.perf_counter()
+        if self.alg.warmStatic(self.parameters, self.context, QgsProcessingMultiStepFeedback(21, self.feedback)) is None:
+            raise QgsProcessingException('Loading the static layers was cancelled')
+        self.feedback.pushInfo('Static layers loaded in {:.2f} s'.format(time.perf_counter() - started))
+
+    def run(self, job):
+        # Run one job, returns the reply sent back to the client
+        received = time.time()
+        started = time.perf_counter()
+        parameters = dict(self.parameters, **{k: v for k, v in job.items() if k != 'submitted'})
+        reply = {'ok': False}
+        try:
+            reply['results'] = processing.run(self.alg, parameters, context=self.context, feedback=self.feedback)
+            reply['ok'] = True
+        except Exception as error:
+            reply['error'] = str(error)
+        finally:
+            self.release()
+        reply['run_s'] = round(time.perf_counter() - started, 3)
+        if job.get('submitted'):
+            reply['queue_s'] = round(max(received - job['submitted'], 0.0), 3)
+            reply['latency_s'] = round(time.time() - job['submitted'], 3)
+        self.feedback.pushInfo('Job {}: {} in {} s'.format(parameters.get('ResourceRaster'), 'ok' if reply['ok'] else 'failed', reply['run_s']))
+        return reply
+
+    def release(self):
+        # Drop every temporary layer of the context except the ones kept loaded
+        warm = self.alg.warmSources()
+        store = self.context.temporaryLayerStore()
+        for layer_id, layer in list(store.mapLayers().items()):
+            if layer_id not in warm and layer.source() not in warm:
+                store.removeMapLayer(layer_id)
+        self.context.setLayersToLoadOnCompletion({})
+
+    def serve(self, port=WORKER_PORT):
+        # Answer jobs on localhost:port until a client sends {'stop': True}. A client with the wrong key, one
+        # that disconnects or sends something other than a job is logged and skipped, the worker keeps serving.
+        with Listener(('localhost', port), authkey=worker_key(create=True)) as listener:
+            self.feedback.pushInfo('Warm worker listening on localhost:{}'.format(port))
+            while True:
+                try:
+                    connection = listener.accept()
+                except (AuthenticationError, EOFError, OSError) as error:
+                    self.feedback.reportError('Refused a connection: {!r}'.format(error))
+                    continue
+                with connection:
+                    try:
+                        job = connection.recv()
+                        if not isinstance(job, dict):
+                            connection.send({'ok': False, 'error': 'A job is a dict of algorithm parameters, not {}'.format(type(job).__name__)})
+                            continue
+                        if job.get('stop'):
+                            connection.send({'ok': True})
+                            return
+                        connection.send(self.run(job))
+                    except (EOFError, OSError) as error:
+                        self.feedback.reportError('Lost the connection to a client: {!r}'.format(error))
+
+
+def submit_job(job, port=WORKER_PORT):
+    # Send job (algorithm parameters) to the warm worker on localhost:port and wait for its reply. The time is
+    # taken before connecting, since the worker only accepts the connection once the jobs before it are done.
+    submitted = time.time()
+    with Client(('localhost', port), authkey=worker_key()) as connection:
+        connection.send(dict(job, submitted=submitted))
+        return connection.recv()
+
 
 class CpasOnwind(QgsProcessingAlgorithm):
+    # Layers a WarmWorker keeps loaded: {'crs': crs_key(EuropeCRS), 'static': {NearestEngine: outputs of
+    # staticLayers()}, 'grids': {CPAGridLength: FixGrid}, 'folder': where it keeps its copies of cache entries}
+    warm = None
 
     def initAlgorithm(self, config=None):
         # This is the length of bounding box for the CPAs.
@@ -46,218 +2681,714 @@ class CpasOnwind(QgsProcessingAlgorithm):
         # Select Input Resource Raster from Files
         self.addParameter(QgsProcessingParameterRasterLayer('ResourceRaster', 'Resource Raster', defaultValue=None))
         self.addParameter(QgsProcessingParameterFeatureSink('Cpas', 'CPAs', type=QgsProcessing.TypeVectorAnyGeometry, createByDefault=True, supportsAppend=True, defaultValue=None))
+        # The CPA attributes without geometry, written from the attribute arrays (see write_attribute_table)
+        self.addParameter(QgsProcessingParameterFileDestination('AttributeTable', 'CPA attribute table', fileFilter='CSV files (*.csv)', optional=True, createByDefault=False, defaultValue=None))
+        # Cumulative LCOE supply curves per NUTS_ID and CNTR_CODE in LCOE bins of SupplyCurveResolution, see SUPPLY CURVES
+        self.addParameter(QgsProcessingParameterFeatureSink('SupplyCurves', 'LCOE supply curves', type=QgsProcessing.TypeVector, createByDefault=False, optional=True, defaultValue=None))
+        self.addParameter(QgsProcessingParameterNumber('SupplyCurveResolution', 'Supply curve LCOE bin width (EUR/MWh)', type=QgsProcessingParameterNumber.Double, minValue=0.001, defaultValue=1.0))
         self.addParameter(QgsProcessingParameterBoolean('VERBOSE_LOG', 'Verbose logging', optional=True, defaultValue=False))
+        # Keep the static preprocessing layers (substations, boundaries, CF grid) in CACHE_FOLDER between runs
+        self.addParameter(QgsProcessingParameterBoolean('UseCache', 'Cache static preprocessing layers', optional=True, defaultValue=True))
+        self.addParameter(QgsProcessingParameterBoolean('ClearCache', 'Clear the cache before running', optional=True, defaultValue=False))
+        # Tiled runs: tile edge length in CPA cells (0 runs the whole extent as one job) and worker processes
+        self.addParameter(QgsProcessingParameterNumber('TileSize', 'Tile size (CPA cells, 0 = no tiling)', type=QgsProcessingParameterNumber.Integer, minValue=0, defaultValue=0))
+        self.addParameter(QgsProcessingParameterNumber('Workers', 'Worker processes', type=QgsProcessingParameterNumber.Integer, minValue=1, defaultValue=os.cpu_count() or 1))
+        # Nearest substation: the native join (reference) or the cached substation index, measured from the CPA
+        # centroid or, like the join, from the CPA geometry
+        self.addParameter(QgsProcessingParameterEnum('NearestEngine', 'Nearest substation engine', options=['Join by nearest', 'Cached index (CPA centroid)', 'Cached index (CPA geometry)'], defaultValue=NEAREST_JOIN))
+        # Vector is the reference path. Raster grid skips polygonize/dissolve/split, see RASTER GRID ENGINE for its tolerance.
+        self.addParameter(QgsProcessingParameterEnum('CpaEngine', 'CPA geometry engine', options=['Vector (polygonize, dissolve, split)', 'Raster grid (block reduce)'], defaultValue=ENGINE_VECTOR))
+        # NUTS_ID and CNTR_CODE: two overlays (reference), or one spatial index pass clipping or keeping CPAs whole
+        self.addParameter(QgsProcessingParameterEnum('RegionEngine', 'Region assignment', options=['Overlays (intersection twice)', 'Spatial index, clip at region borders', 'Spatial index, region of the CPA centroid', 'Spatial index, region of largest overlap'], defaultValue=REGION_OVERLAYS))
+        # Cut the resource with the grid cells it covers instead of a grid over the whole extent, see GRID SPLIT
+        self.addParameter(QgsProcessingParameterBoolean('GridPruning', 'Build the grid only where there is resource', optional=True, defaultValue=False))
+        # Run the independent branches (substations, boundaries and grid, resource polygons) on Workers threads, see STAGE SCHEDULER
+        self.addParameter(QgsProcessingParameterBoolean('ConcurrentStages', 'Run independent stages concurrently', optional=True, defaultValue=False))
+        # Incremental run: recompute only the tiles where ResourceRaster differs from PreviousRaster, see INCREMENTAL RUNS
+        self.addParameter(QgsProcessingParameterVectorLayer('PreviousCpas', 'Previous CPAs (incremental run)', types=[QgsProcessing.TypeVectorPolygon], optional=True, defaultValue=None))
+        self.addParameter(QgsProcessingParameterRasterLayer('PreviousRaster', 'Resource Raster of the previous CPAs', optional=True, defaultValue=None))
+        # Fix steps: native:fixgeometries on everything (reference) or repair of the invalid features only, see GEOMETRY REPAIR
+        self.addParameter(QgsProcessingParameterEnum('GeometryRepair', 'Geometry repair', options=['Fix all features (fixgeometries)', 'Repair invalid features only'], defaultValue=REPAIR_ALL))
+        # Keep the outputs of polygonize, dissolve, split and zonal statistics so an interrupted run can resume, see CHECKPOINTS
+        self.addParameter(QgsProcessingParameterFile('CheckpointFolder', 'Checkpoint folder', behavior=QgsProcessingParameterFile.Folder, optional=True, defaultValue=None))
+        # Stream the per-feature stages and free intermediate layers early, see STREAMING
+        self.addParameter(QgsProcessingParameterBoolean('Streaming', 'Streaming mode (lower peak memory)', optional=True, defaultValue=False))
+        # Full CPA cells as grid indices until the output, see COMPACT CELLS
+        self.addParameter(QgsProcessingParameterBoolean('CompactCells', 'Keep full CPA cells as grid indices', optional=True, defaultValue=False))
+        # Reclassify and zonal statistics over block windows of the raster, see WINDOWED RASTER
+        self.addParameter(QgsProcessingParameterBoolean('WindowedRaster', 'Read the resource raster in block windows', optional=True, defaultValue=False))
 
 
     def processAlgorithm(self, parameters, context, model_feedback):
         # Use a multi-step feedback, so that individual child algorithm progress reports are adjusted for the
-        # overall progress through the model
-        feedback = QgsProcessingMultiStepFeedback(32, model_feedback)
+        # overall progress through the model. It also times every step for the profiling report.
+        verbose = self.parameterAsBool(parameters, 'VERBOSE_LOG', context)
+        feedback = ProfilingFeedback(21, model_feedback, StepProfiler(), verbose)
         results = {}
         outputs = {}
-
-        # Repr Substations
-        alg_params = {
-            'INPUT': filepath+'5_transmissionAndInfrastructure/ENTSO_Substations/entso_substations.shp',
-            'OPERATION': '',
-            'TARGET_CRS': parameters['EuropeCRS'],
-            'OUTPUT': QgsProcessing.TEMPORARY_OUTPUT
-        }
-        outputs['ReprSubstations'] = processing.run('native:reprojectlayer', alg_params, context=context, feedback=feedback, is_child_algorithm=True)
-
-        feedback.setCurrentStep(1)
-        if feedback.isCanceled():
+        tile_size = self.parameterAsInt(parameters, 'TileSize', context)
+        previous = self.parameterAsVectorLayer(parameters, 'PreviousCpas', context)
+        previous_raster = self.parameterAsRasterLayer(parameters, 'PreviousRaster', context)
+        incremental = previous is not None and previous_raster is not None
+        if incremental and not tile_size:
+            tile_size = INCREMENTAL_TILE_SIZE
+        static_output = QgsProcessing.TEMPORARY_OUTPUT
+        tile_folder = None
+        if tile_size:
+            # Tile workers are separate processes, so the layers they share have to be on disk
+            tile_folder = tempfile.mkdtemp(prefix='cpa_tiles_', dir=QgsProcessingUtils.tempFolder())
+            static_output = os.path.join(tile_folder, '{}.gpkg')
+
+        checkpoint_folder = self.parameterAsFile(parameters, 'CheckpointFolder', context)
+        if checkpoint_folder and not tile_size and self.parameterAsEnum(parameters, 'CpaEngine', context) == ENGINE_VECTOR:
+            outputs['Checkpoints'] = {'OUTPUT': self.checkpointFolder(parameters, context, checkpoint_folder)}
+            if resume_step(dict(outputs)) >= 0:
+                model_feedback.pushInfo('Resuming from the checkpoints in {}'.format(outputs['Checkpoints']['OUTPUT']))
+
+        concurrent = self.parameterAsBool(parameters, 'ConcurrentStages', context) and not tile_size
+        if concurrent:
+            # The independent branches at the same time, then CPA geometry, substations and regions in order
+            if not self.concurrentStages(parameters, context, feedback, outputs):
+                return {}
+        elif self.warm is not None and not tile_size:
+            # Substations, boundaries and the substation index as the warm worker loaded them
+            name_step(feedback, 'Static layers (warm)')
+            static = self.warmStatic(parameters, context, feedback)
+            if static is None:
+                return {}
+            outputs.update(static)
+            feedback.setCurrentStep(3)
+            if feedback.isCanceled():
+                return {}
+        else:
+            # Substations, boundaries and the substation index (from the cache when possible)
+            if not self.staticLayers(parameters, context, feedback, outputs, static_output):
+                return {}
+
+            feedback.setCurrentStep(3)
+            if feedback.isCanceled():
+                return {}
+
+        # CPA geometry, resource area and mean CF, then substations and regions
+        if concurrent:
+            if 'RemoveCpasBelowCutoff' not in outputs and not self.gridedCpas(parameters, context, feedback, outputs):
+                return {}
+            if not self.joinCpas(parameters, context, feedback, outputs):
+                return {}
+        elif incremental:
+            outputs['CountryIdsToCpas'] = {'OUTPUT': self.incrementalCpas(parameters, context, feedback, outputs, tile_size, tile_folder, previous, previous_raster)}
+            if outputs['CountryIdsToCpas']['OUTPUT'] is None:
+                return {}
+        elif tile_size:
+            outputs['CountryIdsToCpas'] = {'OUTPUT': self.tiledCpas(parameters, context, feedback, outputs, tile_size, tile_folder)}
+            if outputs['CountryIdsToCpas']['OUTPUT'] is None:
+                return {}
+        elif not self.cpaGeometry(parameters, context, feedback, outputs) or not self.joinCpas(parameters, context, feedback, outputs):
             return {}
 
-        # Fix Substations
-        alg_params = {
-            'INPUT': outputs['ReprSubstations']['OUTPUT'],
-            'OUTPUT': QgsProcessing.TEMPORARY_OUTPUT
-        }
-        outputs['FixSubstations'] = processing.run('native:fixgeometries', alg_params, context=context, feedback=feedback, is_child_algorithm=True)
-
-        feedback.setCurrentStep(2)
+        feedback.setCurrentStep(19)
         if feedback.isCanceled():
             return {}
 
-        # Fixed Boundary Layer
-        alg_params = {
-            'INPUT': filepath+'3_geographicBoundaries/NUTS_2_Boundries/NUTS_RG_10M_2021_3857_LEVL_2.shp',
-            'OUTPUT': QgsProcessing.TEMPORARY_OUTPUT
-        }
-        outputs['FixedBoundaryLayer'] = processing.run('native:fixgeometries', alg_params, context=context, feedback=feedback, is_child_algorithm=True)
+        # Per-CPA cost inputs, saved for re-costing once the output path is known
+        cost_columns = read_cpa_inputs(QgsProcessingUtils.mapLayerFromString(outputs['CountryIdsToCpas']['OUTPUT'], context))
+
+        # CPA attributes
+        # CF, capacity, generation, costs, LCOE, Sub_NUTS_ID, CPA_ID and E37_CPA_ID in one vectorized pass.
+        columnar = columnar_driver(self.parameterAsOutputLayer(parameters, 'Cpas', context))
+        if self.parameterAsBool(parameters, 'Streaming', context) or columnar:
+            # Straight into the output without the working fields, which replaces Drop field(s)
+            name_step(feedback, 'CPA attributes, Drop field(s) ({})'.format(columnar or 'streamed'))
+            create_sink = lambda fields, wkb_type, crs: self.parameterAsSink(parameters, 'Cpas', context, fields, wkb_type, crs)
+            outputs['DropFields'] = {'OUTPUT': fuse_cpa_attributes(outputs['CountryIdsToCpas']['OUTPUT'], context, feedback, DROP_FIELDS, create_sink)}
+            note_step(feedback, context, {'INPUT': outputs['CountryIdsToCpas']['OUTPUT']}, {})
+            self.releaseOutputs(parameters, context, outputs, 'CountryIdsToCpas')
+            if outputs['DropFields']['OUTPUT'] is None:
+                return {}
+        else:
+            outputs['CpaAttributes'] = {'OUTPUT': fuse_cpa_attributes(outputs['CountryIdsToCpas']['OUTPUT'], context, feedback)}
+            note_step(feedback, context, {'INPUT': outputs['CountryIdsToCpas']['OUTPUT']}, outputs['CpaAttributes'])
+
+            feedback.setCurrentStep(20)
+            if feedback.isCanceled():
+                return {}
+
+            # Drop field(s)
+            alg_params = {
+                'COLUMN': DROP_FIELDS,
+                'INPUT': outputs['CpaAttributes']['OUTPUT'],
+                'OUTPUT': parameters['Cpas']
+            }
+            outputs['DropFields'] = run_child('qgis:deletecolumn', alg_params, context, feedback)
+        results['Cpas'] = outputs['DropFields']['OUTPUT']
 
-        feedback.setCurrentStep(3)
-        if feedback.isCanceled():
-            return {}
+        # Attribute table and supply curves, both from the attribute arrays
+        table_path = self.parameterAsFileOutput(parameters, 'AttributeTable', context)
+        curves_sink, curves_id = self.parameterAsSink(parameters, 'SupplyCurves', context, supply_curve_fields(), QgsWkbTypes.NoGeometry, QgsCoordinateReferenceSystem())
+        if table_path or curves_sink is not None:
+            table = recost(cost_columns)
+            if table_path:
+                results['AttributeTable'] = write_attribute_table(table_path, table)
+            if curves_sink is not None:
+                write_supply_curves(curves_sink, supply_curves(table, self.parameterAsDouble(parameters, 'SupplyCurveResolution', context)))
+                del curves_sink
+                results['SupplyCurves'] = curves_id
+
+        # Cost inputs for re-costing, and the profiling report
+        stem = self.outputStem(results['Cpas'])
+        cost_inputs = save_cpa_inputs(stem + '_cost_inputs.npz', cost_columns)
+        model_feedback.pushInfo('Cost inputs for re-costing: {}'.format(cost_inputs))
+        model_feedback.pushInfo('Peak memory: {} MB'.format(_peak_rss_mb()))
+        self.writeProfile(feedback.profiler, stem, verbose, model_feedback)
+        return results
 
-        # Reclassify by table
-        alg_params = {
-            'DATA_TYPE': 1,
-            'INPUT_RASTER': parameters['ResourceRaster'],
-            'NODATA_FOR_MISSING': False,
-            'NO_DATA': -9999,
-            'RANGE_BOUNDARIES': 0,
-            'RASTER_BAND': 1,
-            'TABLE': [0,100,1],
-            'OUTPUT': QgsProcessing.TEMPORARY_OUTPUT
+    def concurrentStages(self, parameters, context, feedback, outputs):
+        # Steps 0-10 (0-15 with the raster grid engine) as stages on the STAGE SCHEDULER. Fills outputs like
+        # staticLayers() followed by resourceMask(), cfGrid() and resourcePolygons() or rasterCpas().
+        # Returns False if the run was cancelled.
+        if self.parameterAsBool(parameters, 'ClearCache', context):
+            clear_cache()
+        # The boundaries are read by another stage's context, so they go to a file
+        static_output = os.path.join(tempfile.mkdtemp(prefix='cpa_stages_', dir=QgsProcessingUtils.tempFolder()), '{}.gpkg')
+        stages = [
+            Stage('Substations', [0, 1], [], ['FixSubstations', 'SubstationIndex'],
+                  lambda c, f, o: self.substationLayers(parameters, c, f, o, static_output)),
+            Stage('Boundaries', [2], [], ['FixedBoundaryLayer'],
+                  lambda c, f, o: self.boundaryLayer(parameters, c, f, o, static_output)),
+        ]
+        if self.parameterAsEnum(parameters, 'CpaEngine', context) == ENGINE_RASTER:
+            stages.append(Stage('Raster grid CPAs', list(range(3, 16)), ['FixedBoundaryLayer'], ['RemoveCpasBelowCutoff'],
+                                lambda c, f, o: self.rasterCpas(parameters, c, f, o)))
+        else:
+            if not self.gridPruned(parameters, context):
+                stages.append(Stage('CF grid', [4, 5], ['FixedBoundaryLayer'], ['FixGrid'],
+                                    lambda c, f, o: self.cfGrid(parameters, c, f, o)))
+            stages.append(Stage('Resource polygons', [3, 6, 7, 8, 9, 10], [key for key in ['Checkpoints'] if key in outputs], ['FixResourcePolys'],
+                                lambda c, f, o: (resume_step(o) >= 6 or self.resourceMask(parameters, c, f, o)) and self.resourcePolygons(parameters, c, f, o)))
+        name_step(feedback, 'Concurrent stages')
+        stage_outputs = run_stages(stages, context, feedback, self.parameterAsInt(parameters, 'Workers', context), outputs)
+        if stage_outputs is None:
+            return False
+        outputs.update(stage_outputs)
+        return True
+
+    def checkpointFolder(self, parameters, context, folder):
+        # The checkpoint folder of this run's fingerprint, with a note of what it was made from
+        raster = self.parameterAsRasterLayer(parameters, 'ResourceRaster', context)
+        grid_length = self.parameterAsInt(parameters, 'CPAGridLength', context)
+        grid_crs = context.project().crs() if context.project() else QgsCoordinateReferenceSystem()
+        settings = {
+            'EuropeCRS': crs_key(self.parameterAsCrs(parameters, 'EuropeCRS', context)),
+            'GeometryRepair': self.parameterAsEnum(parameters, 'GeometryRepair', context),
         }
-        outputs['ReclassifyByTable'] = processing.run('native:reclassifybytable', alg_params, context=context, feedback=feedback, is_child_algorithm=True)
+        for name in CHECKPOINT_PARAMETERS[2:]:
+            settings[name] = self.parameterAsBool(parameters, name, context)
+        fingerprint = checkpoint_fingerprint(raster.source(), grid_length, grid_crs, settings, self.parameterAsBool(parameters, 'UseCache', context))
+        run_folder = os.path.join(folder, fingerprint)
+        os.makedirs(run_folder, exist_ok=True)
+        with open(os.path.join(run_folder, 'checkpoint.json'), 'w') as note_file:
+            json.dump(dict(settings, ResourceRaster=raster.source(), CPAGridLength=grid_length, grid_crs=crs_key(grid_crs),
+                           steps={str(step): STEP_NAMES[step] for step in CHECKPOINT_STEPS}), note_file, indent=2)
+        return run_folder
+
+    def outputStem(self, output):
+        # Path without extension of a file output, for the files written next to it. Temp folder otherwise.
+        path = str(output).split('|')[0]
+        if os.path.isfile(path):
+            return os.path.splitext(path)[0]
+        return os.path.join(QgsProcessingUtils.tempFolder(), 'cpas')
+
+    def fixGeometries(self, parameters, context, feedback, source, output=QgsProcessing.TEMPORARY_OUTPUT, known_valid=False):
+        # A "Fix ..." step on source, written to output. Returns the result like a child algorithm.
+        if self.parameterAsEnum(parameters, 'GeometryRepair', context) == REPAIR_ALL:
+            alg_params = {
+                'INPUT': source,
+                'OUTPUT': output
+            }
+            return run_child('native:fixgeometries', alg_params, context, feedback)
+        if known_valid:
+            name_step(feedback, 'Fix skipped (valid by construction)')
+            if output == QgsProcessing.TEMPORARY_OUTPUT:
+                return {'OUTPUT': source}
+            return {'OUTPUT': stream_features(source, context, feedback, destination=output)}
+        name_step(feedback, 'Repair invalid geometries')
+        counts = repair_counts(REPAIR_INVALID)
+        dest_id = stream_features(source, context, feedback, fix=True, repair_counts=counts,
+                                  destination='memory:' if output == QgsProcessing.TEMPORARY_OUTPUT else output)
+        report_repairs(feedback, counts)
+        note_step(feedback, context, {'INPUT': source}, {'OUTPUT': dest_id})
+        return {'OUTPUT': dest_id}
+
+    def releaseOutputs(self, parameters, context, outputs, *keys):
+        # Streaming mode: free the temporary layers of outputs[keys] once the stage consuming them has finished,
+        # except the ones a warm worker keeps
+        if self.parameterAsBool(parameters, 'Streaming', context):
+            warm = self.warmSources()
+            release_layers(context, *(source for source in (outputs.pop(key, {}).get('OUTPUT') for key in keys) if source not in warm))
+
+    def warmSources(self):
+        # Layer ids and paths a warm worker keeps loaded
+        if self.warm is None:
+            return set()
+        static = [output for outputs in self.warm['static'].values() for output in outputs.values()]
+        return {output['OUTPUT'] for output in static + list(self.warm['grids'].values())}
+
+    def warmStatic(self, parameters, context, feedback):
+        # The warm worker's staticLayers() outputs for the job's NearestEngine, loaded by the first job that needs
+        # them. Returns None if the run was cancelled.
+        europe_crs = crs_key(self.parameterAsCrs(parameters, 'EuropeCRS', context))
+        if europe_crs != self.warm['crs']:
+            raise QgsProcessingException('The warm worker has its layers in {}, not in the EuropeCRS {} of the job'.format(self.warm['crs'], europe_crs))
+        nearest_engine = self.parameterAsEnum(parameters, 'NearestEngine', context)
+        if nearest_engine not in self.warm['static']:
+            static = {}
+            if not self.staticLayers(parameters, context, feedback, static):
+                return None
+            self.warm['static'][nearest_engine] = {key: self.warmKeep(output, context, load=key != 'SubstationIndex') for key, output in static.items()}
+        return self.warm['static'][nearest_engine]
+
+    def warmKeep(self, output, context, load=True):
+        # An output the warm worker keeps. A cache entry is copied into the worker's folder, so evicting or
+        # clearing the cache does not remove it, and layers are loaded now rather than in every job.
+        source = output['OUTPUT']
+        if isinstance(source, str) and os.path.isfile(source) and os.path.dirname(os.path.abspath(source)) == os.path.abspath(cache_folder()):
+            kept = os.path.join(self.warm['folder'], os.path.basename(source))
+            shutil.copyfile(source, kept)
+            source = kept
+        if load:
+            QgsProcessingUtils.mapLayerFromString(source, context)
+        return {'OUTPUT': source}
+
+    def writeProfile(self, profiler, stem, verbose, feedback):
+        # <output name>_profile.json/.csv
+        feedback.pushInfo('Profiling report: {}'.format(profiler.write(stem)))
+        if verbose:
+            feedback.pushInfo(profiler.summary())
+
+    def staticLayers(self, parameters, context, feedback, outputs, static_output=QgsProcessing.TEMPORARY_OUTPUT):
+        # Steps 0-2, which do not depend on the ResourceRaster. Fills outputs['FixSubstations'] and/or
+        # outputs['SubstationIndex'], and outputs['FixedBoundaryLayer']. Returns False if the run was cancelled.
+        if self.parameterAsBool(parameters, 'ClearCache', context):
+            clear_cache()
+        return (self.substationLayers(parameters, context, feedback, outputs, static_output)
+                and self.boundaryLayer(parameters, context, feedback, outputs, static_output))
+
+    def substationLayers(self, parameters, context, feedback, outputs, static_output=QgsProcessing.TEMPORARY_OUTPUT):
+        # Steps 0-1. Fills outputs['FixSubstations'] and/or outputs['SubstationIndex'].
+        # The cached substation index replaces "Repr Substations" and "Fix Substations" once it has been built
+        nearest_engine = self.parameterAsEnum(parameters, 'NearestEngine', context)
+        use_cache = self.parameterAsBool(parameters, 'UseCache', context)
+        index_path = None
+        if nearest_engine != NEAREST_JOIN:
+            if use_cache:
+                index_path = substation_index_path(SUBSTATIONS_SHP, self.parameterAsCrs(parameters, 'EuropeCRS', context))
+            else:
+                index_path = QgsProcessingUtils.generateTempFilename('substation_index.npz')
+            outputs['SubstationIndex'] = {'OUTPUT': index_path}
+        if cache_lookup(index_path) is None:
+            substations_cache = self.staticCachePath(parameters, context, 'fixed_substations', SUBSTATIONS_SHP)
+            if cache_lookup(substations_cache):
+                name_step(feedback, 'Fix Substations (cached)')
+                outputs['FixSubstations'] = {'OUTPUT': substations_cache}
+            else:
+                # Repr Substations
+                alg_params = {
+                    'INPUT': SUBSTATIONS_SHP,
+                    'OPERATION': '',
+                    'TARGET_CRS': parameters['EuropeCRS'],
+                    'OUTPUT': QgsProcessing.TEMPORARY_OUTPUT
+                }
+                outputs['ReprSubstations'] = run_child('native:reprojectlayer', alg_params, context, feedback)
+
+                feedback.setCurrentStep(1)
+                if feedback.isCanceled():
+                    return False
+
+                # Fix Substations
+                outputs['FixSubstations'] = self.fixGeometries(parameters, context, feedback, outputs['ReprSubstations']['OUTPUT'],
+                                                               partial_path(substations_cache) if substations_cache else static_output.format('substations'), known_valid=True)
+                if substations_cache:
+                    outputs['FixSubstations'] = {'OUTPUT': cache_store(outputs['FixSubstations']['OUTPUT'], substations_cache)}
+            if index_path is not None:
+                SubstationIndex.from_layer(QgsProcessingUtils.mapLayerFromString(outputs['FixSubstations']['OUTPUT'], context)).save(index_path)
+                if use_cache:
+                    evict_cache()
+        return True
+
+    def boundaryLayer(self, parameters, context, feedback, outputs, static_output=QgsProcessing.TEMPORARY_OUTPUT):
+        # Step 2. Fills outputs['FixedBoundaryLayer'].
+        feedback.setCurrentStep(2)
+        if feedback.isCanceled():
+            return False
 
+        # Fixed Boundary Layer
+        boundaries_cache = self.staticCachePath(parameters, context, 'fixed_boundaries', NUTS_SHP)
+        if cache_lookup(boundaries_cache):
+            name_step(feedback, 'Fixed Boundary Layer (cached)')
+            outputs['FixedBoundaryLayer'] = {'OUTPUT': boundaries_cache}
+        else:
+            outputs['FixedBoundaryLayer'] = self.fixGeometries(parameters, context, feedback, NUTS_SHP,
+                                                               partial_path(boundaries_cache) if boundaries_cache else static_output.format('boundaries'))
+            if boundaries_cache:
+                outputs['FixedBoundaryLayer'] = {'OUTPUT': cache_store(outputs['FixedBoundaryLayer']['OUTPUT'], boundaries_cache)}
+
+        return True
+
+    def cfGrid(self, parameters, context, feedback, outputs, extent=None, crs='ProjectCrs'):
+        # Steps 4-5, the CPA grid lines. Fills outputs['FixGrid'], returns False if the run was cancelled.
         feedback.setCurrentStep(4)
         if feedback.isCanceled():
-            return {}
-
-        # CF Grid
-        alg_params = {
-            'CRS': 'ProjectCrs',
-            'EXTENT': outputs['FixedBoundaryLayer']['OUTPUT'],
-            'HOVERLAY': 0,
-            'HSPACING': parameters['CPAGridLength'],
-            'TYPE': 1,
-            'VOVERLAY': 0,
-            'VSPACING': parameters['CPAGridLength'],
-            'OUTPUT': QgsProcessing.TEMPORARY_OUTPUT
-        }
-        outputs['CfGrid'] = processing.run('native:creategrid', alg_params, context=context, feedback=feedback, is_child_algorithm=True)
-
-        feedback.setCurrentStep(5)
+            return False
+
+        # The grid over the whole boundary extent only depends on the boundaries, the CRS and CPAGridLength
+        grid_length = self.parameterAsInt(parameters, 'CPAGridLength', context)
+        if extent is None and self.warm is not None and grid_length in self.warm['grids']:
+            name_step(feedback, 'Fix Grid (warm)')
+            outputs['FixGrid'] = self.warm['grids'][grid_length]
+            return True
+        grid_cache = None
+        if extent is None:
+            grid_crs = context.project().crs() if crs == 'ProjectCrs' and context.project() else QgsCoordinateReferenceSystem(crs)
+            grid_cache = self.staticCachePath(parameters, context, 'fixed_cf_grid', NUTS_SHP, grid_length, crs_key(grid_crs))
+        if cache_lookup(grid_cache):
+            name_step(feedback, 'Fix Grid (cached)')
+            outputs['FixGrid'] = {'OUTPUT': grid_cache}
+        else:
+            # CF Grid
+            alg_params = {
+                'CRS': crs,
+                'EXTENT': extent or outputs['FixedBoundaryLayer']['OUTPUT'],
+                'HOVERLAY': 0,
+                'HSPACING': parameters['CPAGridLength'],
+                'TYPE': 1,
+                'VOVERLAY': 0,
+                'VSPACING': parameters['CPAGridLength'],
+                'OUTPUT': QgsProcessing.TEMPORARY_OUTPUT
+            }
+            outputs['CfGrid'] = run_child('native:creategrid', alg_params, context, feedback)
+
+            feedback.setCurrentStep(5)
+            if feedback.isCanceled():
+                return False
+
+            # Fix Grid
+            outputs['FixGrid'] = self.fixGeometries(parameters, context, feedback, outputs['CfGrid']['OUTPUT'],
+                                                    partial_path(grid_cache) if grid_cache else QgsProcessing.TEMPORARY_OUTPUT, known_valid=True)
+            if grid_cache:
+                outputs['FixGrid'] = {'OUTPUT': cache_store(outputs['FixGrid']['OUTPUT'], grid_cache)}
+
+        if extent is None and self.warm is not None:
+            outputs['FixGrid'] = self.warm['grids'][grid_length] = self.warmKeep(outputs['FixGrid'], context)
+        return True
+
+    def joinCpas(self, parameters, context, feedback, outputs, output=QgsProcessing.TEMPORARY_OUTPUT):
+        # Nearest substation, NUTS_ID and CNTR_CODE for the CPAs in outputs['RemoveCpasBelowCutoff'].
+        # Uses outputs['FixSubstations'] for the nearest neighbour join, outputs['SubstationIndex'] otherwise.
+        # Fills outputs up to 'CountryIdsToCpas', returns False if the run was cancelled.
+        feedback.setCurrentStep(16)
         if feedback.isCanceled():
-            return {}
-
-        # Fix Grid
-        alg_params = {
-            'INPUT': outputs['CfGrid']['OUTPUT'],
-            'OUTPUT': QgsProcessing.TEMPORARY_OUTPUT
-        }
-        outputs['FixGrid'] = processing.run('native:fixgeometries', alg_params, context=context, feedback=feedback, is_child_algorithm=True)
+            return False
 
-        feedback.setCurrentStep(6)
-        if feedback.isCanceled():
-            return {}
+        # Distance to substations
+        if self.parameterAsEnum(parameters, 'NearestEngine', context) != NEAREST_JOIN:
+            index = SubstationIndex.load(outputs['SubstationIndex']['OUTPUT'])
+            exact = self.parameterAsEnum(parameters, 'NearestEngine', context) == NEAREST_GEOMETRY
+            name_step(feedback, 'Distance to substations (cached index)')
+            outputs['DistanceToSubstations'] = {'OUTPUT': nearest_substations(outputs['RemoveCpasBelowCutoff']['OUTPUT'], index, exact, context, feedback)}
+            note_step(feedback, context, {'INPUT': outputs['RemoveCpasBelowCutoff']['OUTPUT']}, outputs['DistanceToSubstations'])
+            self.releaseOutputs(parameters, context, outputs, 'RemoveCpasBelowCutoff')
+            return self.regionCpas(parameters, context, feedback, outputs, output)
 
-        # Polygonize (raster to vector)
         alg_params = {
-            'BAND': 1,
-            'EIGHT_CONNECTEDNESS': False,
-            'EXTRA': '',
-            'FIELD': 'DN',
-            'INPUT': outputs['ReclassifyByTable']['OUTPUT'],
+            'DISCARD_NONMATCHING': True,
+            'FIELDS_TO_COPY': ['Sub_ID'],
+            'INPUT': outputs['RemoveCpasBelowCutoff']['OUTPUT'],
+            'INPUT_2': outputs['FixSubstations']['OUTPUT'],
+            'MAX_DISTANCE': None,
+            'NEIGHBORS': 1,
+            'PREFIX': '',
             'OUTPUT': QgsProcessing.TEMPORARY_OUTPUT
         }
-        outputs['PolygonizeRasterToVector'] = processing.run('gdal:polygonize', alg_params, context=context, feedback=feedback, is_child_algorithm=True)
+        outputs['DistanceToSubstations'] = run_child('native:joinbynearest', alg_params, context, feedback)
+        self.releaseOutputs(parameters, context, outputs, 'RemoveCpasBelowCutoff')
+        return self.regionCpas(parameters, context, feedback, outputs, output)
 
-        feedback.setCurrentStep(7)
+    def regionCpas(self, parameters, context, feedback, outputs, output=QgsProcessing.TEMPORARY_OUTPUT):
+        # NUTS_ID and CNTR_CODE for the CPAs in outputs['DistanceToSubstations'].
+        # Fills outputs up to 'CountryIdsToCpas', returns False if the run was cancelled.
+        feedback.setCurrentStep(17)
         if feedback.isCanceled():
-            return {}
+            return False
+
+        # NUTS IDs and COUNTRY IDs to CPAs in one pass
+        region_engine = self.parameterAsEnum(parameters, 'RegionEngine', context)
+        if region_engine != REGION_OVERLAYS:
+            source = outputs['DistanceToSubstations']['OUTPUT']
+            crs = QgsProcessingUtils.mapLayerFromString(source, context).crs()
+            boundaries = QgsProcessingUtils.mapLayerFromString(outputs['FixedBoundaryLayer']['OUTPUT'], context)
+            index = RegionIndex(boundaries, crs, context.transformContext())
+            destination = 'memory:' if output == QgsProcessing.TEMPORARY_OUTPUT else output
+            name_step(feedback, 'Regions to CPAs (spatial index)')
+            outputs['CountryIdsToCpas'] = {'OUTPUT': assign_regions(source, index, region_engine, context, feedback, destination)}
+            note_step(feedback, context, {'INPUT': source}, outputs['CountryIdsToCpas'])
+            self.releaseOutputs(parameters, context, outputs, 'DistanceToSubstations')
+            return outputs['CountryIdsToCpas']['OUTPUT'] is not None
 
-        # Add x field
+        # NUTS IDs to CPAs
         alg_params = {
-            'FIELD_LENGTH': 1,
-            'FIELD_NAME': 'x',
-            'FIELD_PRECISION': 0,
-            'FIELD_TYPE': 1,
-            'FORMULA': '1',
-            'INPUT': outputs['PolygonizeRasterToVector']['OUTPUT'],
+            'INPUT': outputs['DistanceToSubstations']['OUTPUT'],
+            'INPUT_FIELDS': [''],
+            'OVERLAY': outputs['FixedBoundaryLayer']['OUTPUT'],
+            'OVERLAY_FIELDS': ['NUTS_ID'],
+            'OVERLAY_FIELDS_PREFIX': '',
             'OUTPUT': QgsProcessing.TEMPORARY_OUTPUT
         }
-        outputs['AddXField'] = processing.run('native:fieldcalculator', alg_params, context=context, feedback=feedback, is_child_algorithm=True)
+        outputs['NutsIdsToCpas'] = run_child('native:intersection', alg_params, context, feedback)
+        self.releaseOutputs(parameters, context, outputs, 'DistanceToSubstations')
 
-        feedback.setCurrentStep(8)
+        feedback.setCurrentStep(18)
         if feedback.isCanceled():
-            return {}
+            return False
 
-        # Fix polys
+        # COUNTRY IDs to CPAs
         alg_params = {
-            'INPUT': outputs['AddXField']['OUTPUT'],
-            'OUTPUT': QgsProcessing.TEMPORARY_OUTPUT
+            'INPUT': outputs['NutsIdsToCpas']['OUTPUT'],
+            'INPUT_FIELDS': [''],
+            'OVERLAY': NUTS_SHP,
+            'OVERLAY_FIELDS': ['CNTR_CODE'],
+            'OVERLAY_FIELDS_PREFIX': '',
+            'OUTPUT': output
         }
-        outputs['FixPolys'] = processing.run('native:fixgeometries', alg_params, context=context, feedback=feedback, is_child_algorithm=True)
-
-        feedback.setCurrentStep(9)
+        outputs['CountryIdsToCpas'] = run_child('native:intersection', alg_params, context, feedback)
+        self.releaseOutputs(parameters, context, outputs, 'NutsIdsToCpas')
+
+        return True
+
+    def cpaGeometry(self, parameters, context, feedback, outputs, extent=None, crs='ProjectCrs'):
+        # Dispatch to the selected CPA geometry engine. extent/crs restrict the CPA grid (tiled runs).
+        if self.parameterAsEnum(parameters, 'CpaEngine', context) == ENGINE_RASTER:
+            return self.rasterCpas(parameters, context, feedback, outputs)
+        return self.vectorCpas(parameters, context, feedback, outputs, extent, crs)
+
+    def vectorCpas(self, parameters, context, feedback, outputs, extent=None, crs='ProjectCrs'):
+        # Reference geometry path: reclassify, polygonize, dissolve and split the resource with the CPA grid lines.
+        # Fills outputs up to 'RemoveCpasBelowCutoff', returns False if the run was cancelled.
+        # A run resumed from a checkpoint (see CHECKPOINTS) skips the steps before it.
+        resume = resume_step(outputs)
+        pruned = self.gridPruned(parameters, context)
+        return ((resume >= 6 or self.resourceMask(parameters, context, feedback, outputs))
+                and (resume >= 11 or pruned or self.cfGrid(parameters, context, feedback, outputs, extent, crs))
+                and self.resourcePolygons(parameters, context, feedback, outputs)
+                and self.gridedCpas(parameters, context, feedback, outputs))
+
+    def resourceMask(self, parameters, context, feedback, outputs):
+        # Step 3, the resource as a 0/1 raster. Fills outputs['ReclassifyByTable'].
+        feedback.setCurrentStep(3)
         if feedback.isCanceled():
-            return {}
+            return False
+
+        # Reclassify by table
+        if self.parameterAsBool(parameters, 'WindowedRaster', context):
+            name_step(feedback, 'Reclassify by table (windowed)')
+            raster = self.parameterAsRasterLayer(parameters, 'ResourceRaster', context)
+            outputs['ReclassifyByTable'] = {'OUTPUT': resource_mask(raster.source(), QgsProcessingUtils.generateTempFilename('resource_mask.tif'), feedback)}
+            note_step(feedback, context, {'INPUT_RASTER': raster.source()}, outputs['ReclassifyByTable'])
+            return outputs['ReclassifyByTable']['OUTPUT'] is not None
 
-        # Dissolve
         alg_params = {
-            'FIELD': ['x'],
-            'INPUT': outputs['FixPolys']['OUTPUT'],
+            'DATA_TYPE': 1,
+            'INPUT_RASTER': parameters['ResourceRaster'],
+            'NODATA_FOR_MISSING': False,
+            'NO_DATA': -9999,
+            'RANGE_BOUNDARIES': 0,
+            'RASTER_BAND': 1,
+            'TABLE': [0,100,1],
             'OUTPUT': QgsProcessing.TEMPORARY_OUTPUT
         }
-        outputs['Dissolve'] = processing.run('native:dissolve', alg_params, context=context, feedback=feedback, is_child_algorithm=True)
+        outputs['ReclassifyByTable'] = run_child('native:reclassifybytable', alg_params, context, feedback)
+        return True
+
+    def resourcePolygons(self, parameters, context, feedback, outputs):
+        # Steps 6-10, the dissolved resource polygons of outputs['ReclassifyByTable']. Fills outputs['FixResourcePolys'].
+        streaming = self.parameterAsBool(parameters, 'Streaming', context)
+        resume = resume_step(outputs)
+        if resume >= 11:
+            return True
+
+        if resume < 6:
+            feedback.setCurrentStep(6)
+            if feedback.isCanceled():
+                return False
+
+            # Polygonize (raster to vector)
+            alg_params = {
+                'BAND': 1,
+                'EIGHT_CONNECTEDNESS': False,
+                'EXTRA': '',
+                'FIELD': 'DN',
+                'INPUT': outputs['ReclassifyByTable']['OUTPUT'],
+                'OUTPUT': checkpoint_output(outputs, 6)
+            }
+            outputs['PolygonizeRasterToVector'] = run_child('gdal:polygonize', alg_params, context, feedback)
+            checkpoint_store(outputs, 6, feedback)
+
+        if resume < 9:
+            feedback.setCurrentStep(7)
+            if feedback.isCanceled():
+                return False
+
+            if streaming:
+                # Add x field and Fix polys in one pass
+                name_step(feedback, 'Add x field, Fix polys (streamed)')
+                x_field = (QgsField('x', QVariant.Int, '', 1, 0), lambda feature: 1)
+                counts = repair_counts(self.parameterAsEnum(parameters, 'GeometryRepair', context))
+                outputs['FixPolys'] = {'OUTPUT': stream_features(outputs['PolygonizeRasterToVector']['OUTPUT'], context, feedback, fix=True, add_fields=[x_field], repair_counts=counts)}
+                report_repairs(feedback, counts)
+                note_step(feedback, context, {'INPUT': outputs['PolygonizeRasterToVector']['OUTPUT']}, outputs['FixPolys'])
+                self.releaseOutputs(parameters, context, outputs, 'ReclassifyByTable', 'PolygonizeRasterToVector')
+                if outputs['FixPolys']['OUTPUT'] is None:
+                    return False
+            else:
+                # Add x field
+                alg_params = {
+                    'FIELD_LENGTH': 1,
+                    'FIELD_NAME': 'x',
+                    'FIELD_PRECISION': 0,
+                    'FIELD_TYPE': 1,
+                    'FORMULA': '1',
+                    'INPUT': outputs['PolygonizeRasterToVector']['OUTPUT'],
+                    'OUTPUT': QgsProcessing.TEMPORARY_OUTPUT
+                }
+                outputs['AddXField'] = run_child('native:fieldcalculator', alg_params, context, feedback)
+
+                feedback.setCurrentStep(8)
+                if feedback.isCanceled():
+                    return False
+
+                # Fix polys
+                outputs['FixPolys'] = self.fixGeometries(parameters, context, feedback, outputs['AddXField']['OUTPUT'])
+
+            feedback.setCurrentStep(9)
+            if feedback.isCanceled():
+                return False
+
+            # Dissolve
+            alg_params = {
+                'FIELD': ['x'],
+                'INPUT': outputs['FixPolys']['OUTPUT'],
+                'OUTPUT': checkpoint_output(outputs, 9)
+            }
+            outputs['Dissolve'] = run_child('native:dissolve', alg_params, context, feedback)
+            checkpoint_store(outputs, 9, feedback)
+            self.releaseOutputs(parameters, context, outputs, 'FixPolys')
 
         feedback.setCurrentStep(10)
         if feedback.isCanceled():
-            return {}
+            return False
 
         # Fix Resource Polys
-        alg_params = {
-            'INPUT': outputs['Dissolve']['OUTPUT'],
-            'OUTPUT': QgsProcessing.TEMPORARY_OUTPUT
-        }
-        outputs['FixResourcePolys'] = processing.run('native:fixgeometries', alg_params, context=context, feedback=feedback, is_child_algorithm=True)
-
-        feedback.setCurrentStep(11)
-        if feedback.isCanceled():
-            return {}
-
-        # Grided Resource
-        # Create CPA grid by splitting the resource polygons with the grid lines.
-        alg_params = {
-            'INPUT': outputs['FixResourcePolys']['OUTPUT'],
-            'LINES': outputs['FixGrid']['OUTPUT'],
-            'OUTPUT': QgsProcessing.TEMPORARY_OUTPUT
-        }
-        outputs['GridedResource'] = processing.run('native:splitwithlines', alg_params, context=context, feedback=feedback, is_child_algorithm=True)
-
-        feedback.setCurrentStep(12)
-        if feedback.isCanceled():
-            return {}
-
-        # Resource with CF
-        # Assign a sample mean of the underlying CF raster to the created polygons.
-        alg_params = {
-            'COLUMN_PREFIX': 'CF_',
-            'INPUT': outputs['GridedResource']['OUTPUT'],
-            'INPUT_RASTER': parameters['ResourceRaster'],
-            'RASTER_BAND': 1,
-            'STATISTICS': [2],
-            'OUTPUT': QgsProcessing.TEMPORARY_OUTPUT
-        }
-        outputs['ResourceWithCf'] = processing.run('native:zonalstatisticsfb', alg_params, context=context, feedback=feedback, is_child_algorithm=True)
+        if streaming:
+            name_step(feedback, 'Fix Resource Polys (streamed)')
+            counts = repair_counts(self.parameterAsEnum(parameters, 'GeometryRepair', context))
+            outputs['FixResourcePolys'] = {'OUTPUT': stream_features(outputs['Dissolve']['OUTPUT'], context, feedback, fix=True, repair_counts=counts)}
+            report_repairs(feedback, counts)
+            note_step(feedback, context, {'INPUT': outputs['Dissolve']['OUTPUT']}, outputs['FixResourcePolys'])
+            self.releaseOutputs(parameters, context, outputs, 'Dissolve')
+            if outputs['FixResourcePolys']['OUTPUT'] is None:
+                return False
+        else:
+            outputs['FixResourcePolys'] = self.fixGeometries(parameters, context, feedback, outputs['Dissolve']['OUTPUT'])
+        return True
+
+    def gridedCpas(self, parameters, context, feedback, outputs):
+        # Steps 11-15, split with outputs['FixGrid'] (or the grid cells, with GridPruning), mean CF, area and cutoff.
+        # Fills outputs['RemoveCpasBelowCutoff'].
+        streaming = self.parameterAsBool(parameters, 'Streaming', context)
+        resume = resume_step(outputs)
+        if resume < 11 and self.parameterAsBool(parameters, 'CompactCells', context):
+            return self.compactCpas(parameters, context, feedback, outputs)
+        if resume < 11:
+            feedback.setCurrentStep(11)
+            if feedback.isCanceled():
+                return False
+
+            # Grided Resource
+            # Create CPA grid by splitting the resource polygons with the grid lines.
+            if self.parameterAsBool(parameters, 'GridPruning', context):
+                name_step(feedback, 'Grided Resource (grid split)')
+                source = outputs['FixResourcePolys']['OUTPUT']
+                origin = self.gridOrigin(outputs, QgsProcessingUtils.mapLayerFromString(source, context).crs(), context)
+                output = checkpoint_output(outputs, 11)
+                outputs['GridedResource'] = {'OUTPUT': grid_split(source, origin, self.parameterAsInt(parameters, 'CPAGridLength', context), context, feedback,
+                                                                  'memory:' if output == QgsProcessing.TEMPORARY_OUTPUT else output)}
+                note_step(feedback, context, {'INPUT': source}, outputs['GridedResource'])
+                if outputs['GridedResource']['OUTPUT'] is None:
+                    return False
+            else:
+                alg_params = {
+                    'INPUT': outputs['FixResourcePolys']['OUTPUT'],
+                    'LINES': outputs['FixGrid']['OUTPUT'],
+                    'OUTPUT': checkpoint_output(outputs, 11)
+                }
+                outputs['GridedResource'] = run_child('native:splitwithlines', alg_params, context, feedback)
+            checkpoint_store(outputs, 11, feedback)
+            self.releaseOutputs(parameters, context, outputs, 'FixResourcePolys', 'FixGrid')
+
+        if resume < 12:
+            feedback.setCurrentStep(12)
+            if feedback.isCanceled():
+                return False
+
+            # Resource with CF
+            # Assign a sample mean of the underlying CF raster to the created polygons.
+            if self.parameterAsBool(parameters, 'WindowedRaster', context):
+                name_step(feedback, 'Resource with CF (windowed)')
+                raster = self.parameterAsRasterLayer(parameters, 'ResourceRaster', context)
+                output = checkpoint_output(outputs, 12)
+                outputs['ResourceWithCf'] = {'OUTPUT': zonal_means(outputs['GridedResource']['OUTPUT'], raster.source(), context, feedback,
+                                                                   'memory:' if output == QgsProcessing.TEMPORARY_OUTPUT else output)}
+                note_step(feedback, context, {'INPUT': outputs['GridedResource']['OUTPUT'], 'INPUT_RASTER': raster.source()}, outputs['ResourceWithCf'])
+                if outputs['ResourceWithCf']['OUTPUT'] is None:
+                    return False
+            else:
+                alg_params = {
+                    'COLUMN_PREFIX': 'CF_',
+                    'INPUT': outputs['GridedResource']['OUTPUT'],
+                    'INPUT_RASTER': parameters['ResourceRaster'],
+                    'RASTER_BAND': 1,
+                    'STATISTICS': [2],
+                    'OUTPUT': checkpoint_output(outputs, 12)
+                }
+                outputs['ResourceWithCf'] = run_child('native:zonalstatisticsfb', alg_params, context, feedback)
+            checkpoint_store(outputs, 12, feedback)
+            self.releaseOutputs(parameters, context, outputs, 'GridedResource')
 
         feedback.setCurrentStep(13)
         if feedback.isCanceled():
-            return {}
+            return False
+
+        if streaming:
+            # Fix CF Polys, Calc: resource area polygon and Remove CPAs below cutoff in one pass
+            name_step(feedback, 'Fix CF Polys, SqKm, cutoff (streamed)')
+            crs = self.parameterAsRasterLayer(parameters, 'ResourceRaster', context).crs()
+            sqkm_field = (QgsField('SqKm', QVariant.Double, '', 10, 7), area_sqkm(crs, context))
+            counts = repair_counts(self.parameterAsEnum(parameters, 'GeometryRepair', context))
+            outputs['RemoveCpasBelowCutoff'] = {'OUTPUT': stream_features(outputs['ResourceWithCf']['OUTPUT'], context, feedback, fix=True, add_fields=[sqkm_field],
+                                                                          keep=lambda feature: feature['SqKm'] > MIN_CPA_SQKM, repair_counts=counts)}
+            report_repairs(feedback, counts)
+            note_step(feedback, context, {'INPUT': outputs['ResourceWithCf']['OUTPUT']}, outputs['RemoveCpasBelowCutoff'])
+            self.releaseOutputs(parameters, context, outputs, 'ResourceWithCf')
+            return outputs['RemoveCpasBelowCutoff']['OUTPUT'] is not None
 
-        # Corrected CF
-        alg_params = {
-            'FIELD_LENGTH': 0,
-            'FIELD_NAME': 'CF',
-            'FIELD_PRECISION': 0,
-            'FIELD_TYPE': 0,
-            'FORMULA': '\"CF_mean\" * 0.85',
-            'INPUT': outputs['ResourceWithCf']['OUTPUT'],
-            'OUTPUT': QgsProcessing.TEMPORARY_OUTPUT
-        }
-        outputs['CorrectedCf'] = processing.run('native:fieldcalculator', alg_params, context=context, feedback=feedback, is_child_algorithm=True)
+        # Fix CF Polys
+        outputs['FixCfPolys'] = self.fixGeometries(parameters, context, feedback, outputs['ResourceWithCf']['OUTPUT'])
 
         feedback.setCurrentStep(14)
         if feedback.isCanceled():
-            return {}
-
-        # Fix CF Polys
-        alg_params = {
-            'INPUT': outputs['CorrectedCf']['OUTPUT'],
-            'OUTPUT': QgsProcessing.TEMPORARY_OUTPUT
-        }
-        outputs['FixCfPolys'] = processing.run('native:fixgeometries', alg_params, context=context, feedback=feedback, is_child_algorithm=True)
-
-        feedback.setCurrentStep(15)
-        if feedback.isCanceled():
-            return {}
+            return False
 
         # Calc: resource area polygon
+        # Area is measured before the NUTS overlays, so CPAs split at region borders keep the area of the whole cell.
         alg_params = {
             'FIELD_LENGTH': 10,
             'FIELD_NAME': 'SqKm',
@@ -267,258 +3398,182 @@ class CpasOnwind(QgsProcessingAlgorithm):
             'INPUT': outputs['FixCfPolys']['OUTPUT'],
             'OUTPUT': QgsProcessing.TEMPORARY_OUTPUT
         }
-        outputs['CalcResourceAreaPolygon'] = processing.run('native:fieldcalculator', alg_params, context=context, feedback=feedback, is_child_algorithm=True)
+        outputs['CalcResourceAreaPolygon'] = run_child('native:fieldcalculator', alg_params, context, feedback)
 
-        feedback.setCurrentStep(16)
+        feedback.setCurrentStep(15)
         if feedback.isCanceled():
-            return {}
+            return False
 
         # Remove CPAs below cutoff
         alg_params = {
             'FIELD': 'SqKm',
             'INPUT': outputs['CalcResourceAreaPolygon']['OUTPUT'],
             'OPERATOR': 2,
-            'VALUE': '0.5',
-            'OUTPUT': QgsProcessing.TEMPORARY_OUTPUT
-        }
-        outputs['RemoveCpasBelowCutoff'] = processing.run('native:extractbyattribute', alg_params, context=context, feedback=feedback, is_child_algorithm=True)
-
-        feedback.setCurrentStep(17)
-        if feedback.isCanceled():
-            return {}
-
-        # Calc: Nameplate Capacity
-        alg_params = {
-            'FIELD_LENGTH': 15,
-            'FIELD_NAME': 'Name_cap',
-            'FIELD_PRECISION': 6,
-            'FIELD_TYPE': 0,
-            'FORMULA': '\"SqKm\" * 5',
-            'INPUT': outputs['RemoveCpasBelowCutoff']['OUTPUT'],
+            'VALUE': str(MIN_CPA_SQKM),
             'OUTPUT': QgsProcessing.TEMPORARY_OUTPUT
         }
-        outputs['CalcNameplateCapacity'] = processing.run('native:fieldcalculator', alg_params, context=context, feedback=feedback, is_child_algorithm=True)
-
-        feedback.setCurrentStep(18)
-        if feedback.isCanceled():
-            return {}
+        outputs['RemoveCpasBelowCutoff'] = run_child('native:extractbyattribute', alg_params, context, feedback)
 
-        # Total GW
-        alg_params = {
-            'FIELD_LENGTH': 10,
-            'FIELD_NAME': 'Name_cap_gw',
-            'FIELD_PRECISION': 5,
-            'FIELD_TYPE': 0,
-            'FORMULA': '\"Name_cap\"/1000',
-            'INPUT': outputs['CalcNameplateCapacity']['OUTPUT'],
-            'OUTPUT': QgsProcessing.TEMPORARY_OUTPUT
-        }
-        outputs['TotalGw'] = processing.run('native:fieldcalculator', alg_params, context=context, feedback=feedback, is_child_algorithm=True)
-
-        feedback.setCurrentStep(19)
-        if feedback.isCanceled():
-            return {}
-
-        # Calc: Annual Generation
-        alg_params = {
-            'FIELD_LENGTH': 20,
-            'FIELD_NAME': 'An_gen',
-            'FIELD_PRECISION': 3,
-            'FIELD_TYPE': 0,
-            'FORMULA': '\"Name_cap\" * 8760 *\"CF\"',
-            'INPUT': outputs['TotalGw']['OUTPUT'],
-            'OUTPUT': QgsProcessing.TEMPORARY_OUTPUT
-        }
-        outputs['CalcAnnualGeneration'] = processing.run('native:fieldcalculator', alg_params, context=context, feedback=feedback, is_child_algorithm=True)
-
-        feedback.setCurrentStep(20)
-        if feedback.isCanceled():
-            return {}
+        return True
 
-        # Calc: Plant Capital Cost
-        alg_params = {
-            'FIELD_LENGTH': 20,
-            'FIELD_NAME': 'Plant_cost',
-            'FIELD_PRECISION': 3,
-            'FIELD_TYPE': 0,
-            'FORMULA': '\"Name_cap\" * 1480024',
-            'INPUT': outputs['CalcAnnualGeneration']['OUTPUT'],
-            'OUTPUT': QgsProcessing.TEMPORARY_OUTPUT
-        }
-        outputs['CalcPlantCapitalCost'] = processing.run('native:fieldcalculator', alg_params, context=context, feedback=feedback, is_child_algorithm=True)
-
-        feedback.setCurrentStep(21)
-        if feedback.isCanceled():
-            return {}
-
-        # Distance to substations
-        alg_params = {
-            'DISCARD_NONMATCHING': True,
-            'FIELDS_TO_COPY': ['Sub_ID'],
-            'INPUT': outputs['CalcPlantCapitalCost']['OUTPUT'],
-            'INPUT_2': outputs['FixSubstations']['OUTPUT'],
-            'MAX_DISTANCE': None,
-            'NEIGHBORS': 1,
-            'PREFIX': '',
-            'OUTPUT': QgsProcessing.TEMPORARY_OUTPUT
-        }
-        outputs['DistanceToSubstations'] = processing.run('native:joinbynearest', alg_params, context=context, feedback=feedback, is_child_algorithm=True)
-
-        feedback.setCurrentStep(22)
-        if feedback.isCanceled():
-            return {}
-
-        # Calc: Interconnection Cost
-        alg_params = {
-            'FIELD_LENGTH': 10,
-            'FIELD_NAME': 'Inter_cost',
-            'FIELD_PRECISION': 3,
-            'FIELD_TYPE': 0,
-            'FORMULA': '517056 * (\"distance\"/1000)',
-            'INPUT': outputs['DistanceToSubstations']['OUTPUT'],
-            'OUTPUT': QgsProcessing.TEMPORARY_OUTPUT
-        }
-        outputs['CalcInterconnectionCost'] = processing.run('native:fieldcalculator', alg_params, context=context, feedback=feedback, is_child_algorithm=True)
-
-        feedback.setCurrentStep(23)
-        if feedback.isCanceled():
-            return {}
-
-        # Calc: Total Capital Cost
-        alg_params = {
-            'FIELD_LENGTH': 10,
-            'FIELD_NAME': 'Total_cost',
-            'FIELD_PRECISION': 3,
-            'FIELD_TYPE': 0,
-            'FORMULA': '\"Plant_cost\" + \"Inter_cost\"',
-            'INPUT': outputs['CalcInterconnectionCost']['OUTPUT'],
-            'OUTPUT': QgsProcessing.TEMPORARY_OUTPUT
-        }
-        outputs['CalcTotalCapitalCost'] = processing.run('native:fieldcalculator', alg_params, context=context, feedback=feedback, is_child_algorithm=True)
-
-        feedback.setCurrentStep(24)
-        if feedback.isCanceled():
-            return {}
-
-        # Calc: Annual Payments
-        alg_params = {
-            'FIELD_LENGTH': 10,
-            'FIELD_NAME': 'An_payments',
-            'FIELD_PRECISION': 3,
-            'FIELD_TYPE': 0,
-            'FORMULA': '\"Total_cost\" * 0.073',
-            'INPUT': outputs['CalcTotalCapitalCost']['OUTPUT'],
-            'OUTPUT': QgsProcessing.TEMPORARY_OUTPUT
-        }
-        outputs['CalcAnnualPayments'] = processing.run('native:fieldcalculator', alg_params, context=context, feedback=feedback, is_child_algorithm=True)
-
-        feedback.setCurrentStep(25)
+    def compactCpas(self, parameters, context, feedback, outputs):
+        # Steps 11-15 on a GridCpas, see COMPACT CELLS. Fills outputs['RemoveCpasBelowCutoff'].
+        feedback.setCurrentStep(11)
         if feedback.isCanceled():
-            return {}
+            return False
 
-        # Calc: LCOE
-        alg_params = {
-            'FIELD_LENGTH': 10,
-            'FIELD_NAME': 'LCOE',
-            'FIELD_PRECISION': 3,
-            'FIELD_TYPE': 0,
-            'FORMULA': '\"An_payments\" / \"An_gen\"',
-            'INPUT': outputs['CalcAnnualPayments']['OUTPUT'],
-            'OUTPUT': QgsProcessing.TEMPORARY_OUTPUT
-        }
-        outputs['CalcLcoe'] = processing.run('native:fieldcalculator', alg_params, context=context, feedback=feedback, is_child_algorithm=True)
+        # Grided Resource
+        name_step(feedback, 'Grided Resource (compact)')
+        source = outputs['FixResourcePolys']['OUTPUT']
+        crs = QgsProcessingUtils.mapLayerFromString(source, context).crs()
+        cpas = grid_cells(source, self.gridOrigin(outputs, crs, context), self.parameterAsInt(parameters, 'CPAGridLength', context), context, feedback)
+        if cpas is None:
+            return False
+        count_step(feedback, 'full_cells', len(cpas.full))
+        count_step(feedback, 'pieces', len(cpas.pieces))
+        self.releaseOutputs(parameters, context, outputs, 'FixResourcePolys')
 
-        feedback.setCurrentStep(26)
+        feedback.setCurrentStep(12)
         if feedback.isCanceled():
-            return {}
+            return False
 
-        # NUTS IDs to CPAs
-        alg_params = {
-            'INPUT': outputs['CalcLcoe']['OUTPUT'],
-            'INPUT_FIELDS': [''],
-            'OVERLAY': outputs['FixedBoundaryLayer']['OUTPUT'],
-            'OVERLAY_FIELDS': ['NUTS_ID'],
-            'OVERLAY_FIELDS_PREFIX': '',
-            'OUTPUT': QgsProcessing.TEMPORARY_OUTPUT
-        }
-        outputs['NutsIdsToCpas'] = processing.run('native:intersection', alg_params, context=context, feedback=feedback, is_child_algorithm=True)
+        # Resource with CF
+        name_step(feedback, 'Resource with CF (compact)')
+        if not cell_means(cpas, self.parameterAsRasterLayer(parameters, 'ResourceRaster', context).source(), feedback):
+            return False
 
-        feedback.setCurrentStep(27)
+        feedback.setCurrentStep(13)
         if feedback.isCanceled():
-            return {}
+            return False
 
-        # Create Substatiuon NUTS_ID
-        alg_params = {
-            'FIELD_LENGTH': 0,
-            'FIELD_NAME': 'Sub_NUTS_ID',
-            'FIELD_PRECISION': 0,
-            'FIELD_TYPE': 2,
-            'FORMULA': 'substr(\"Sub_ID\",5,4)',
-            'INPUT': outputs['NutsIdsToCpas']['OUTPUT'],
-            'OUTPUT': QgsProcessing.TEMPORARY_OUTPUT
-        }
-        outputs['CreateSubstatiuonNuts_id'] = processing.run('native:fieldcalculator', alg_params, context=context, feedback=feedback, is_child_algorithm=True)
+        # Fix CF Polys
+        name_step(feedback, 'Fix CF Polys (pieces)')
+        counts = repair_counts(self.parameterAsEnum(parameters, 'GeometryRepair', context))
+        cpas.repair(counts)
+        report_repairs(feedback, counts)
 
-        feedback.setCurrentStep(28)
+        feedback.setCurrentStep(14)
         if feedback.isCanceled():
-            return {}
+            return False
 
-        # COUNTRY IDs to CPAs
-        alg_params = {
-            'INPUT': outputs['CreateSubstatiuonNuts_id']['OUTPUT'],
-            'INPUT_FIELDS': [''],
-            'OVERLAY': filepath+'3_geographicBoundaries/NUTS_2_Boundries/NUTS_RG_10M_2021_3857_LEVL_2.shp',
-            'OVERLAY_FIELDS': ['CNTR_CODE'],
-            'OVERLAY_FIELDS_PREFIX': '',
-            'OUTPUT': QgsProcessing.TEMPORARY_OUTPUT
-        }
-        outputs['CountryIdsToCpas'] = processing.run('native:intersection', alg_params, context=context, feedback=feedback, is_child_algorithm=True)
+        # Calc: resource area polygon
+        name_step(feedback, 'Calc: resource area polygon (compact)')
+        sqkm = measure_sqkm(crs, context)
+        cpas.add_values(QgsField('SqKm', QVariant.Double, len=10, prec=7), full_cell_sqkm(cpas, sqkm, cell_area_mode(crs, context)),
+                        [sqkm(geometry) for geometry in cpas.geometries])
 
-        feedback.setCurrentStep(29)
+        feedback.setCurrentStep(15)
         if feedback.isCanceled():
-            return {}
-
-        # Calc: CPA_ID
-        alg_params = {
-            'FIELD_LENGTH': 10,
-            'FIELD_NAME': 'CPA_ID',
-            'FIELD_PRECISION': 0,
-            'FIELD_TYPE': 2,
-            'FORMULA': '@row_number',
-            'INPUT': outputs['CountryIdsToCpas']['OUTPUT'],
-            'OUTPUT': QgsProcessing.TEMPORARY_OUTPUT
-        }
-        outputs['CalcCpa_id'] = processing.run('native:fieldcalculator', alg_params, context=context, feedback=feedback, is_child_algorithm=True)
-
-        feedback.setCurrentStep(30)
+            return False
+
+        # Remove CPAs below cutoff, and the only layer of the compact steps
+        name_step(feedback, 'Remove CPAs below cutoff (compact)')
+        full_sqkm, piece_sqkm = cpas.values['SqKm']
+        cpas.keep(full_sqkm > MIN_CPA_SQKM, piece_sqkm > MIN_CPA_SQKM)
+        outputs['RemoveCpasBelowCutoff'] = {'OUTPUT': cpas.write(context, feedback)}
+        note_step(feedback, context, {}, outputs['RemoveCpasBelowCutoff'])
+        return outputs['RemoveCpasBelowCutoff']['OUTPUT'] is not None
+
+    def rasterCpas(self, parameters, context, feedback, outputs):
+        # Raster grid engine. Fills outputs['RemoveCpasBelowCutoff'], returns False if the run was cancelled.
+        raster = self.parameterAsRasterLayer(parameters, 'ResourceRaster', context)
+        name_step(feedback, 'Raster grid CPAs')
+        outputs['RemoveCpasBelowCutoff'] = {'OUTPUT': raster_grid_cpas(raster.source(), raster.crs(), self.gridOrigin(outputs, raster.crs(), context),
+                                                                       self.parameterAsInt(parameters, 'CPAGridLength', context), context, feedback)}
+        note_step(feedback, context, {'INPUT_RASTER': raster.source()}, outputs['RemoveCpasBelowCutoff'])
+        return outputs['RemoveCpasBelowCutoff']['OUTPUT'] is not None
+
+    def staticCachePath(self, parameters, context, kind, source, *key_parts):
+        # Cache entry for a layer derived from source alone, None when caching is off
+        if not self.parameterAsBool(parameters, 'UseCache', context):
+            return None
+        return cache_path(kind, [file_fingerprint(source), crs_key(self.parameterAsCrs(parameters, 'EuropeCRS', context))] + list(key_parts))
+
+    def gridPruned(self, parameters, context):
+        # The grid cells are cut from the resource polygons (GRID SPLIT, COMPACT CELLS), no CF grid is built
+        return self.parameterAsBool(parameters, 'GridPruning', context) or self.parameterAsBool(parameters, 'CompactCells', context)
+
+    def gridExtent(self, outputs, crs, context):
+        # Extent of the boundary layer in crs. Its top left corner is the origin of the CPA grid, as in "CF Grid".
+        boundary = QgsProcessingUtils.mapLayerFromString(outputs['FixedBoundaryLayer']['OUTPUT'], context)
+        return QgsCoordinateTransform(boundary.crs(), crs, context.transformContext()).transformBoundingBox(boundary.extent())
+
+    def gridOrigin(self, outputs, crs, context):
+        extent = self.gridExtent(outputs, crs, context)
+        return extent.xMinimum(), extent.yMaximum()
+
+    def tiledCpas(self, parameters, context, feedback, outputs, tile_size, tile_folder):
+        # Run CPA geometry, substations and regions per grid-aligned tile of tile_size x tile_size CPA cells in
+        # worker processes, then merge. Returns the id of the merged layer, None if the run was cancelled.
+        raster = self.parameterAsRasterLayer(parameters, 'ResourceRaster', context)
+        grid_length = self.parameterAsInt(parameters, 'CPAGridLength', context)
+        workers = self.parameterAsInt(parameters, 'Workers', context)
+        extent = self.gridExtent(outputs, raster.crs(), context)
+        jobs = [self.tileJob(parameters, context, outputs, raster, grid_length, tile, window, os.path.join(tile_folder, 'tile_{}.gpkg'.format(n)))
+                for n, (tile, window) in enumerate(grid_tiles(raster.source(), extent, grid_length, tile_size))]
+        feedback.pushInfo('Running {} tiles on {} worker processes'.format(len(jobs), workers))
+        name_step(feedback, 'Tiled CPAs ({} tiles, {} workers)'.format(len(jobs), workers))
+        if not run_tile_jobs(jobs, workers, tile_folder, feedback):
+            return None
+        merged = merge_tiles([job['output'] for job in jobs if os.path.exists(job['output'])],
+                             (extent.xMinimum(), extent.yMaximum()), grid_length, raster.crs(), context, feedback)
+        note_step(feedback, context, {'INPUT_RASTER': raster.source()}, {'OUTPUT': merged})
+        return merged
+
+    def incrementalCpas(self, parameters, context, feedback, outputs, tile_size, tile_folder, previous, previous_raster):
+        # Recompute the tiles where ResourceRaster differs from previous_raster and merge them with the CPAs of
+        # previous elsewhere, see INCREMENTAL RUNS. Returns the id of the merged layer, None if the run was cancelled.
+        raster = self.parameterAsRasterLayer(parameters, 'ResourceRaster', context)
+        if not same_pixel_grid(raster.source(), previous_raster.source()):
+            raise QgsProcessingException('{} and {} are not on the same pixel grid'.format(raster.source(), previous_raster.source()))
+        if previous.crs() != raster.crs():
+            raise QgsProcessingException('The previous CPAs are not in the CRS of the Resource Raster')
+        grid_length = self.parameterAsInt(parameters, 'CPAGridLength', context)
+        workers = self.parameterAsInt(parameters, 'Workers', context)
+        extent = self.gridExtent(outputs, raster.crs(), context)
+        tiles = list(grid_tiles(raster.source(), extent, grid_length, tile_size))
+        windows = [window for _tile, window in tiles]
+        use_cache = self.parameterAsBool(parameters, 'UseCache', context)
+        previous_hashes = tile_hashes(previous_raster.source(), windows, use_cache)
+        hashes = tile_hashes(raster.source(), windows, use_cache)
         if feedback.isCanceled():
-            return {}
-
-        # Unique ID
-        alg_params = {
-            'FIELD_LENGTH': 20,
-            'FIELD_NAME': 'E37_CPA_ID',
-            'FIELD_PRECISION': 0,
-            'FIELD_TYPE': 2,
-            'FORMULA': 'concat(\"NUTS_ID\",\'_\',\"CPA_ID\")',
-            'INPUT': outputs['CalcCpa_id']['OUTPUT'],
-            'OUTPUT': QgsProcessing.TEMPORARY_OUTPUT
+            return None
+        changed = [n for n in range(len(tiles)) if hashes[n] != previous_hashes[n]]
+        jobs = [self.tileJob(parameters, context, outputs, raster, grid_length, tiles[n][0], tiles[n][1], os.path.join(tile_folder, 'tile_{}.gpkg'.format(n)))
+                for n in changed]
+        feedback.pushInfo('{} of {} tiles changed, running them on {} worker processes'.format(len(changed), len(tiles), workers))
+        name_step(feedback, 'Incremental CPAs ({} of {} tiles)'.format(len(changed), len(tiles)))
+        if jobs and not run_tile_jobs(jobs, workers, tile_folder, feedback):
+            return None
+        merged = merge_tiles([job['output'] for job in jobs if os.path.exists(job['output'])],
+                             (extent.xMinimum(), extent.yMaximum()), grid_length, raster.crs(), context, feedback,
+                             previous, [job['tile'] for job in jobs])
+        note_step(feedback, context, {'INPUT_RASTER': raster.source(), 'INPUT': previous.source()}, {'OUTPUT': merged})
+        return merged
+
+    def tileJob(self, parameters, context, outputs, raster, grid_length, tile, window, output):
+        # The job run_tile_job() runs for one tile
+        return {
+            'raster': raster.source(),
+            'window': window,
+            'tile': tile,
+            'crs': raster.crs().authid() or raster.crs().toWkt(),
+            'grid_length': grid_length,
+            'engine': self.parameterAsEnum(parameters, 'CpaEngine', context),
+            'nearest': self.parameterAsEnum(parameters, 'NearestEngine', context),
+            'regions': self.parameterAsEnum(parameters, 'RegionEngine', context),
+            'streaming': self.parameterAsBool(parameters, 'Streaming', context),
+            'windowed': self.parameterAsBool(parameters, 'WindowedRaster', context),
+            'repair': self.parameterAsEnum(parameters, 'GeometryRepair', context),
+            # The grid origin comes from the whole boundary layer and tiles are grid-aligned, so the cells match
+            'pruning': self.parameterAsBool(parameters, 'GridPruning', context),
+            'compact': self.parameterAsBool(parameters, 'CompactCells', context),
+            'substations': outputs.get('FixSubstations', {}).get('OUTPUT'),
+            'substation_index': outputs.get('SubstationIndex', {}).get('OUTPUT'),
+            'boundaries': outputs['FixedBoundaryLayer']['OUTPUT'],
+            'output': output,
         }
-        outputs['UniqueId'] = processing.run('native:fieldcalculator', alg_params, context=context, feedback=feedback, is_child_algorithm=True)
-
-        feedback.setCurrentStep(31)
-        if feedback.isCanceled():
-            return {}
 
-        # Drop field(s)
-        alg_params = {
-            'COLUMN': ['fid','DN','x','n','feature_x','feature_y','nearest_x','nearest_y'],
-            'INPUT': outputs['UniqueId']['OUTPUT'],
-            'OUTPUT': parameters['Cpas']
-        }
-        outputs['DropFields'] = processing.run('qgis:deletecolumn', alg_params, context=context, feedback=feedback, is_child_algorithm=True)
-        results['Cpas'] = outputs['DropFields']['OUTPUT']
-        return results
 
     def name(self):
         return 'CPAs - Onwind'
@@ -533,4 +3588,74 @@ class CpasOnwind(QgsProcessingAlgorithm):
         return 'External Runs'
 
     def createInstance(self):
-        return CpasOnwind()
+        instance = CpasOnwind()
+        # processing.run() runs a copy, which has to see the warm layers too
+        instance.warm = self.warm
+        return instance
+
+
+if __name__ == '__main__':
+    # Worker processes of tiled and batch runs, and the standalone batch entry point:
+    #   python Onwind_CPAs.py --tile job.json
+    #   python Onwind_CPAs.py --run job.json
+    #   python Onwind_CPAs.py --batch RASTER_OR_FOLDER [...] --output FOLDER [--workers N] [--grid-length L]
+    #   python Onwind_CPAs.py --recost CPAS_cost_inputs.npz --output FOLDER [--set NAME=VALUE[,VALUE...] ...]
+    #   python Onwind_CPAs.py --benchmark [GRID_LENGTH ...] --output FOLDER
+    #   python Onwind_CPAs.py --serve [--port PORT] [--grid-length L]
+    #   python Onwind_CPAs.py --submit RASTER --output CPAS [--grid-length L] [--port PORT]
+    parser = argparse.ArgumentParser(description='CPAs - Onwind')
+    mode = parser.add_mutually_exclusive_group(required=True)
+    mode.add_argument('--tile', help='tile job written by a tiled run')
+    mode.add_argument('--run', help='scenario job written by a batch run')
+    mode.add_argument('--batch', nargs='+', help='resource rasters or folders of rasters')
+    mode.add_argument('--recost', help='cost inputs (.npz) saved by a model run')
+    mode.add_argument('--benchmark', nargs='*', type=int, metavar='GRID_LENGTH', help='benchmark on the bundled shapefiles and synthetic rasters')
+    mode.add_argument('--serve', action='store_true', help='run a warm worker that answers jobs on a local socket')
+    mode.add_argument('--submit', help='resource raster of a job for the warm worker')
+    parser.add_argument('--output', help='output folder of a batch, re-costing or benchmark run, CPA output of a submitted job')
+    parser.add_argument('--port', type=int, default=WORKER_PORT, help='local port of the warm worker')
+    parser.add_argument('--set', action='append', default=[], help='cost coefficient values of a re-costing run, NAME=VALUE[,VALUE...]')
+    parser.add_argument('--workers', type=int, help='worker processes of a batch run')
+    parser.add_argument('--grid-length', type=int, default=1400, help='CPAGridLength of a batch run')
+    parser.add_argument('--format', default='gpkg', help='output file extension of a batch run, e.g. gpkg or parquet')
+    args = parser.parse_args()
+    if args.recost:
+        # Re-costing works on the saved arrays, QGIS does not have to be started
+        if not args.output:
+            parser.error('--recost needs --output')
+        sweep = {}
+        for assignment in args.set:
+            name, values = assignment.split('=', 1)
+            sweep[name] = [float(v) for v in values.split(',')]
+        for row in recost_sweep(args.recost, sweep, args.output):
+            print(row['table'])
+        sys.exit(0)
+    if args.submit:
+        # The client side does not need QGIS either
+        if not args.output:
+            parser.error('--submit needs --output')
+        reply = submit_job({'ResourceRaster': os.path.abspath(args.submit), 'CPAGridLength': args.grid_length, 'Cpas': os.path.abspath(args.output)}, args.port)
+        print(json.dumps(reply, indent=2, default=str))
+        sys.exit(0 if reply['ok'] else 1)
+    qgs = start_qgis()
+    main_context = QgsProcessingContext()
+    main_context.setProject(QgsProject.instance())
+    ok = True
+    if args.tile:
+        with open(args.tile) as job_file:
+            ok = run_tile_job(json.load(job_file), main_context, QgsProcessingMultiStepFeedback(21, QgsProcessingFeedback()))
+    elif args.run:
+        with open(args.run) as job_file:
+            ok = bool(run_job(json.load(job_file), main_context, ConsoleFeedback()))
+    elif args.serve:
+        WarmWorker({'CPAGridLength': args.grid_length}).serve(args.port)
+    elif args.benchmark is not None:
+        if not args.output:
+            parser.error('--benchmark needs --output')
+        ok = run_benchmark(args.output, args.benchmark or BENCHMARK_GRID_LENGTHS, feedback=ConsoleFeedback()) is not None
+    else:
+        if not args.output:
+            parser.error('--batch needs --output')
+        ok = run_batch(args.batch, args.output, {'CPAGridLength': args.grid_length}, args.workers, args.format, ConsoleFeedback(), main_context) is not None
+    qgs.exitQgis()
+    sys.exit(0 if ok else 1)